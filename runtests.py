@@ -10,13 +10,13 @@ from django.test.utils import get_runner
 from django.conf import settings
 
 
-def runtests():
+def runtests(test_labels=None):
     django.setup()
     TestRunner = get_runner(settings)
     test_runner = TestRunner(verbosity=1, interactive=True)
-    failures = test_runner.run_tests(['time_logger'])
+    failures = test_runner.run_tests(test_labels or ['time_logger'])
     sys.exit(bool(failures))
 
 
 if __name__ == "__main__":
-    runtests()
+    runtests(sys.argv[1:])
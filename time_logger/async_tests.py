@@ -0,0 +1,124 @@
+# coding: utf-8
+import asyncio
+import threading
+import time
+
+from django.http import HttpResponse
+from django.test import TestCase, override_settings
+from django.urls import path
+from djutils.testrunner import TearDownTestCaseMixin
+import mock
+from mock import sentinel
+
+from time_logger import models_mongo
+from time_logger.middleware.async_view_logger import ViewTimeLoggerMiddleware
+
+
+def sync_view(request):
+    return HttpResponse('sync')
+
+
+async def async_view(request):
+    await asyncio.sleep(0.05)
+    return HttpResponse('async')
+
+
+urlpatterns = [
+    path('sync/', sync_view),
+    path('async/', async_view),
+]
+
+
+def _wait_for_logs(count, timeout=5):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if models_mongo.ViewTimeLog.objects.count() >= count:
+            return True
+        time.sleep(0.01)
+    return False
+
+
+@override_settings(
+    ROOT_URLCONF=__name__,
+    MIDDLEWARE=['time_logger.middleware.async_view_logger.ViewTimeLoggerMiddleware'],
+    LOG_VIEW_TIME=0.000000001,
+)
+class ViewTimeLoggerMiddlewareTestCase(TestCase, TearDownTestCaseMixin):
+    def tearDown(self):
+        self.tearDownMongo()
+
+    def test_sync_view(self):
+        response = self.client.get('/sync/')
+        self.assertEqual(response.content, b'sync')
+
+        log = models_mongo.ViewTimeLog.objects.get()
+        self.assertEqual(log.view_func_path, '%s.sync_view' % __name__)
+        self.assertIsNotNone(log.view_duration)
+
+    async def test_async_view(self):
+        response = await self.async_client.get('/async/')
+        self.assertEqual(response.content, b'async')
+
+        self.assertTrue(await asyncio.to_thread(_wait_for_logs, 1))
+        log = await asyncio.to_thread(models_mongo.ViewTimeLog.objects.get)
+        self.assertEqual(log.view_func_path, '%s.async_view' % __name__)
+        self.assertGreaterEqual(log.duration, 0.05)
+        self.assertGreaterEqual(log.view_duration, 0.05)
+
+    async def test_async_request_data_read_before_response(self):
+        threads = []
+        get_request_data = ViewTimeLoggerMiddleware._get_request_data
+
+        def _get_request_data(middleware, request, username):
+            threads.append(threading.current_thread())
+            return get_request_data(middleware, request, username)
+
+        with mock.patch.object(ViewTimeLoggerMiddleware, '_get_request_data', autospec=True,
+                               side_effect=_get_request_data):
+            response = await self.async_client.post('/async/', {'name': 'test'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(threads, [threading.current_thread()])
+
+        self.assertTrue(await asyncio.to_thread(_wait_for_logs, 1))
+        log = await asyncio.to_thread(models_mongo.ViewTimeLog.objects.get)
+        self.assertEqual(log.request_post, {'name': 'test'})
+
+    async def test_async_response_not_blocked_by_save(self):
+        save_started = threading.Event()
+        save_release = threading.Event()
+        save = models_mongo.ViewTimeLog.save
+
+        def slow_save(log, *args, **kwargs):
+            save_started.set()
+            save_release.wait(5)
+            return save(log, *args, **kwargs)
+
+        with mock.patch.object(models_mongo.ViewTimeLog, 'save', autospec=True, side_effect=slow_save):
+            response = await self.async_client.get('/async/')
+            self.assertEqual(response.status_code, 200)
+
+            self.assertTrue(await asyncio.to_thread(save_started.wait, 5))
+            self.assertFalse(await asyncio.to_thread(models_mongo.ViewTimeLog.objects.count))
+            save_release.set()
+            self.assertTrue(await asyncio.to_thread(_wait_for_logs, 1))
+
+
+class ViewTimeLoggerMiddlewareModeTestCase(TestCase):
+    def test_sync_mode(self):
+        def get_response(request):
+            return sentinel.response
+
+        middleware = ViewTimeLoggerMiddleware(get_response)
+        self.assertFalse(middleware.is_async)
+        self.assertFalse(asyncio.iscoroutinefunction(middleware.process_view))
+
+    def test_async_mode(self):
+        async def get_response(request):
+            return sentinel.response
+
+        middleware = ViewTimeLoggerMiddleware(get_response)
+        self.assertTrue(middleware.is_async)
+        # django does not wrap coroutine hooks with sync_to_async
+        self.assertTrue(asyncio.iscoroutinefunction(middleware.process_view))
+        self.assertTrue(asyncio.iscoroutinefunction(middleware.process_exception))
+        self.assertTrue(asyncio.iscoroutinefunction(middleware.process_template_response))
@@ -0,0 +1,214 @@
+# coding: utf-8
+import logging
+import os
+import threading
+
+from time_logger import models_mongo
+from time_logger.log_tail import SlowLogTail
+from time_logger.management.commands import bin_log_to_mongo, slow_logs_from_db, slow_logs_from_file
+from time_logger.query_digest import QueryDigestCollector
+from time_logger.utils import timer
+
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
+
+logger = logging.getLogger('time_logger')
+
+
+class SlowLogSource(object):
+    """
+    Entries added to slow log file
+    """
+    name = 'slow_log'
+
+    def __init__(self, log_path, batch_size=1000, workers=1):
+        self.digests = QueryDigestCollector(models_mongo.QueryDigest.SLOW_LOG_SOURCE)
+        self.writer = slow_logs_from_file.get_slow_log_writer(self.digests, batch_size)
+        self.tail = SlowLogTail(log_path, workers=workers)
+        # rotated log is replaced in directory
+        self.watch_path = os.path.dirname(os.path.abspath(log_path))
+
+    def collect(self):
+        slow_logs_from_file.import_new_entries(self.tail, self.writer, self.digests)
+
+    def get_counts(self):
+        return self.writer.added, self.writer.inserted
+
+    def close(self):
+        self.tail.close()
+
+
+class BinLogSource(object):
+    """
+    Complete binlogs in bin_log_to_mongo.PATH_TO_BINLOGS
+    """
+    name = 'bin_log'
+
+    def __init__(self, batch_size=1000, engine='readline', workers=1):
+        self.engine = engine
+        self.workers = workers
+        self.digests = QueryDigestCollector(models_mongo.QueryDigest.BIN_LOG_SOURCE)
+        self.writer = bin_log_to_mongo.get_binlog_writer(self.digests, batch_size)
+        self.watch_path = bin_log_to_mongo.PATH_TO_BINLOGS
+        self._mtime = None
+
+    def collect(self):
+        # new binlog changes mtime of directory, it is not listed without changes
+        mtime = os.stat(bin_log_to_mongo.PATH_TO_BINLOGS).st_mtime
+        if mtime == self._mtime:
+            return
+
+        file_names = bin_log_to_mongo.get_new_binlog_file_names()
+        bin_log_to_mongo.import_binlogs(file_names, self.writer, self.digests, self.engine, self.workers)
+        self._mtime = mtime
+
+    def get_counts(self):
+        return self.writer.added, self.writer.inserted
+
+    def close(self):
+        pass
+
+
+class SlowLogTableSource(object):
+    """
+    Queries added to mysql.slow_log tables of databases, tables are read every interval seconds by daemon thread,
+    so slow databases do not delay import of files
+    """
+    name = 'slow_log_table'
+    watch_path = None
+
+    def __init__(self, aliases, batch_size=1000, interval=60):
+        self.aliases = aliases
+        self.batch_size = batch_size
+        self.interval = interval
+
+        self.added = 0
+        self.inserted = 0
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def collect(self):
+        # tables are imported by thread started on first collect
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='time_logger_slow_log_table')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def import_tables(self):
+        for writer in slow_logs_from_db.import_servers(self.aliases, batch_size=self.batch_size):
+            if writer is not None:
+                with self._lock:
+                    self.added += writer.added
+                    self.inserted += writer.inserted
+
+    def get_counts(self):
+        with self._lock:
+            return self.added, self.inserted
+
+    def close(self):
+        self._stop_event.set()
+        if self._thread is not None:
+            # current import is finished and written
+            self._thread.join()
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            try:
+                self.import_tables()
+            except Exception:
+                logger.exception('Failed to collect %s', self.name)
+            self._stop_event.wait(self.interval)
+
+
+class Collector(object):
+    """
+    Imports logs of sources in one process until stop() is called. Sources are collected after changes of their
+    watch paths (inotify with pyinotify) or every interval seconds. Throughput of sources is written to stdout
+    every stats_interval seconds.
+    """
+
+    def __init__(self, sources, interval=1, stats_interval=60, stdout=None):
+        self.sources = sources
+        self.interval = interval
+        self.stats_interval = stats_interval
+        self.stdout = stdout
+
+        self._stop_event = threading.Event()
+        self._stats_time = timer()
+        # source name: (added, inserted) of previous stats
+        self._stats_counts = dict((source.name, (0, 0)) for source in sources)
+
+    def run(self):
+        watcher = FileWatcher([source.watch_path for source in self.sources if source.watch_path], self.interval)
+        try:
+            while not self._stop_event.is_set():
+                self.collect()
+                if timer() - self._stats_time >= self.stats_interval:
+                    self.write_stats()
+                watcher.wait(self._stop_event)
+        finally:
+            watcher.close()
+            for source in self.sources:
+                source.close()
+            self.write_stats()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def collect(self):
+        for source in self.sources:
+            try:
+                source.collect()
+            except Exception:
+                logger.exception('Failed to collect %s', source.name)
+
+    def write_stats(self):
+        now = timer()
+        duration = max(now - self._stats_time, 1e-6)
+        stats = []
+        for source in self.sources:
+            added, inserted = source.get_counts()
+            previous_added, previous_inserted = self._stats_counts[source.name]
+            self._stats_counts[source.name] = (added, inserted)
+            stats.append('%s: %s documents, %s inserted (%.1f inserted/s)' % (
+                source.name, added - previous_added, inserted - previous_inserted,
+                (inserted - previous_inserted) / duration,
+            ))
+        self._stats_time = now
+
+        if self.stdout is not None:
+            self.stdout.write('; '.join(stats))
+
+
+class FileWatcher(object):
+    """
+    Waits for changes in directories by inotify, or interval seconds without pyinotify
+    """
+
+    def __init__(self, paths, interval):
+        self.interval = interval
+        self._notifier = None
+
+        if pyinotify is not None and paths:
+            watch_manager = pyinotify.WatchManager()
+            mask = pyinotify.IN_MODIFY | pyinotify.IN_CREATE | pyinotify.IN_MOVED_TO | pyinotify.IN_CLOSE_WRITE
+            for path in paths:
+                watch_manager.add_watch(path, mask)
+            self._notifier = pyinotify.Notifier(watch_manager, pyinotify.ProcessEvent(),
+                                                timeout=int(interval * 1000))
+
+    def wait(self, stop_event):
+        if self._notifier is None:
+            stop_event.wait(self.interval)
+            return
+
+        if self._notifier.check_events():
+            self._notifier.read_events()
+            self._notifier.process_events()
+
+    def close(self):
+        if self._notifier is not None:
+            self._notifier.stop()
@@ -2,15 +2,25 @@
 
 from django import forms
 
+from . import models_mongo
+
 class ViewsLoggerForm(forms.Form):
-    min_duration = forms.IntegerField(required=False)
+    min_duration = forms.FloatField(required=False)
     view_func_path = forms.CharField(required=False)
     min_dc = forms.DateTimeField(required=False)
     max_dc = forms.DateTimeField(required=False)
 
 
 class SlowQueriesLog(forms.Form):
-    min_query_time = forms.IntegerField(required=False)
+    ORDER_CHOICES = (
+        ('', 'not sorted'),
+        ('-query_time', 'query time'),
+        ('-start_time', 'start time'),
+    )
+
+    min_query_time = forms.FloatField(required=False)
+    server = forms.CharField(required=False)
+    order = forms.ChoiceField(choices=ORDER_CHOICES, required=False)
     min_dc = forms.DateTimeField(required=False)
     max_dc = forms.DateTimeField(required=False)
 
@@ -19,3 +29,20 @@ class BinLog(forms.Form):
     min_exec_time = forms.IntegerField(required=False)
     min_dc = forms.DateTimeField(required=False)
     max_dc = forms.DateTimeField(required=False)
+
+
+class QueryDigests(forms.Form):
+    source = forms.ChoiceField(choices=models_mongo.QueryDigest.SOURCE_CHOICES, required=False)
+    fingerprint = forms.CharField(required=False)
+    min_dc = forms.DateTimeField(required=False)
+    max_dc = forms.DateTimeField(required=False)
+
+
+class LatencyHistograms(forms.Form):
+    SOURCE_CHOICES = (('view', 'view'),) + models_mongo.QueryDigest.SOURCE_CHOICES
+
+    source = forms.ChoiceField(choices=SOURCE_CHOICES)
+    key = forms.CharField(required=False, help_text='View path, fingerprint hash or "<query type> <table>" prefix')
+    by_hour = forms.BooleanField(required=False)
+    min_dc = forms.DateTimeField(required=False)
+    max_dc = forms.DateTimeField(required=False)
@@ -0,0 +1,93 @@
+# coding: utf-8
+import math
+
+# smallest distinguished value in seconds, smaller values go to the first bucket
+MIN_VALUE = 0.000001
+BUCKETS_PER_DOUBLING = 4
+
+
+def get_period(dt):
+    """
+    Hour start of hourly histograms
+    """
+    return dt.replace(minute=0, second=0, microsecond=0)
+
+
+class LogHistogram(object):
+    """
+    Mergeable log-bucketed histogram of durations in seconds.
+    Bucket i holds values from MIN_VALUE * 2 ** (i / BUCKETS_PER_DOUBLING) up to the next bucket bound,
+    so relative error of quantiles is under 2 ** (1 / BUCKETS_PER_DOUBLING) - 1 (~19%).
+    """
+    __slots__ = ('count', 'total', 'max_value', 'buckets')
+
+    _factor = BUCKETS_PER_DOUBLING / math.log(2)
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        # exact max, quantiles are bucket values
+        self.max_value = None
+        self.buckets = {}
+
+    @classmethod
+    def get_index(cls, value):
+        if value <= MIN_VALUE:
+            return 0
+        return int(math.log(value / MIN_VALUE) * cls._factor)
+
+    @staticmethod
+    def get_bucket_value(index):
+        """
+        Geometric middle of bucket
+        """
+        return MIN_VALUE * 2 ** ((index + 0.5) / BUCKETS_PER_DOUBLING)
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        if self.max_value is None or value > self.max_value:
+            self.max_value = value
+        index = self.get_index(value)
+        self.buckets[index] = self.buckets.get(index, 0) + 1
+
+    def merge(self, other):
+        self.count += other.count
+        self.total += other.total
+        if other.max_value is not None and (self.max_value is None or other.max_value > self.max_value):
+            self.max_value = other.max_value
+        for index, count in other.buckets.items():
+            self.buckets[index] = self.buckets.get(index, 0) + count
+
+    def quantile(self, q):
+        if not self.count:
+            return None
+
+        rank = q * self.count
+        seen = 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen >= rank:
+                return self.get_bucket_value(index)
+        return self.get_bucket_value(max(self.buckets))
+
+    def get_max(self):
+        if not self.buckets:
+            return None
+        return self.get_bucket_value(max(self.buckets))
+
+    def to_dict(self):
+        """
+        Buckets with string keys for mongo dict field
+        """
+        return dict((str(index), count) for index, count in self.buckets.items())
+
+    @classmethod
+    def from_dict(cls, buckets, total=0.0, max_value=None):
+        histogram = cls()
+        for index, count in buckets.items():
+            histogram.buckets[int(index)] = count
+            histogram.count += count
+        histogram.total = total
+        histogram.max_value = max_value
+        return histogram
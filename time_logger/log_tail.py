@@ -0,0 +1,113 @@
+# coding: utf-8
+import hashlib
+import logging
+import mmap
+import os
+
+from time_logger import models_mongo
+from time_logger.mysql_logs_parser_from_file import MmapMysqlSlowQueriesParser, parse_slow_log_parallel, \
+    SLOW_LOG_RANGE_SIZE
+
+logger = logging.getLogger('time_logger')
+
+# bytes before checkpoint offset compared with saved hash
+TAIL_HASH_SIZE = 1024
+# unread bytes parsed by pool of workers, pool is not started for small appends of followed log
+PARALLEL_MIN_SIZE = 4 * SLOW_LOG_RANGE_SIZE
+
+
+class SlowLogTail(object):
+    """
+    Reads entries added to slow log since offset saved in SlowLogCheckpoint. Only complete lines are read.
+    Log is read from beginning when it is truncated (smaller than offset or bytes before offset differ).
+    Opened file is read to the end before rotated log (other inode of path) is opened.
+    With workers, only unread part of at least PARALLEL_MIN_SIZE bytes is parsed by pool of processes.
+    """
+
+    def __init__(self, log_path, workers=1, ordered=True):
+        self.log_path = log_path
+        self.workers = workers
+        self.ordered = ordered
+
+        self.checkpoint = models_mongo.SlowLogCheckpoint.objects(log_path=log_path).first()
+        if self.checkpoint is None:
+            self.checkpoint = models_mongo.SlowLogCheckpoint(log_path=log_path)
+        self._file = None
+        self._open()
+
+    def read(self, before_checkpoint=None):
+        """
+        Iterate new entries, checkpoint is saved when all of them are iterated,
+        after before_checkpoint() is called (e.g. to write imported entries)
+        """
+        checkpoint = self.checkpoint
+        # rest of rotated log is read before new log is opened
+        is_rotated = self._is_rotated()
+
+        end = 0
+        tail_hash = None
+        if os.fstat(self._file.fileno()).st_size:
+            data = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                if checkpoint.offset and self._get_tail_hash(data, checkpoint.offset) != checkpoint.tail_hash:
+                    logger.warning('Slow log %s is truncated, it is read from beginning', self.log_path)
+                    checkpoint.offset = 0
+
+                # last line of written log can be incomplete
+                end = len(data) if is_rotated else data.rfind(b'\n', checkpoint.offset) + 1
+                tail_hash = self._get_tail_hash(data, end)
+            finally:
+                data.close()
+        elif checkpoint.offset:
+            logger.warning('Slow log %s is truncated, it is read from beginning', self.log_path)
+            checkpoint.offset = 0
+
+        if end > checkpoint.offset:
+            # workers open log by path
+            if self.workers > 1 and not is_rotated and end - checkpoint.offset >= PARALLEL_MIN_SIZE:
+                entries = parse_slow_log_parallel(self.log_path, self.workers, self.ordered,
+                                                  start=checkpoint.offset, end=end, last_time=checkpoint.last_time)
+            else:
+                entries = MmapMysqlSlowQueriesParser(self._file, checkpoint.offset, end, checkpoint.last_time)
+            # new entries can begin without '# Time:' line in the same second as imported ones
+            last_time = checkpoint.last_time
+            for entry in entries:
+                if entry['start_time'] is not None and (last_time is None or entry['start_time'] > last_time):
+                    last_time = entry['start_time']
+                yield entry
+
+            if before_checkpoint is not None:
+                before_checkpoint()
+            checkpoint.offset = end
+            checkpoint.tail_hash = tail_hash
+            checkpoint.last_time = last_time
+            checkpoint.save()
+
+        if is_rotated:
+            logger.info('Slow log %s is rotated', self.log_path)
+            self._open()
+
+    def close(self):
+        self._file.close()
+
+    def _open(self):
+        if self._file is not None:
+            self._file.close()
+        self._file = open(self.log_path, 'rb')
+
+        inode = os.fstat(self._file.fileno()).st_ino
+        if self.checkpoint.inode != inode:
+            self.checkpoint.inode = inode
+            self.checkpoint.offset = 0
+            self.checkpoint.tail_hash = None
+
+    def _is_rotated(self):
+        try:
+            return os.stat(self.log_path).st_ino != self.checkpoint.inode
+        except OSError:
+            # new log is not created yet
+            return False
+
+    @staticmethod
+    def _get_tail_hash(data, offset):
+        return hashlib.sha1(data[max(offset - TAIL_HASH_SIZE, 0):offset]).hexdigest()
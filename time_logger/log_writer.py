@@ -0,0 +1,283 @@
+# coding: utf-8
+import atexit
+import collections
+import hashlib
+import logging
+import threading
+import time
+
+from pymongo.errors import DuplicateKeyError
+
+try:
+    from pymongo.errors import BulkWriteError
+except ImportError:
+    # pymongo 2
+    BulkWriteError = None
+
+from time_logger.utils import timer
+
+logger = logging.getLogger('time_logger')
+
+DROP_OLDEST = 'drop_oldest'
+DROP_NEWEST = 'drop_newest'
+OVERFLOW_POLICIES = (DROP_OLDEST, DROP_NEWEST)
+
+
+DUPLICATE_KEY_ERROR_CODE = 11000
+
+
+def insert_many(document_cls, docs, ignore_duplicates=False):
+    """
+    Unordered bulk insert of raw mongo documents (pymongo 3 and pymongo 2 api), returns number of inserted
+    documents. With ignore_duplicates documents which violate unique index are skipped.
+    """
+    collection = document_cls._get_collection()
+    try:
+        if hasattr(collection, 'insert_many'):
+            return len(collection.insert_many(docs, ordered=False).inserted_ids)
+        collection.insert(docs, continue_on_error=True)
+        return len(docs)
+    except DuplicateKeyError:
+        if not ignore_duplicates:
+            raise
+        # pymongo 2 does not report number of inserted documents, _id is set to documents before insert
+        return collection.find({'_id': {'$in': [doc['_id'] for doc in docs if '_id' in doc]}}).count()
+    except Exception as e:
+        if not ignore_duplicates or BulkWriteError is None or not isinstance(e, BulkWriteError):
+            raise
+        errors = e.details.get('writeErrors', [])
+        if any(error['code'] != DUPLICATE_KEY_ERROR_CODE for error in errors) or e.details.get('writeConcernErrors'):
+            raise
+        return e.details.get('nInserted', 0)
+
+
+class BackgroundLogWriter(object):
+    """
+    Bounded in-process queue of documents drained by a daemon thread.
+    Documents are written with one insert per document class of batch when batch_size documents are collected
+    or flush_interval seconds passed.
+    """
+
+    def __init__(self, max_size=1000, batch_size=100, flush_interval=1.0, overflow_policy=DROP_OLDEST, spool=None):
+        if overflow_policy not in OVERFLOW_POLICIES:
+            raise ValueError('Unknown overflow policy: %s' % overflow_policy)
+
+        # time_logger.spool.SpoolWriter for documents which can not be written to mongo
+        self.spool = spool
+        self.max_size = max_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.overflow_policy = overflow_policy
+
+        self.written = 0
+        self.spooled = 0
+        self.failed = 0
+        self.dropped_oldest = 0
+        self.dropped_newest = 0
+
+        self._queue = collections.deque()
+        self._in_flight = 0
+        self._closed = False
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def put(self, document):
+        """
+        Enqueue document without blocking. Returns False if document was dropped.
+        """
+        with self._condition:
+            if self._closed:
+                self.dropped_newest += 1
+                return False
+
+            if len(self._queue) >= self.max_size:
+                if self.overflow_policy == DROP_NEWEST:
+                    self.dropped_newest += 1
+                    return False
+                self._queue.popleft()
+                self.dropped_oldest += 1
+
+            self._queue.append(document)
+            if len(self._queue) >= self.batch_size:
+                self._condition.notify_all()
+
+        self._ensure_started()
+        return True
+
+    def flush(self, timeout=None):
+        """
+        Write all queued documents from the calling thread and wait for the batch being written by the worker.
+        """
+        while self._write_batch():
+            pass
+
+        deadline = None if timeout is None else time.time() + timeout
+        with self._condition:
+            while self._in_flight:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+
+    def close(self, timeout=None):
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        self.flush(timeout)
+
+    def get_stats(self):
+        with self._condition:
+            return {
+                'queued': len(self._queue),
+                'written': self.written,
+                'spooled': self.spooled,
+                'failed': self.failed,
+                'dropped_oldest': self.dropped_oldest,
+                'dropped_newest': self.dropped_newest,
+            }
+
+    def _ensure_started(self):
+        if self._thread is not None:
+            return
+
+        with self._condition:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name='time_logger_writer')
+            self._thread.daemon = True
+            self._thread.start()
+        atexit.register(self.close)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                deadline = time.time() + self.flush_interval
+                while not self._closed and len(self._queue) < self.batch_size:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    self._condition.wait(remaining)
+                if self._closed and not self._queue:
+                    return
+            self._write_batch()
+
+    def _write_batch(self):
+        with self._condition:
+            if not self._queue:
+                return False
+            batch = [self._queue.popleft() for _ in range(min(self.batch_size, len(self._queue)))]
+            self._in_flight += 1
+
+        try:
+            if self.spool is not None and self.spool.is_active():
+                self._spool_batch(batch)
+            else:
+                self._insert_batch(batch)
+        finally:
+            with self._condition:
+                self._in_flight -= 1
+                self._condition.notify_all()
+
+        return True
+
+    def _insert_batch(self, batch):
+        start = timer()
+        try:
+            docs_by_cls = collections.OrderedDict()
+            for document in batch:
+                document.validate()
+                docs_by_cls.setdefault(document.__class__, []).append(document.to_mongo())
+            for document_cls, docs in docs_by_cls.items():
+                # provisional log can be replaced by final log before it is inserted
+                insert_many(document_cls, docs, ignore_duplicates=True)
+        except Exception:
+            logger.exception('Failed to write %s documents', len(batch))
+            if self.spool is not None:
+                self.spool.activate()
+                self._spool_batch(batch)
+            else:
+                with self._condition:
+                    self.failed += len(batch)
+        else:
+            with self._condition:
+                self.written += len(batch)
+            if self.spool is not None:
+                self.spool.observe(timer() - start)
+
+    def _spool_batch(self, batch):
+        try:
+            self.spool.write(batch)
+        except Exception:
+            logger.exception('Failed to spool %s documents', len(batch))
+            with self._condition:
+                self.failed += len(batch)
+        else:
+            with self._condition:
+                self.spooled += len(batch)
+
+
+def get_content_hash(fields):
+    """
+    sha1 of field names and values, the same for log imported again
+    """
+    content = u'\n'.join(u'%s=%s' % (name, _to_text(fields[name])) for name in sorted(fields))
+    return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+
+def _to_text(value):
+    if isinstance(value, bytes):
+        # python 2 parsers return str
+        return value.decode('utf-8', 'replace')
+    return value
+
+
+class BatchWriter(object):
+    """
+    Writes imported logs with unordered insert per batch_size documents. Documents get content_hash
+    (unique index) of their fields, already imported documents are skipped with one query per batch.
+    on_insert(document, context) is called for new documents before they are inserted.
+    """
+
+    def __init__(self, document_cls, batch_size=1000, on_insert=None):
+        self.document_cls = document_cls
+        self.batch_size = batch_size
+        self.on_insert = on_insert
+
+        self.added = 0
+        self.inserted = 0
+        self._start = timer()
+        # content hash: (document, context)
+        self._batch = collections.OrderedDict()
+
+    def add(self, fields, context=None):
+        content_hash = get_content_hash(fields)
+        self.added += 1
+        if content_hash not in self._batch:
+            self._batch[content_hash] = (self.document_cls(content_hash=content_hash, **fields), context)
+        if len(self._batch) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        batch, self._batch = self._batch, collections.OrderedDict()
+        if not batch:
+            return
+
+        imported_hashes = set(self.document_cls.objects(content_hash__in=list(batch)).values_list('content_hash'))
+        docs = []
+        for content_hash, (document, context) in batch.items():
+            if content_hash in imported_hashes:
+                continue
+            if self.on_insert is not None:
+                self.on_insert(document, context)
+            docs.append(document.to_mongo())
+
+        if docs:
+            # documents imported concurrently are skipped by unique index
+            self.inserted += insert_many(self.document_cls, docs, ignore_duplicates=True)
+
+    def get_report(self):
+        duration = max(timer() - self._start, 1e-6)
+        return '%s: %s documents, %s inserted, %s duplicates in %.1f s (%.0f documents/s, %.0f inserted/s)' % (
+            self.document_cls.__name__, self.added, self.inserted, self.added - self.inserted, duration,
+            self.added / duration, self.inserted / duration,
+        )
@@ -0,0 +1,138 @@
+# coding: utf-8
+import datetime
+
+from django.core.management.base import BaseCommand
+
+from time_logger import models_mongo
+from time_logger.histogram import LogHistogram, get_period
+from time_logger.management.commands.bin_log_to_mongo import get_histogram_key
+from time_logger.management.commands.slow_logs_from_db import _parse_since
+from time_logger.query_digest import QueryHistogramCollector, get_fingerprint_hash, get_statement_fingerprint
+
+VIEW_SOURCE = 'view'
+SOURCES = (VIEW_SOURCE, models_mongo.QueryDigest.SLOW_LOG_SOURCE, models_mongo.QueryDigest.BIN_LOG_SOURCE)
+
+
+class Command(BaseCommand):
+    help = 'Build hourly latency histograms of logs imported before histograms were collected'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--source', nargs='+', choices=SOURCES, default=list(SOURCES))
+        parser.add_argument('--since', default=None,
+                            help='Date or datetime, default is the first log (query histograms are rebuilt since '
+                                 'the next hour, the first one can be partly removed)')
+        parser.add_argument('--until', default=None,
+                            help='Date or datetime, default is start of current hour (query histograms are rebuilt '
+                                 'until hour of the latest log of every server, it is still imported)')
+        parser.add_argument('--batch_size', type=int, default=1000, help='Logs read per histograms write')
+
+    def handle(self, *args, **options):
+        since = get_period(_parse_since(options['since'])) if options['since'] else None
+        until = get_period(_parse_since(options['until']) if options['until'] else datetime.datetime.now())
+
+        for source in options['source']:
+            if source == VIEW_SOURCE:
+                count = backfill_views(since, until)
+            else:
+                count = backfill_queries(source, since, until, options['batch_size'])
+            self.stdout.write('%s: %s logs' % (source, count))
+
+
+def get_covered_periods(source, since, until):
+    """
+    Hours from since until of source which are covered by imported logs: hours before the first log are removed
+    by retention (the first hour can be removed partly, so it is skipped without since),
+    hour of the latest log is still imported. Returns (since, until), since is None if there are no such hours.
+    """
+    if source == models_mongo.QueryDigest.SLOW_LOG_SOURCE:
+        log_cls = models_mongo.MysqlSlowQueriesTimeLog
+        # slow_log tables of servers are imported independently
+        servers = log_cls.objects.distinct('server') or [None]
+    else:
+        log_cls = models_mongo.MysqlBinLogTimeLog
+        servers = None
+
+    first_time = log_cls.objects.order_by('start_time').scalar('start_time').first()
+    if first_time is None:
+        return None, until
+
+    if servers is None:
+        latest_times = [log_cls.objects.order_by('-start_time').scalar('start_time').first()]
+    else:
+        latest_times = [log_cls.objects(server=server).order_by('-start_time').scalar('start_time').first()
+                        for server in servers]
+    until = min([until] + [get_period(latest_time) for latest_time in latest_times])
+
+    first_period = get_period(first_time)
+    if since is None:
+        since = first_period + datetime.timedelta(hours=1)
+    else:
+        since = max(since, first_period)
+    if since >= until:
+        return None, until
+    return since, until
+
+
+def backfill_queries(source, since, until, batch_size=1000):
+    """
+    Rebuild QueryLatencyHistogram of source for hours from since until which are covered by logs,
+    returns number of logs
+    """
+    since, until = get_covered_periods(source, since, until)
+    if since is None:
+        return 0
+
+    models_mongo.QueryLatencyHistogram.objects(source=source, period__gte=since, period__lt=until).delete()
+
+    if source == models_mongo.QueryDigest.SLOW_LOG_SOURCE:
+        logs = models_mongo.MysqlSlowQueriesTimeLog.objects.only(
+            'start_time', 'query_time', 'sql_text', 'fingerprint_hash')
+    else:
+        logs = models_mongo.MysqlBinLogTimeLog.objects.only('start_time', 'exec_time', 'query_type', 'query')
+    logs = logs.filter(start_time__gte=since, start_time__lt=until).no_cache()
+
+    collector = QueryHistogramCollector(source)
+    count = 0
+    for log in logs:
+        if source == models_mongo.QueryDigest.SLOW_LOG_SOURCE:
+            # logs imported before digests
+            key = log.fingerprint_hash or get_fingerprint_hash(get_statement_fingerprint(log.sql_text or ''))
+            collector.add(key, log.start_time, log.query_time or 0)
+        else:
+            collector.add(get_histogram_key(log.query_type, log.query), log.start_time, log.exec_time or 0)
+        count += 1
+        if count % batch_size == 0:
+            collector.flush()
+    collector.flush()
+    return count
+
+
+def backfill_views(since, until):
+    """
+    Add ViewLatencyHistogram of view logs for hours without histograms of view, returns number of logs.
+    Only slow requests are logged, so histograms of them are not replaced.
+    """
+    logs = models_mongo.ViewTimeLog.objects(dc__lt=until, in_progress__ne=True).only(
+        'dc', 'duration', 'view_func_path').no_cache()
+    existing = models_mongo.ViewLatencyHistogram.objects(period__lt=until)
+    if since is not None:
+        logs = logs.filter(dc__gte=since)
+        existing = existing.filter(period__gte=since)
+    existing = set(existing.scalar('view_func_path', 'period'))
+
+    # (view_func_path, period): LogHistogram
+    histograms = {}
+    count = 0
+    for log in logs:
+        key = (log.view_func_path, get_period(log.dc))
+        if key in existing or log.duration is None:
+            continue
+        histogram = histograms.get(key)
+        if histogram is None:
+            histogram = histograms[key] = LogHistogram()
+        histogram.add(log.duration)
+        count += 1
+
+    for (view_func_path, period), histogram in histograms.items():
+        models_mongo.ViewLatencyHistogram.add(view_func_path, period, histogram)
+    return count
@@ -1,14 +1,29 @@
 # coding: utf-8
 import os
 import datetime
+import multiprocessing
+
+try:
+    from queue import Empty
+except ImportError:
+    # python 2
+    from Queue import Empty
 
 from django.core.management.base import BaseCommand
 import subprocess
-from time_logger.mysql_logs_parser_from_file import MysqlBinLogParser
+from time_logger.log_writer import BatchWriter
+from time_logger.mysql_logs_parser_from_file import MysqlBinLogParser, MmapMysqlBinLogParser
+from time_logger.query_digest import QueryDigestCollector, get_table
 from time_logger import models_mongo
 
 PATH_TO_BINLOGS = '/var/log/mysql/'
 PATH_TO_READABLE_BINLOGS = '/tmp/binlogs/'
+MYSQLBINLOG = 'mysqlbinlog'
+# seconds of waiting for parsed batch before workers are checked
+WORKERS_CHECK_INTERVAL = 5
+
+# queue of parsed batches, set in worker processes
+_queue = None
 
 
 class Command(BaseCommand):
@@ -16,57 +31,230 @@ class Command(BaseCommand):
 
     def add_arguments(self, parser):
         parser.add_argument('--log_path', default=None)
+        # readline parses output of mysqlbinlog from pipe while it is decoded,
+        # mmap decodes binlog into temporary file first
+        parser.add_argument('--engine', choices=('readline', 'mmap'), default='readline')
+        parser.add_argument('--workers', type=int, default=1, help='Number of processes decoding and parsing binlogs')
+        parser.add_argument('--batch_size', type=int, default=1000,
+                            help='Logs per insert and checkpoint of binlog position')
 
     def handle(self, *args, **options):
-        parsed_log_names = models_mongo.ParsedLogsFiles.objects.values_list('file_name')
-
         log_path = options.get('log_path')
         if log_path:
             file_name = log_path.split('/')[-1]
-            if file_name in parsed_log_names:
+            if _get_parsed_file_names([file_name]):
                 raise Exception('file already parsed')
 
-            new_binlog_file_paths = _create_readable_binlog([file_name, ])
+            new_binlog_file_names = [file_name]
+
+        else:
+            new_binlog_file_names = get_new_binlog_file_names()
+
+        digests = QueryDigestCollector(models_mongo.QueryDigest.BIN_LOG_SOURCE)
+        writer = get_binlog_writer(digests, options['batch_size'])
+        import_binlogs(new_binlog_file_names, writer, digests, options['engine'], options['workers'])
+        self.stdout.write(writer.get_report())
+
+
+def get_new_binlog_file_names():
+    """
+    Names of complete binlogs in PATH_TO_BINLOGS which are not parsed
+    """
+    binlog_file_names = [
+        name for name in os.listdir(PATH_TO_BINLOGS)
+        if name.startswith('mysql-bin') and name != 'mysql-bin.index'
+    ]
+    # cutoff last log. Mysql writes binlogs in it
+    binlog_file_names = sorted(binlog_file_names)[:-1]
+
+    parsed_log_names = _get_parsed_file_names(binlog_file_names)
+    return [name for name in binlog_file_names if name not in parsed_log_names]
 
+
+def get_binlog_writer(digests, batch_size=1000):
+    """
+    BatchWriter of binlog logs, digests of inserted logs are added to digests
+    """
+    return BatchWriter(models_mongo.MysqlBinLogTimeLog, batch_size,
+                       on_insert=lambda document, context: _add_digest(digests, document))
+
+
+def import_binlogs(file_names, writer, digests, engine='readline', workers=1):
+    """
+    Import binlogs from positions of their checkpoints. Logs are written by writer of get_binlog_writer,
+    digests and checkpoint are saved after each batch.
+    """
+    checkpoints = dict(
+        (checkpoint.file_name, checkpoint)
+        for checkpoint in models_mongo.BinLogCheckpoint.objects(file_name__in=file_names)
+    )
+    tasks = [
+        (file_name, checkpoints[file_name].end_log_pos if file_name in checkpoints else 0, engine, writer.batch_size)
+        for file_name in file_names
+    ]
+
+    for file_name, entries, end_log_pos, is_finished in _parse_binlogs(tasks, workers):
+        # events imported before interruption are skipped by content hash, it includes log_position
+        for entry in entries:
+            writer.add(entry)
+        writer.flush()
+        digests.flush()
+
+        checkpoint = checkpoints.get(file_name)
+        if is_finished:
+            models_mongo.ParsedLogsFiles.objects.create(file_name=file_name)
+            if checkpoint is not None:
+                checkpoint.delete()
         else:
-            new_binlog_file_names = [
-                name for name in os.listdir(PATH_TO_BINLOGS)
-                if name not in parsed_log_names and name.startswith('mysql-bin') and name != 'mysql-bin.index'
-                ]
+            if checkpoint is None:
+                checkpoint = checkpoints[file_name] = models_mongo.BinLogCheckpoint(file_name=file_name)
+            checkpoint.end_log_pos = end_log_pos
+            checkpoint.save()
+
+
+def get_histogram_key(query_type, query):
+    """
+    Key of binlog query in QueryLatencyHistogram: "<query type> <table>"
+    """
+    table = get_table(query or '')
+    return '%s %s' % (query_type, table) if table else query_type
+
+
+def _add_digest(digests, document):
+    document.fingerprint_hash = digests.add(document.query, document.exec_time, seen=document.start_time,
+                                            histogram_key=get_histogram_key(document.query_type, document.query))
 
-            # cutoff last log. Mysql writes binlogs in it
-            new_binlog_file_names = sorted(new_binlog_file_names)[:-1]
 
-            new_binlog_file_paths = _create_readable_binlog(new_binlog_file_names)
+def _get_parsed_file_names(file_names):
+    return set(models_mongo.ParsedLogsFiles.objects(file_name__in=file_names).values_list('file_name'))
 
-        for log_path in new_binlog_file_paths:
-            for entry in MysqlBinLogParser(log_path):
-                if entry['query_type'] in models_mongo.MysqlBinLogTimeLog.LOGGED_QUERY_TYPES:
-                    # remove not interested stats
-                    del entry['server_id']
-                    del entry['end_log_pos']
-                    del entry['thread_id']
-                    del entry['db']
 
-                    entry['end_time'] = entry['start_time'] + datetime.timedelta(seconds=entry['exec_time'])
-                    models_mongo.MysqlBinLogTimeLog.objects.create(**entry)
-            models_mongo.ParsedLogsFiles.objects.create(file_name=log_path.split('/')[-1])
+def _parse_binlogs(tasks, workers):
+    """
+    Iterate batches (file_name, logged entries, end_log_pos, is_finished) of binlogs parsed from positions of tasks.
+    With several workers binlogs are decoded and parsed by pool of processes, batches of binlogs are mixed.
+    """
+    if workers <= 1 or len(tasks) <= 1:
+        for task in tasks:
+            for batch in _parse_binlog(*task):
+                yield batch
+        return
 
-            # remove parsed_log
-            os.remove(log_path)
+    queue = multiprocessing.Queue(workers * 2)
+    children = set(multiprocessing.active_children())
+    pool = multiprocessing.Pool(min(workers, len(tasks)), _init_worker, (queue,))
+    # processes of pool exit only when pool is terminated
+    processes = set(multiprocessing.active_children()) - children
+    try:
+        results = [pool.apply_async(_put_binlog_batches, task) for task in tasks]
 
+        not_finished = len(tasks)
+        while not_finished:
+            try:
+                batch = queue.get(timeout=WORKERS_CHECK_INTERVAL)
+            except Empty:
+                # task of killed worker is not finished, pool replaces worker and waits for it forever
+                _check_workers(results, processes)
+                continue
+            if isinstance(batch, Exception):
+                raise batch
+            if batch[3]:
+                not_finished -= 1
+            yield batch
+    finally:
+        pool.terminate()
 
-def _create_readable_binlog(new_binlog_file_names):
-    new_binlog_file_paths = []
 
+def _check_workers(results, processes):
+    for result in results:
+        if result.ready() and not result.successful():
+            # raises error of task
+            result.get()
+    for process in processes:
+        if not process.is_alive():
+            raise Exception('Binlog worker %s exited with code %s' % (process.pid, process.exitcode))
+
+
+def _init_worker(queue):
+    global _queue
+    _queue = queue
+
+
+def _put_binlog_batches(*task):
+    try:
+        for batch in _parse_binlog(*task):
+            _queue.put(batch)
+    except Exception as e:
+        _queue.put(Exception('%s: %s' % (task[0], e)))
+
+
+def _parse_binlog(file_name, start_log_pos, engine, batch_size):
+    """
+    Iterate batches of logged entries after start_log_pos, last batch is finished
+    """
+    read_binlog = _read_binlog_from_file if engine == 'mmap' else _read_binlog_from_pipe
+
+    entries = []
+    end_log_pos = start_log_pos
+    for entry in read_binlog(file_name):
+        entry_log_pos = int(entry['end_log_pos'])
+        if entry_log_pos <= start_log_pos:
+            continue
+        end_log_pos = entry_log_pos
+
+        if entry['query_type'] in models_mongo.MysqlBinLogTimeLog.LOGGED_QUERY_TYPES:
+            # remove not interested stats
+            del entry['server_id']
+            del entry['end_log_pos']
+            del entry['thread_id']
+            del entry['db']
+
+            entry['end_time'] = entry['start_time'] + datetime.timedelta(seconds=entry['exec_time'])
+            entry['log_position'] = '%s:%s' % (file_name, end_log_pos)
+            entries.append(entry)
+            if len(entries) >= batch_size:
+                yield file_name, entries, end_log_pos, False
+                entries = []
+
+    yield file_name, entries, end_log_pos, True
+
+
+def _get_mysqlbinlog_args(file_name):
+    # command mysqlbinlog --verbose --base64-output=NEVER  mysql-bin.002491 > bin_logs.sql
+    return [MYSQLBINLOG, '--verbose', os.path.join(PATH_TO_BINLOGS, file_name)]
+
+
+def _read_binlog_from_pipe(file_name):
+    """
+    Parses output of mysqlbinlog while binlog is decoded, decoded binlog is not written to disk
+    """
+    # buffered pipe, python 2 reads unbuffered pipe by byte
+    process = subprocess.Popen(_get_mysqlbinlog_args(file_name), stdout=subprocess.PIPE, bufsize=-1,
+                               universal_newlines=True)
+    try:
+        for entry in MysqlBinLogParser(process.stdout):
+            yield entry
+        # lines after end of log
+        process.stdout.read()
+    finally:
+        process.stdout.close()
+        returncode = process.wait()
+
+    if returncode:
+        raise Exception('mysqlbinlog failed on %s with code %s' % (file_name, returncode))
+
+
+def _read_binlog_from_file(file_name):
     # create dir for readable logs
     if not os.path.exists(PATH_TO_READABLE_BINLOGS):
         os.mkdir(PATH_TO_READABLE_BINLOGS)
-    # make binlogs readable
-    for file_name in new_binlog_file_names:
-        # command mysqlbinlog --verbose --base64-output=NEVER  mysql-bin.002491 > bin_logs.sql
-        subprocess.call('mysqlbinlog --verbose %s%s > %s%s' %
-                        (PATH_TO_BINLOGS, file_name, PATH_TO_READABLE_BINLOGS, file_name), shell=True)
-
-        new_binlog_file_paths.append('%s%s' % (PATH_TO_READABLE_BINLOGS, file_name))
-    return new_binlog_file_paths
+
+    log_path = os.path.join(PATH_TO_READABLE_BINLOGS, file_name)
+    try:
+        with open(log_path, 'w') as log_file:
+            subprocess.check_call(_get_mysqlbinlog_args(file_name), stdout=log_file)
+        for entry in MmapMysqlBinLogParser(log_path):
+            yield entry
+    finally:
+        # remove parsed_log
+        os.remove(log_path)
@@ -0,0 +1,44 @@
+# coding: utf-8
+from django.core.management.base import BaseCommand
+
+from time_logger import models_mongo
+
+DURATION_FIELDS = ('query_time', 'lock_time')
+
+
+class Command(BaseCommand):
+    help = 'Convert integer query_time and lock_time of imported slow queries to float seconds'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch_size', type=int, default=1000, help='Logs read per update')
+
+    def handle(self, *args, **options):
+        collection = models_mongo.MysqlSlowQueriesTimeLog._get_collection()
+        counts = dict.fromkeys(DURATION_FIELDS, 0)
+
+        # raw documents, mongoengine converts integers to float
+        batch = []
+        for doc in collection.find({}, dict.fromkeys(DURATION_FIELDS, 1)):
+            batch.append(doc)
+            if len(batch) >= options['batch_size']:
+                _migrate(batch, counts)
+                batch = []
+        _migrate(batch, counts)
+
+        for field_name in DURATION_FIELDS:
+            self.stdout.write('%s: %s logs' % (field_name, counts[field_name]))
+
+
+def _migrate(docs, counts):
+    # ids of logs by integer duration, logs are updated with one query per value
+    ids_by_value = {}
+    for doc in docs:
+        for field_name in DURATION_FIELDS:
+            value = doc.get(field_name)
+            # long of python 2
+            if isinstance(value, (int, type(2 ** 64))) and not isinstance(value, bool):
+                ids_by_value.setdefault((field_name, value), []).append(doc['_id'])
+
+    for (field_name, value), ids in ids_by_value.items():
+        models_mongo.MysqlSlowQueriesTimeLog.objects(id__in=ids).update(**{'set__%s' % field_name: float(value)})
+        counts[field_name] += len(ids)
@@ -1,26 +1,45 @@
 # # coding: utf-8
-import os
 import datetime
 
 from django.core.management.base import BaseCommand
-import subprocess
-from time_logger.mysql_logs_parser_from_file import MysqlBinLogParser
-from time_logger import models_mongo
-
-PATH_TO_BINLOGS = '/var/log/mysql/'
-PATH_TO_READABLE_BINLOGS = '/tmp/binlogs/'
+from time_logger.retention import EXPIRE_FIELDS, apply_ttl_indexes, get_expired, iter_delete_expired
 
 
 class Command(BaseCommand):
-    help = 'Remove old logs from MysqlBinLogTimeLog, MysqlSlowQueriesTimeLog, ViewTimeLog'
+    help = ('Remove old logs from MysqlBinLogTimeLog, MysqlSlowQueriesTimeLog, ViewTimeLog, SuppressedViewTimeLog, '
+            'ViewLatencyHistogram, QueryLatencyHistogram')
 
     def add_arguments(self, parser):
-        parser.add_argument('--expire_day', required=True, help='Day after which remove logs')
+        parser.add_argument('--expire_day', help='Day after which remove logs')
+        parser.add_argument('--chunk_size', type=int, default=1000, help='Logs removed by one delete')
+        parser.add_argument('--sleep', type=float, default=0.1, help='Seconds between deletes')
+        parser.add_argument('--dry-run', action='store_true', dest='dry_run', default=False,
+                            help='Only print number of logs to remove')
+        parser.add_argument('--ttl', action='store_true', default=False,
+                            help='Apply TTL indexes of LOG_VIEW_TIME_TTL_DAYS, mongo removes expired logs itself')
 
     def handle(self, *args, **options):
-        expire_day = int(options.get('expire_day'))
-        expire_date = datetime.datetime.now() - datetime.timedelta(days=expire_day)
+        if not options.get('expire_day') and not options['ttl']:
+            raise Exception('expire_day or ttl is required')
+
+        if options['ttl'] and not options['dry_run']:
+            for document_name, field_name, action in apply_ttl_indexes():
+                self.stdout.write('%s.%s: %s' % (document_name, field_name, action))
+
+        if options.get('expire_day'):
+            expire_day = int(options.get('expire_day'))
+            expire_date = datetime.datetime.now() - datetime.timedelta(days=expire_day)
+
+            for document_cls, field_name in EXPIRE_FIELDS:
+                document_name = document_cls.__name__
+                count = get_expired(document_cls, field_name, expire_date).count()
+                if options['dry_run'] or not count:
+                    self.stdout.write('%s: %s logs to remove' % (document_name, count))
+                    continue
 
-        models_mongo.MysqlBinLogTimeLog.objects.filter(start_time__lt=expire_date).delete()
-        models_mongo.MysqlSlowQueriesTimeLog.objects.filter(start_time__lt=expire_date).delete()
-        models_mongo.ViewTimeLog.objects.filter(dc__lt=expire_date).delete()
+                removed = 0
+                chunks = iter_delete_expired(document_cls, field_name, expire_date, options['chunk_size'],
+                                             options['sleep'])
+                for chunk_removed in chunks:
+                    removed += chunk_removed
+                    self.stdout.write('%s: %s/%s logs removed' % (document_name, removed, count))
@@ -0,0 +1,65 @@
+# coding: utf-8
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from time_logger import models_mongo
+from time_logger.log_writer import insert_many
+from time_logger.spool import get_spool_files, read_spool_file
+
+
+class Command(BaseCommand):
+    help = 'Import logs spooled by ViewTimeLogger when mongo was unavailable'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--spool_dir', default=getattr(settings, 'LOG_VIEW_TIME_SPOOL_DIR', None))
+        parser.add_argument('--batch_size', type=int, default=1000)
+        parser.add_argument('--include_active', action='store_true', default=False,
+                            help='Import files which are not closed, use only for files of stopped processes')
+        parser.add_argument('--keep', action='store_true', default=False, help='Do not remove imported files')
+
+    def handle(self, *args, **options):
+        spool_dir = options.get('spool_dir')
+        if not spool_dir:
+            raise Exception('spool_dir is not set')
+
+        batch_size = options['batch_size']
+        for path in get_spool_files(spool_dir, include_active=options['include_active']):
+            batches = {}
+            count = 0
+            for model_name, document in read_spool_file(path):
+                batch = batches.setdefault(model_name, [])
+                batch.append(document)
+                if len(batch) >= batch_size:
+                    _insert(model_name, batch)
+                    count += len(batch)
+                    batches[model_name] = []
+
+            for model_name, batch in batches.items():
+                if batch:
+                    _insert(model_name, batch)
+                    count += len(batch)
+
+            if not options['keep']:
+                os.remove(path)
+            self.stdout.write('%s: %s logs' % (path, count))
+
+
+def _insert(model_name, docs):
+    # documents have _id, so already imported documents are skipped
+    document_cls = getattr(models_mongo, model_name)
+    insert_many(document_cls, docs, ignore_duplicates=True)
+
+    if document_cls is models_mongo.ViewTimeLog:
+        # final logs replace provisional logs of the same id
+        final_docs = dict((doc['_id'], doc) for doc in docs if not doc.get('in_progress'))
+        if not final_docs:
+            return
+        collection = document_cls._get_collection()
+        for provisional in collection.find({'_id': {'$in': list(final_docs)}, 'in_progress': True}, {'_id': 1}):
+            if hasattr(collection, 'replace_one'):
+                collection.replace_one({'_id': provisional['_id']}, final_docs[provisional['_id']])
+            else:
+                # pymongo 2
+                collection.update({'_id': provisional['_id']}, final_docs[provisional['_id']])
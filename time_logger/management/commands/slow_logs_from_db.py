@@ -1,33 +1,187 @@
 # coding: utf-8
 import datetime
+import logging
+from multiprocessing.pool import ThreadPool
 
 from django.core.management.base import BaseCommand
-from django.db import connection
+from django.db import connections, DEFAULT_DB_ALIAS
+from django.utils.dateparse import parse_date, parse_datetime
 
 from time_logger import models_mongo
+from time_logger.log_writer import BatchWriter
+from time_logger.query_digest import QueryDigestCollector, get_statement_fingerprint
+
+try:
+    from MySQLdb.cursors import SSCursor
+except ImportError:
+    SSCursor = None
+
+logger = logging.getLogger('time_logger')
 
 
 class Command(BaseCommand):
     help = 'Improt mysql slow query log from mysql to mongodb'
 
+    def add_arguments(self, parser):
+        parser.add_argument('--database', nargs='+', default=[DEFAULT_DB_ALIAS],
+                            help='Aliases of mysql databases in DATABASES, they are imported concurrently')
+        parser.add_argument('--threads', type=int, default=None,
+                            help='Number of databases imported at the same time, default is all of them')
+        parser.add_argument('--since', default=None,
+                            help='Import queries started since date or datetime, '
+                                 'default is start time of latest imported query of database')
+        parser.add_argument('--limit', type=int, default=None, help='Max number of imported queries per database')
+        parser.add_argument('--batch_size', type=int, default=1000, help='Rows per fetch and logs per insert')
+
     def handle(self, *args, **options):
-        logs = models_mongo.MysqlSlowQueriesTimeLog.objects.all()
-        latest_start_time = None
-        if logs:
-            latest_start_time = logs.order_by('-start_time')[0].start_time
-        cursor = connection.cursor()
-        cursor.execute("use mysql")
-
-        query = "SELECT * FROM slow_log"
-        if latest_start_time:
-            query += " WHERE start_time > '%s'" % latest_start_time.isoformat()
-        cursor.execute(query)
-        fields = map(lambda x: x[0], cursor.description)
-        results = [dict(zip(fields, row)) for row in cursor.fetchall()]
-
-        # write results into mongo
-        for row in results:
-            row['query_time'] = row['query_time'].second
+        aliases = options['database']
+        since = _parse_since(options['since']) if options['since'] else None
+
+        writers = import_servers(aliases, since, options['limit'], options['batch_size'], options['threads'])
+        failed_aliases = []
+        for alias, writer in zip(aliases, writers):
+            if writer is None:
+                failed_aliases.append(alias)
+            else:
+                self.stdout.write('%s: %s' % (alias, writer.get_report()))
+        if failed_aliases:
+            raise Exception('Failed to import slow log of %s' % ', '.join(failed_aliases))
+
+
+def import_servers(aliases, since=None, limit=None, batch_size=1000, threads=None):
+    """
+    Import slow_log of databases concurrently, returns BatchWriter of every alias or None if import failed
+    """
+    pool = ThreadPool(min(threads or len(aliases), len(aliases)))
+    try:
+        return pool.map(lambda alias: _import_server_safe(alias, since, limit, batch_size), aliases)
+    finally:
+        pool.close()
+
+
+def _import_server_safe(alias, since, limit, batch_size):
+    try:
+        return _import_server(alias, since, limit, batch_size)
+    except Exception:
+        logger.exception('Failed to import slow log of %s', alias)
+        return None
+
+
+def _import_server(alias, since, limit, batch_size):
+    """
+    Import slow_log of database alias, returns BatchWriter of its logs. Logs are tagged by alias in server field.
+    """
+    if since is None:
+        since = _get_latest_start_time(alias)
+
+    # writer and digests are used by one thread
+    digests = QueryDigestCollector(models_mongo.QueryDigest.SLOW_LOG_SOURCE)
+    writer = BatchWriter(models_mongo.MysqlSlowQueriesTimeLog, batch_size,
+                         on_insert=lambda document, context: _add_digest(digests, document))
+    # connections are thread local, connection of this thread is closed after import
+    connection = connections[alias]
+    try:
+        for row in _iter_slow_log(connection, since, limit, batch_size):
+            row['query_time'] = _to_seconds(row['query_time'])
             row['end_time'] = row['start_time'] + datetime.timedelta(seconds=row['query_time'])
-            row['lock_time'] = row['lock_time'].second
-            models_mongo.MysqlSlowQueriesTimeLog.objects.create(**row)
+            row['lock_time'] = _to_seconds(row['lock_time'])
+            row['server'] = alias
+            writer.add(row)
+    finally:
+        connection.close()
+    writer.flush()
+    digests.flush()
+    return writer
+
+
+def _to_seconds(value):
+    """
+    Seconds with microseconds of TIME(6) column, drivers return it as timedelta or time
+    """
+    if isinstance(value, datetime.timedelta):
+        return value.days * 86400 + value.seconds + value.microseconds / 1000000.0
+    if isinstance(value, datetime.time):
+        return value.hour * 3600 + value.minute * 60 + value.second + value.microsecond / 1000000.0
+    return float(value)
+
+
+def _get_latest_start_time(alias):
+    """
+    High-water mark of database: start time of latest imported query. Queries of this second are imported again,
+    imported logs are skipped by content hash.
+    """
+    logs = models_mongo.MysqlSlowQueriesTimeLog.objects.order_by('-start_time').only('start_time')
+    if alias == DEFAULT_DB_ALIAS:
+        # logs imported before they were tagged by server
+        logs = logs.filter(server__in=[alias, None])
+    else:
+        logs = logs.filter(server=alias)
+    latest_log = logs.first()
+    return latest_log.start_time if latest_log else None
+
+
+def _parse_since(value):
+    since = parse_datetime(value)
+    if since is None:
+        since = parse_date(value)
+        if since is None:
+            raise ValueError('Wrong date: %s' % value)
+        since = datetime.datetime.combine(since, datetime.time())
+    return since
+
+
+def _iter_slow_log(connection, since, limit, chunk_size):
+    """
+    Iterate rows of mysql.slow_log ordered by start_time as dicts. Rows are fetched by chunks from server-side
+    cursor, so result is not loaded into memory at once. Rows of since second are not counted by limit.
+    """
+    query = 'SELECT * FROM mysql.slow_log'
+    params = []
+    if since:
+        query += ' WHERE start_time >= %s'
+        params.append(since)
+    query += ' ORDER BY start_time'
+    if limit:
+        if since:
+            # rows of since (latest imported second) are imported again, without them in limit import advances
+            # when more than limit queries are logged in one second
+            limit += _count_slow_log_rows(connection, since)
+        query += ' LIMIT %s'
+        params.append(limit)
+
+    cursor = _get_server_side_cursor(connection)
+    try:
+        cursor.execute(query, params)
+        fields = [column[0] for column in cursor.description]
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            for row in rows:
+                yield dict(zip(fields, row))
+    finally:
+        cursor.close()
+
+
+def _count_slow_log_rows(connection, start_time):
+    cursor = connection.cursor()
+    try:
+        cursor.execute('SELECT COUNT(*) FROM mysql.slow_log WHERE start_time = %s', [start_time])
+        return cursor.fetchone()[0]
+    finally:
+        cursor.close()
+
+
+def _get_server_side_cursor(connection):
+    if SSCursor is None or connection.vendor != 'mysql':
+        # client-side cursor of other drivers
+        return connection.cursor()
+
+    connection.ensure_connection()
+    return connection.connection.cursor(SSCursor)
+
+
+def _add_digest(digests, document):
+    document.fingerprint_hash = digests.add(document.sql_text, document.query_time, document.lock_time,
+                                            document.rows_examined, document.start_time,
+                                            query_fingerprint=get_statement_fingerprint(document.sql_text))
@@ -1,28 +1,95 @@
 # coding: utf-8
 import datetime
+import logging
+import time
 
 from django.core.management.base import BaseCommand
+from time_logger.log_tail import SlowLogTail
+from time_logger.log_writer import BatchWriter
 from time_logger.mysql_logs_parser_from_file import MysqlSlowQueriesParser
+from time_logger.query_digest import QueryDigestCollector, get_statement_fingerprint
 from time_logger import models_mongo
 
+logger = logging.getLogger('time_logger')
+
 
 class Command(BaseCommand):
     help = 'Improt mysql slow query log from file to mongodb'
 
     def add_arguments(self, parser):
         parser.add_argument('--log_path')
+        parser.add_argument('--engine', choices=('mmap', 'readline'), default='mmap',
+                            help='readline engine imports whole log without checkpoint')
+        parser.add_argument('--workers', type=int, default=1,
+                            help='Number of processes parsing log by parts (mmap engine)')
+        parser.add_argument('--unordered', action='store_true', default=False,
+                            help='Import parts of log as they are parsed')
+        parser.add_argument('--follow', action='store_true', default=False,
+                            help='Keep importing entries added to log')
+        parser.add_argument('--interval', type=float, default=1, help='Seconds between log reads in follow mode')
+        parser.add_argument('--batch_size', type=int, default=1000, help='Logs per insert')
 
     def handle(self, *args, **options):
-        for entry in MysqlSlowQueriesParser(options['log_path']):
-            data = {
-                'start_time': entry['start_time'],
-                'end_time': entry['start_time'] - datetime.timedelta(seconds=entry['query_time']),
-                'user_host': u'%s@%s' % (entry['user'], entry['host']),
-                'query_time': entry['query_time'],
-                'lock_time': entry['lock_time'],
-                'rows_sent': entry['rows_sent'],
-                'sql_text': ' ;'.join(entry['queries_list']),
-            }
-
-            if not models_mongo.MysqlSlowQueriesTimeLog.objects.filter(**data).count():
-                models_mongo.MysqlSlowQueriesTimeLog.objects.create(**data)
+        digests = QueryDigestCollector(models_mongo.QueryDigest.SLOW_LOG_SOURCE)
+        writer = get_slow_log_writer(digests, options['batch_size'])
+        try:
+            if options['engine'] == 'readline':
+                _import_entries(MysqlSlowQueriesParser(options['log_path']), writer)
+                writer.flush()
+                digests.flush()
+                return
+
+            # log is read from offset of previous import
+            tail = SlowLogTail(options['log_path'], workers=options['workers'], ordered=not options['unordered'])
+            try:
+                while True:
+                    import_new_entries(tail, writer, digests)
+                    if not options['follow']:
+                        break
+                    time.sleep(options['interval'])
+            finally:
+                tail.close()
+        finally:
+            self.stdout.write(writer.get_report())
+
+
+def get_slow_log_writer(digests, batch_size=1000):
+    """
+    BatchWriter of slow log entries, digests of inserted logs are added to digests
+    """
+    return BatchWriter(models_mongo.MysqlSlowQueriesTimeLog, batch_size,
+                       on_insert=lambda document, entry: _add_digest(digests, document, entry))
+
+
+def import_new_entries(tail, writer, digests):
+    """
+    Import entries added to log of SlowLogTail, writer of get_slow_log_writer
+    """
+    # entries are written before checkpoint is saved
+    _import_entries(tail.read(before_checkpoint=writer.flush), writer)
+    digests.flush()
+
+
+def _import_entries(entries, writer):
+    for entry in entries:
+        if entry['start_time'] is None:
+            # first entry of log without '# Time:' line and 'SET timestamp=' query
+            logger.warning('Slow log entry without time is skipped: %s', ' '.join(entry['queries_list'])[:100])
+            continue
+        # entries after checkpoint imported by interrupted run are skipped by content hash
+        writer.add({
+            'start_time': entry['start_time'],
+            'end_time': entry['start_time'] - datetime.timedelta(seconds=entry['query_time']),
+            'user_host': u'%s@%s' % (entry['user'], entry['host']),
+            'query_time': entry['query_time'],
+            'lock_time': entry['lock_time'],
+            'rows_sent': entry['rows_sent'],
+            'sql_text': ' ;'.join(entry['queries_list']),
+        }, entry)
+
+
+def _add_digest(digests, document, entry):
+    # lines of multiline query are joined by ' ;' in sql_text, fingerprint is the same as of backfilled logs
+    document.fingerprint_hash = digests.add(' '.join(entry['queries_list']), entry['query_time'],
+                                            entry['lock_time'], entry['rows_examined'], entry['start_time'],
+                                            query_fingerprint=get_statement_fingerprint(document.sql_text))
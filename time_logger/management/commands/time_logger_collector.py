@@ -0,0 +1,40 @@
+# coding: utf-8
+import signal
+
+from django.core.management.base import BaseCommand
+
+from time_logger.collector import Collector, SlowLogSource, BinLogSource, SlowLogTableSource
+
+
+class Command(BaseCommand):
+    help = 'Import slow log, binlogs and slow_log tables continuously in one process'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--log_path', help='Path of slow query log')
+        parser.add_argument('--binlogs', action='store_true', default=False,
+                            help='Import binlogs of bin_log_to_mongo.PATH_TO_BINLOGS')
+        parser.add_argument('--database', nargs='+', default=[], help='Aliases of databases to import slow_log table')
+        parser.add_argument('--interval', type=float, default=1,
+                            help='Seconds between imports of files without pyinotify (or changes with it)')
+        parser.add_argument('--db_interval', type=float, default=60, help='Seconds between imports of slow_log tables')
+        parser.add_argument('--stats_interval', type=float, default=60, help='Seconds between throughput stats')
+        parser.add_argument('--batch_size', type=int, default=1000, help='Logs per insert')
+        parser.add_argument('--engine', choices=('readline', 'mmap'), default='readline', help='Engine of binlogs')
+        parser.add_argument('--workers', type=int, default=1, help='Number of processes parsing logs')
+
+    def handle(self, *args, **options):
+        sources = []
+        if options['log_path']:
+            sources.append(SlowLogSource(options['log_path'], options['batch_size'], options['workers']))
+        if options['binlogs']:
+            sources.append(BinLogSource(options['batch_size'], options['engine'], options['workers']))
+        if options['database']:
+            sources.append(SlowLogTableSource(options['database'], options['batch_size'], options['db_interval']))
+        if not sources:
+            raise Exception('log_path, binlogs or database is required')
+
+        collector = Collector(sources, options['interval'], options['stats_interval'], self.stdout)
+        # current import is finished and written on shutdown
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, lambda signum, frame: collector.stop())
+        collector.run()
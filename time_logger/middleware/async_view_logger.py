@@ -0,0 +1,89 @@
+# coding: utf-8
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+
+from time_logger.middleware.view_logger import ViewTimeLogger, RequestTimeRecord, logger, _get_username
+from time_logger.utils import timer
+
+from asgiref.sync import sync_to_async
+try:
+    from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+except ImportError:
+    # asgiref < 3.6
+    iscoroutinefunction = asyncio.iscoroutinefunction
+
+    def markcoroutinefunction(func):
+        func._is_coroutine = asyncio.coroutines._is_coroutine
+        return func
+
+
+class ViewTimeLoggerMiddleware(ViewTimeLogger):
+    """
+    MIDDLEWARE version of ViewTimeLogger (django >= 3.1), works with sync and async get_response.
+    In async mode hooks are coroutines, so django does not run them in thread,
+    and logs are written in thread pool without blocking event loop. Request data is read before response
+    is returned, request body is closed after it.
+    Query capture and profiler are not used for async requests: their queries and stacks are in other threads.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        super(ViewTimeLoggerMiddleware, self).__init__()
+        self.get_response = get_response
+
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+            self.executor = ThreadPoolExecutor(
+                max_workers=getattr(settings, 'LOG_VIEW_TIME_ASYNC_WORKERS', 1),
+                thread_name_prefix='time_logger',
+            )
+            # django adapts sync hooks of async middleware with sync_to_async
+            self.process_view = self.aprocess_view
+            self.process_template_response = self.aprocess_template_response
+            self.process_exception = self.aprocess_exception
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+
+        self.process_request(request)
+        response = self.get_response(request)
+        return self.process_response(request, response)
+
+    async def __acall__(self, request):
+        record = request.time_logger = RequestTimeRecord(timer())
+        response = await self.get_response(request)
+
+        end = timer()
+        log_view_time = getattr(settings, 'LOG_VIEW_TIME', None)
+        is_slow = log_view_time and end - record.start > log_view_time
+        if self.histograms or is_slow:
+            request_data = None
+            if is_slow:
+                # lazy request.user can query database, it is not allowed in event loop
+                username = await sync_to_async(_get_username)(request) if hasattr(request, 'user') else None
+                request_data = self._get_request_data(request, username)
+
+            # logging is not awaited, response is not delayed by mongo
+            future = asyncio.get_running_loop().run_in_executor(
+                self.executor, self._log_view, request, end, request_data)
+            future.add_done_callback(_log_exception)
+        return response
+
+    async def aprocess_view(self, request, view_func, view_args, view_kwargs):
+        ViewTimeLogger.process_view(self, request, view_func, view_args, view_kwargs)
+
+    async def aprocess_template_response(self, request, response):
+        return ViewTimeLogger.process_template_response(self, request, response)
+
+    async def aprocess_exception(self, request, exception):
+        return ViewTimeLogger.process_exception(self, request, exception)
+
+
+def _log_exception(future):
+    if future.exception() is not None:
+        logger.error('Failed to log view', exc_info=future.exception())
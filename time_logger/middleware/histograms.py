@@ -0,0 +1,73 @@
+# coding: utf-8
+import atexit
+import datetime
+import logging
+import threading
+import time
+
+from time_logger import models_mongo
+from time_logger.histogram import LogHistogram, get_period
+
+logger = logging.getLogger('time_logger')
+
+# views over max_views limit are counted together
+OTHER_VIEWS_PATH = '__other__'
+
+
+class ViewLatencyHistograms(object):
+    """
+    Per process latency histograms of all requests by view path and hour of request.
+    Daemon thread flushes them every flush_interval seconds into hourly ViewLatencyHistogram documents.
+    """
+
+    def __init__(self, flush_interval=60, max_views=1000):
+        self.flush_interval = flush_interval
+        self.max_views = max_views
+
+        # (view path, period): LogHistogram
+        self._histograms = {}
+        self._view_func_paths = set()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def add(self, view_func_path, duration, dc=None):
+        """
+        Add duration of request finished at dc (now by default)
+        """
+        period = get_period(dc or datetime.datetime.now())
+        with self._lock:
+            histogram = self._histograms.get((view_func_path, period))
+            if histogram is None:
+                if view_func_path not in self._view_func_paths and len(self._view_func_paths) >= self.max_views:
+                    view_func_path = OTHER_VIEWS_PATH
+                self._view_func_paths.add(view_func_path)
+                histogram = self._histograms.setdefault((view_func_path, period), LogHistogram())
+            histogram.add(duration)
+
+        if self._thread is None:
+            self._ensure_started()
+
+    def flush(self):
+        with self._lock:
+            histograms, self._histograms = self._histograms, {}
+            self._view_func_paths = set()
+
+        for (view_func_path, period), histogram in histograms.items():
+            try:
+                models_mongo.ViewLatencyHistogram.add(view_func_path, period, histogram)
+            except Exception:
+                logger.exception('Failed to flush latency histogram of %s', view_func_path)
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name='time_logger_histograms')
+            self._thread.daemon = True
+            self._thread.start()
+        atexit.register(self.flush)
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
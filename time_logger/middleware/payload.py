@@ -0,0 +1,120 @@
+# coding: utf-8
+import re
+
+TRUNCATED_MARKER = '...[truncated]'
+REDACTED_VALUE = '********'
+# key of request_get/request_post with count of skipped keys
+SKIPPED_KEYS_KEY = '__skipped_keys__'
+
+DEFAULT_REDACT_KEYS = ('password', 'passwd', 'secret', 'token', 'api_key', 'csrfmiddlewaretoken', 'sessionid')
+
+
+def _truncate(value, max_size):
+    """
+    Returns value cut to max_size bytes and original size in bytes
+    """
+    encoded = value.encode('utf-8')
+    size = len(encoded)
+    if size <= max_size:
+        return value, size
+    return encoded[:max_size].decode('utf-8', 'ignore') + TRUNCATED_MARKER, size
+
+
+class PayloadCapture(object):
+    """
+    Bounded copy of request GET, POST and body for ViewTimeLog.
+    Values of sensitive keys (whole keys, case insensitive) are replaced by REDACTED_VALUE.
+    """
+
+    def __init__(self, max_value_size=1024, max_field_size=16384, max_body_size=0, redact_keys=DEFAULT_REDACT_KEYS):
+        self.max_value_size = max_value_size
+        self.max_field_size = max_field_size
+        self.max_body_size = max_body_size
+
+        self._redact_key = None
+        self._redact_body = None
+        if redact_keys:
+            keys_pattern = '|'.join(re.escape(key) for key in redact_keys)
+            self._redact_key = re.compile('^(?:%s)$' % keys_pattern, re.IGNORECASE)
+            # key=value of urlencoded body and "key": "value" of json body
+            self._redact_body = re.compile(
+                r'''((?:^|(?<=[&?"'\s{,]))(?:%s)["']?\s*[=:]\s*["']?)[^&"',}\s]*''' % keys_pattern, re.IGNORECASE
+            )
+
+    def query_to_dict(self, qd):
+        """
+        Returns dict of QueryDict and original size in bytes if it was truncated else None
+        """
+        result = {}
+        size = 0
+        field_size = 0
+        skipped_keys = 0
+        is_truncated = False
+
+        for key in qd:
+            # mongo dict field not allow '.' and '$' in key
+            if '.' in key or '$' in key:
+                continue
+
+            is_redacted = self._redact_key is not None and self._redact_key.search(key)
+            values = []
+            item_size = len(key)
+            for value in qd.getlist(key):
+                if is_redacted:
+                    value = REDACTED_VALUE
+                value, value_size = _truncate(value, self.max_value_size)
+                is_truncated = is_truncated or value_size > self.max_value_size
+                size += value_size
+                item_size += min(value_size, self.max_value_size)
+                values.append(value)
+
+            if field_size + item_size > self.max_field_size:
+                skipped_keys += 1
+                continue
+            field_size += item_size
+
+            if len(values) > 1:
+                result[key] = values
+            else:
+                result[key] = values[0]
+
+        if skipped_keys:
+            result[SKIPPED_KEYS_KEY] = skipped_keys
+        if is_truncated or skipped_keys:
+            return result, size
+        return result, None
+
+    def get_body(self, request):
+        """
+        Returns first max_body_size bytes of request body as text and original size in bytes if it was truncated
+        (None if size is unknown). Not read body is not read further than max_body_size.
+        Should be called after request.POST, which can not be parsed after body head is read.
+        """
+        if not self.max_body_size:
+            return None, None
+
+        try:
+            size = int(request.META['CONTENT_LENGTH'])
+        except (KeyError, ValueError, TypeError):
+            size = None
+
+        if hasattr(request, '_body'):
+            size = len(request._body)
+            body = request._body[:self.max_body_size + 1]
+        elif getattr(request, '_read_started', False):
+            # body stream was consumed by view (POST or FILES parsing)
+            return None, None
+        elif size is not None and size <= self.max_body_size:
+            # small body is buffered, so request.POST is still available
+            body = request.body
+        else:
+            # view did not read body, only head of stream is read for log
+            body = request.read(self.max_body_size + 1)
+
+        is_truncated = len(body) > self.max_body_size
+        body = body[:self.max_body_size].decode('utf-8', 'replace')
+        if self._redact_body is not None:
+            body = self._redact_body.sub(r'\1' + REDACTED_VALUE, body)
+        if is_truncated:
+            return body + TRUNCATED_MARKER, size
+        return body, None
@@ -0,0 +1,92 @@
+# coding: utf-8
+import collections
+import sys
+import threading
+import time
+
+# samples of new stacks of thread with max_stacks stacks
+OTHER_STACK = '[other stacks]'
+
+
+class SamplingProfiler(object):
+    """
+    Statistical profiler. One daemon thread samples stacks of registered threads every interval seconds,
+    samples are aggregated by folded stack ("outer;inner count" lines, input format of flamegraph.pl).
+    Number of distinct stacks per thread is limited by max_stacks.
+    """
+
+    def __init__(self, interval=0.02, max_depth=100, max_stacks=1000):
+        self.interval = interval
+        self.max_depth = max_depth
+        self.max_stacks = max_stacks
+
+        self._samples = {}
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def start(self, ident):
+        with self._condition:
+            self._samples[ident] = collections.Counter()
+            self._condition.notify_all()
+        self._ensure_started()
+
+    def stop(self, ident):
+        """
+        Stop sampling of thread and return its samples counter or None if thread was not sampled.
+        """
+        with self._condition:
+            return self._samples.pop(ident, None)
+
+    def sample(self):
+        frames = sys._current_frames()
+        with self._condition:
+            for ident, counter in self._samples.items():
+                frame = frames.get(ident)
+                if frame is not None:
+                    stack = self._get_folded_stack(frame)
+                    if stack not in counter and len(counter) >= self.max_stacks:
+                        stack = OTHER_STACK
+                    counter[stack] += 1
+
+    def _get_folded_stack(self, frame):
+        stack = []
+        while frame is not None and len(stack) < self.max_depth:
+            code = frame.f_code
+            stack.append('%s (%s:%d)' % (code.co_name, code.co_filename, code.co_firstlineno))
+            frame = frame.f_back
+        stack.reverse()
+        return ';'.join(stack)
+
+    def _ensure_started(self):
+        if self._thread is not None:
+            return
+
+        with self._condition:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name='time_logger_profiler')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._samples:
+                    self._condition.wait()
+            time.sleep(self.interval)
+            self.sample()
+
+
+def to_folded(samples, max_size=None):
+    """
+    Folded stacks of samples, the most common first. Stacks over max_size characters are skipped.
+    """
+    lines = []
+    size = 0
+    for stack, count in samples.most_common():
+        line = '%s %d' % (stack, count)
+        size += len(line) + 1
+        if max_size is not None and size > max_size + 1:
+            break
+        lines.append(line)
+    return '\n'.join(lines)
@@ -0,0 +1,116 @@
+# coding: utf-8
+import collections
+
+from django.db import connections
+
+from time_logger.utils import timer
+
+
+# connection methods which create cursors of django < 2.0, they are replaced by install
+_MAKE_CURSOR_METHODS = ('make_cursor', 'make_debug_cursor')
+
+
+class QueryCapture(object):
+    """
+    Database execute wrapper (django >= 2.0) which counts request queries
+    and keeps last max_queries statements with their durations.
+    Connections of django < 2.0 make cursors wrapped by CaptureCursorWrapper.
+    """
+
+    def __init__(self, max_queries=100):
+        self.count = 0
+        self.duration = 0.0
+        self.queries = collections.deque(maxlen=max_queries)
+
+    def __call__(self, execute, sql, params, many, context):
+        start = timer()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            duration = timer() - start
+            self.count += 1
+            self.duration += duration
+            self.queries.append((context['connection'].alias, sql, duration))
+
+    def install(self):
+        for connection in connections.all():
+            execute_wrappers = getattr(connection, 'execute_wrappers', None)
+            if execute_wrappers is None:
+                self._install_cursor_wrapper(connection)
+                continue
+            # wrapper of previous request could be left if its response was not processed
+            execute_wrappers[:] = [w for w in execute_wrappers if not isinstance(w, QueryCapture)]
+            execute_wrappers.append(self)
+
+    def uninstall(self):
+        for connection in connections.all():
+            execute_wrappers = getattr(connection, 'execute_wrappers', None)
+            if execute_wrappers is None:
+                self._uninstall_cursor_wrapper(connection)
+            elif self in execute_wrappers:
+                execute_wrappers.remove(self)
+
+    def _install_cursor_wrapper(self, connection):
+        # connections are thread local, methods are replaced on connection of request thread
+        for name in _MAKE_CURSOR_METHODS:
+            # wrapper of previous request could be left if its response was not processed
+            connection.__dict__.pop(name, None)
+            make_cursor = getattr(connection, name, None)
+            if make_cursor is not None:
+                setattr(connection, name, _CaptureMakeCursor(make_cursor, connection, self))
+
+    def _uninstall_cursor_wrapper(self, connection):
+        for name in _MAKE_CURSOR_METHODS:
+            make_cursor = connection.__dict__.get(name)
+            if isinstance(make_cursor, _CaptureMakeCursor) and make_cursor.queries is self:
+                del connection.__dict__[name]
+
+    def to_list(self):
+        return [
+            {'alias': alias, 'sql': sql, 'duration': round(duration, 6)}
+            for alias, sql, duration in self.queries
+        ]
+
+
+class _CaptureMakeCursor(object):
+    def __init__(self, make_cursor, connection, queries):
+        self.make_cursor = make_cursor
+        self.connection = connection
+        self.queries = queries
+
+    def __call__(self, cursor):
+        return CaptureCursorWrapper(self.make_cursor(cursor), self.connection, self.queries)
+
+
+class CaptureCursorWrapper(object):
+    """
+    Cursor of django < 2.0 which executes queries by QueryCapture
+    """
+
+    def __init__(self, cursor, connection, queries):
+        self.cursor = cursor
+        self.context = {'connection': connection, 'cursor': cursor}
+        self.queries = queries
+
+    def __getattr__(self, attr):
+        return getattr(self.cursor, attr)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        return self.cursor.__exit__(type, value, traceback)
+
+    def execute(self, sql, params=None):
+        return self.queries(self._execute, sql, params, False, self.context)
+
+    def executemany(self, sql, param_list):
+        return self.queries(self._execute, sql, param_list, True, self.context)
+
+    def _execute(self, sql, params, many, context):
+        if many:
+            return self.cursor.executemany(sql, params)
+        return self.cursor.execute(sql, params)
@@ -0,0 +1,149 @@
+# coding: utf-8
+import datetime
+import logging
+import threading
+import time
+
+from time_logger.middleware.histograms import OTHER_VIEWS_PATH
+from time_logger.utils import timer
+
+logger = logging.getLogger('time_logger')
+
+# min seconds between checks of summary thread
+MIN_SUMMARY_DELAY = 1
+
+
+class TokenBucket(object):
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate, capacity, now):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = now
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+
+class SuppressedLogs(object):
+    __slots__ = ('count', 'duration_min', 'duration_max', 'duration_sum', 'start_dc', 'end_dc')
+
+    def __init__(self, dc):
+        self.count = 0
+        self.duration_min = None
+        self.duration_max = None
+        self.duration_sum = 0.0
+        self.start_dc = dc
+        self.end_dc = dc
+
+    def add(self, duration, dc):
+        self.count += 1
+        self.duration_sum += duration
+        if self.duration_min is None or duration < self.duration_min:
+            self.duration_min = duration
+        if self.duration_max is None or duration > self.duration_max:
+            self.duration_max = duration
+        self.end_dc = dc
+
+
+class LogRateLimiter(object):
+    """
+    Per process and per view token buckets of slow view logs.
+    Logs over budget are counted by view and returned by pop_suppressed once per summary_interval seconds.
+    With on_summary daemon thread passes them to on_summary, so summaries are written without new slow requests.
+    """
+
+    def __init__(self, rate=None, burst=None, view_rate=None, view_burst=None, summary_interval=60, max_views=1000,
+                 on_summary=None):
+        self.rate = rate
+        self.burst = burst or max(rate or 0, 1)
+        self.view_rate = view_rate
+        self.view_burst = view_burst or max(view_rate or 0, 1)
+        self.summary_interval = summary_interval
+        self.max_views = max_views
+        self.on_summary = on_summary
+        self._thread = None
+
+        now = timer()
+        self._bucket = TokenBucket(self.rate, self.burst, now) if self.rate else None
+        self._view_buckets = {}
+        self._suppressed = {}
+        self._summary_time = now
+        self._lock = threading.Lock()
+
+    def allow(self, view_func_path, duration):
+        now = timer()
+        with self._lock:
+            buckets = []
+            if self._bucket is not None:
+                buckets.append(self._bucket)
+            if self.view_rate:
+                buckets.append(self._get_view_bucket(view_func_path, now))
+
+            for bucket in buckets:
+                bucket.refill(now)
+            if all(bucket.tokens >= 1 for bucket in buckets):
+                for bucket in buckets:
+                    bucket.tokens -= 1
+                return True
+
+            dc = datetime.datetime.now()
+            suppressed = self._suppressed.get(view_func_path)
+            if suppressed is None:
+                if len(self._suppressed) >= self.max_views:
+                    view_func_path = OTHER_VIEWS_PATH
+                suppressed = self._suppressed.get(view_func_path)
+                if suppressed is None:
+                    suppressed = self._suppressed[view_func_path] = SuppressedLogs(dc)
+            suppressed.add(duration, dc)
+
+        if self.on_summary is not None and self._thread is None:
+            self._ensure_started()
+        return False
+
+    def pop_suppressed(self, force=False):
+        """
+        Suppressed logs by view path if summary interval passed (or force) else empty dict
+        """
+        now = timer()
+        with self._lock:
+            if not self._suppressed or (not force and now - self._summary_time < self.summary_interval):
+                return {}
+            suppressed, self._suppressed = self._suppressed, {}
+            self._summary_time = now
+        return suppressed
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name='time_logger_suppressed')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._lock:
+                delay = self._summary_time + self.summary_interval - timer()
+            time.sleep(max(delay, MIN_SUMMARY_DELAY))
+            self._write_summary()
+
+    def _write_summary(self):
+        suppressed = self.pop_suppressed()
+        if suppressed:
+            try:
+                self.on_summary(suppressed)
+            except Exception:
+                logger.exception('Failed to write suppressed logs summary')
+
+    def _get_view_bucket(self, view_func_path, now):
+        bucket = self._view_buckets.get(view_func_path)
+        if bucket is None:
+            if len(self._view_buckets) >= self.max_views:
+                view_func_path = OTHER_VIEWS_PATH
+            bucket = self._view_buckets.get(view_func_path)
+            if bucket is None:
+                bucket = self._view_buckets[view_func_path] = TokenBucket(self.view_rate, self.view_burst, now)
+        return bucket
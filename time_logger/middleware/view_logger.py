@@ -1,74 +1,375 @@
 # coding: utf-8
+import atexit
 import datetime
+import threading
 from django.conf import settings
 import inspect
+import logging
+import weakref
+
+from bson import ObjectId
 
 from time_logger import models_mongo
+from time_logger.log_writer import BackgroundLogWriter, DROP_OLDEST
+from time_logger.middleware.histograms import ViewLatencyHistograms
+from time_logger.middleware.payload import PayloadCapture, DEFAULT_REDACT_KEYS
+from time_logger.middleware.profiler import SamplingProfiler, to_folded
+from time_logger.middleware.query_capture import QueryCapture
+from time_logger.middleware.rate_limit import LogRateLimiter
+from time_logger.middleware.watchdog import InFlightWatchdog
+from time_logger.spool import SpoolWriter
+from time_logger.utils import timer
+
+logger = logging.getLogger('time_logger')
+
+
+def _round_duration(seconds):
+    # time.time of python 2 timer is not monotonic, durations can be negative after clock adjustment
+    return round(max(seconds, 0), 3)
+
+
+def _get_username(request):
+    # request.user is not set without auth middleware
+    user = getattr(request, 'user', None)
+    return user.username if user is not None else None
+
+
+class RequestTimeRecord(object):
+    """
+    Timings and view of request, request.time_logger
+    """
+    __slots__ = ('start', 'view_start', 'view_end', 'view_func', 'view_args', 'view_kwargs',
+                 'queries', 'thread_ident', 'provisional_log')
+
+    def __init__(self, start, thread_ident=None):
+        self.start = start
+        self.view_start = None
+        self.view_end = None
+        self.view_func = None
+        self.view_args = None
+        self.view_kwargs = None
+        self.queries = None
+        self.thread_ident = thread_ident
+        # ViewTimeLog saved by watchdog before request finished
+        self.provisional_log = None
+
 
 class ViewTimeLogger(object):
 
+    def __init__(self):
+        # view function: view path, views are not kept alive by cache
+        self._view_func_paths = weakref.WeakKeyDictionary()
+
+        self.spool = None
+        if getattr(settings, 'LOG_VIEW_TIME_SPOOL_DIR', None):
+            self.spool = SpoolWriter(
+                settings.LOG_VIEW_TIME_SPOOL_DIR,
+                max_file_size=getattr(settings, 'LOG_VIEW_TIME_SPOOL_MAX_SIZE', 64 * 1024 * 1024),
+                fsync_interval=getattr(settings, 'LOG_VIEW_TIME_SPOOL_FSYNC_INTERVAL', 1),
+                latency_budget=getattr(settings, 'LOG_VIEW_TIME_SPOOL_LATENCY', 1),
+                cooldown=getattr(settings, 'LOG_VIEW_TIME_SPOOL_COOLDOWN', 60),
+            )
+            # registered before writer closing, so it is called after writer flush
+            atexit.register(self.spool.close)
+
+        self.writer = None
+        if getattr(settings, 'LOG_VIEW_TIME_ASYNC', False):
+            self.writer = BackgroundLogWriter(
+                max_size=getattr(settings, 'LOG_VIEW_TIME_QUEUE_SIZE', 1000),
+                batch_size=getattr(settings, 'LOG_VIEW_TIME_BATCH_SIZE', 100),
+                flush_interval=getattr(settings, 'LOG_VIEW_TIME_FLUSH_INTERVAL', 1),
+                overflow_policy=getattr(settings, 'LOG_VIEW_TIME_QUEUE_OVERFLOW', DROP_OLDEST),
+                spool=self.spool,
+            )
+
+        self.payload = PayloadCapture(
+            max_value_size=getattr(settings, 'LOG_VIEW_TIME_MAX_VALUE_SIZE', 1024),
+            max_field_size=getattr(settings, 'LOG_VIEW_TIME_MAX_FIELD_SIZE', 16384),
+            max_body_size=getattr(settings, 'LOG_VIEW_TIME_MAX_BODY_SIZE', 0),
+            redact_keys=getattr(settings, 'LOG_VIEW_TIME_REDACT_KEYS', DEFAULT_REDACT_KEYS),
+        )
+
+        self.max_queries = None
+        if getattr(settings, 'LOG_VIEW_TIME_QUERIES', False):
+            self.max_queries = getattr(settings, 'LOG_VIEW_TIME_MAX_QUERIES', 100)
+
+        self.profiler = None
+        self.profile_max_size = None
+        if getattr(settings, 'LOG_VIEW_TIME_PROFILE', False):
+            self.profiler = SamplingProfiler(
+                interval=getattr(settings, 'LOG_VIEW_TIME_PROFILE_INTERVAL', 0.02),
+                max_stacks=getattr(settings, 'LOG_VIEW_TIME_PROFILE_MAX_STACKS', 1000),
+            )
+            self.profile_max_size = getattr(settings, 'LOG_VIEW_TIME_PROFILE_MAX_SIZE', 1024 * 1024)
+
+        self.histograms = None
+        if getattr(settings, 'LOG_VIEW_TIME_HISTOGRAMS', False):
+            self.histograms = ViewLatencyHistograms(
+                flush_interval=getattr(settings, 'LOG_VIEW_TIME_HISTOGRAMS_FLUSH_INTERVAL', 60),
+                max_views=getattr(settings, 'LOG_VIEW_TIME_HISTOGRAMS_MAX_VIEWS', 1000),
+            )
+
+        self.rate_limiter = None
+        if getattr(settings, 'LOG_VIEW_TIME_RATE', None) or getattr(settings, 'LOG_VIEW_TIME_VIEW_RATE', None):
+            self.rate_limiter = LogRateLimiter(
+                rate=getattr(settings, 'LOG_VIEW_TIME_RATE', None),
+                burst=getattr(settings, 'LOG_VIEW_TIME_BURST', None),
+                view_rate=getattr(settings, 'LOG_VIEW_TIME_VIEW_RATE', None),
+                view_burst=getattr(settings, 'LOG_VIEW_TIME_VIEW_BURST', None),
+                summary_interval=getattr(settings, 'LOG_VIEW_TIME_SUPPRESSED_INTERVAL', 60),
+                on_summary=self._save_suppressed,
+            )
+            atexit.register(self._log_suppressed, True)
+
+        self.watchdog = None
+        if getattr(settings, 'LOG_VIEW_TIME_WATCHDOG', False):
+            self.watchdog = InFlightWatchdog(
+                self._log_in_flight,
+                interval=getattr(settings, 'LOG_VIEW_TIME_WATCHDOG_INTERVAL', 10),
+            )
+
     def process_request(self, request):
-        request.time_logger = {
-            'start_dt': datetime.datetime.now(),
-            'view_func': None,
-            'view_args': None,
-            'view_kwargs': None,
-        }
+        record = request.time_logger = RequestTimeRecord(timer())
+        if self.max_queries:
+            record.queries = QueryCapture(self.max_queries)
+            record.queries.install()
+        if self.profiler or self.watchdog:
+            record.thread_ident = threading.current_thread().ident
+        if self.profiler:
+            self.profiler.start(record.thread_ident)
+        if self.watchdog:
+            self.watchdog.add(record.thread_ident, request)
         return None
 
     def process_view(self, request, view_func, view_args, view_kwargs):
-        request.time_logger['view_func'] = view_func
-        request.time_logger['view_args'] = view_args
-        request.time_logger['view_kwargs'] = view_kwargs
+        record = request.time_logger
+        record.view_start = timer()
+        record.view_func = view_func
+        record.view_args = view_args
+        record.view_kwargs = view_kwargs
+
+    def process_template_response(self, request, response):
+        # view returned, template rendering is accounted as response phase
+        self._mark_view_end(request)
+        return response
 
     def process_response(self, request, response):
+        record = getattr(request, 'time_logger', None)
+        if self.watchdog and record is not None:
+            # waits for provisional log being saved by watchdog
+            self.watchdog.remove(record.thread_ident)
         self._log_view(request)
+        if record is not None:
+            if record.queries:
+                record.queries.uninstall()
+            if self.profiler:
+                self.profiler.stop(record.thread_ident)
         return response
 
     def process_exception(self, request, exception):
-        self._log_view(request)
+        # response middleware is applied to exception response too, so view is logged in process_response
+        self._mark_view_end(request)
         return None
 
+    def _mark_view_end(self, request):
+        record = getattr(request, 'time_logger', None)
+        if record is not None and record.view_end is None:
+            record.view_end = timer()
 
-    def _log_view(self, request):
-        if not hasattr(request, 'time_logger'):
+    def _log_view(self, request, end=None, request_data=None):
+        """
+        Log request if it is slow. request_data of _get_request_data can be read before, so request is not
+        read by thread of async middleware.
+        """
+        record = getattr(request, 'time_logger', None)
+        if record is None:
             return
 
-        duration = datetime.datetime.now() - request.time_logger['start_dt']
+        if end is None:
+            end = timer()
+        duration = end - record.start
 
-        is_exceed_time = hasattr(settings, 'LOG_VIEW_TIME') \
-                         and settings.LOG_VIEW_TIME \
-                         and duration > datetime.timedelta(seconds=settings.LOG_VIEW_TIME)
-        if is_exceed_time:
-            view_func_module = inspect.getmodule(request.time_logger['view_func'])
-            if view_func_module:
-                view_func_path = '%s.%s' % (view_func_module.__name__, request.time_logger['view_func'].__name__)
-            else:
-                view_func_path = ''
+        if self.histograms:
+            self.histograms.add(self._get_view_func_path(record.view_func), duration)
+
+        log_view_time = getattr(settings, 'LOG_VIEW_TIME', None)
+        if log_view_time and duration > log_view_time:
+            view_func_path = self._get_view_func_path(record.view_func)
 
-            models_mongo.ViewTimeLog.objects.create(
-                duration=duration.seconds,
+            # provisional log is finalized regardless of rate limit
+            if self.rate_limiter and record.provisional_log is None:
+                is_allowed = self.rate_limiter.allow(view_func_path, duration)
+                self._log_suppressed()
+                if not is_allowed:
+                    return
+
+            if request_data is None:
+                request_data = self._get_request_data(request, _get_username(request))
+
+            log = models_mongo.ViewTimeLog(
+                duration=_round_duration(duration),
                 view_func_path=view_func_path,
-                view_args=request.time_logger['view_args'],
-                view_kwargs=request.time_logger['view_kwargs'],
-                username=request.user.username,
-                request_get=self._query_to_dict(request.GET),
-                request_post=self._query_to_dict(request.POST),
-                # request_body=request.body,
+                view_args=record.view_args,
+                view_kwargs=record.view_kwargs,
+                **request_data
             )
+            self._set_phases(log, record, end)
+
+            queries = record.queries
+            if queries:
+                log.queries_count = queries.count
+                log.queries_duration = _round_duration(queries.duration)
+                log.queries = queries.to_list()
+
+            if self.profiler:
+                samples = self.profiler.stop(record.thread_ident)
+                if samples:
+                    log.profile = to_folded(samples, self.profile_max_size)
+
+            provisional_log = record.provisional_log
+            if provisional_log is not None:
+                # replace provisional document by id, writer only inserts documents
+                log.id = provisional_log.id
+                log.stack = provisional_log.stack
+                self._save(log, direct=True)
+                return
+
+            self._save(log)
+
+    def _get_request_data(self, request, username):
+        """
+        Fields of log with request GET, POST and body
+        """
+        request_get, request_get_size = self.payload.query_to_dict(request.GET)
+        # POST is parsed from whole body before head of body is read
+        request_post, request_post_size = self.payload.query_to_dict(request.POST)
+        request_body, request_body_size = self.payload.get_body(request)
+        data = {
+            'username': username,
+            'request_get': request_get,
+            'request_post': request_post,
+            'request_body': request_body,
+        }
+
+        # original sizes of truncated fields
+        request_sizes = {}
+        for field_name, size in (('request_get', request_get_size), ('request_post', request_post_size),
+                                 ('request_body', request_body_size)):
+            if size is not None:
+                request_sizes[field_name] = size
+        if request_sizes:
+            data['request_sizes'] = request_sizes
+        return data
 
+    def _log_in_flight(self, request, stack):
+        """
+        Save provisional log of request running longer than LOG_VIEW_TIME, called from watchdog thread.
+        Request body, POST and user are not used, they are evaluated lazily by view thread.
+        """
+        record = request.time_logger
+        end = timer()
+        request_get, request_get_size = self.payload.query_to_dict(request.GET)
 
-    def _query_to_dict(self, qd):
-        result = {}
-        for key in qd:
-            # mongo dict field not allow '.' and '$' in key
-            if '.' in key or '$' in key:
-                continue
+        log = models_mongo.ViewTimeLog(
+            duration=_round_duration(end - record.start),
+            view_func_path=self._get_view_func_path(record.view_func),
+            view_args=record.view_args,
+            view_kwargs=record.view_kwargs,
+            request_get=request_get,
+            in_progress=True,
+            stack=stack,
+        )
+        if request_get_size is not None:
+            log.request_sizes = {'request_get': request_get_size}
+        self._set_phases(log, record, end)
 
-            values = qd.getlist(key)
-            if len(values) > 1:
-                result[key] = values
+        # final log replaces provisional one by id, it can be queued or spooled
+        log.id = ObjectId()
+        record.provisional_log = log
+        self._save(log)
+
+    def _save(self, log, direct=False):
+        """
+        Save log with background writer if it is enabled and not direct, else with spool fallback
+        """
+        if self.writer and not direct:
+            # queued documents are inserted without save()
+            if not log.dc:
+                log.dc = datetime.datetime.now()
+            self.writer.put(log)
+        elif self.spool:
+            self._save_or_spool(log)
+        else:
+            log.save()
+
+    def _save_or_spool(self, log):
+        if not log.dc:
+            log.dc = datetime.datetime.now()
+
+        if self.spool.is_active():
+            self.spool.write([log])
+            return
+
+        start = timer()
+        try:
+            log.save()
+        except Exception:
+            logger.exception('Failed to save %s, it is spooled', log.__class__.__name__)
+            self.spool.activate()
+            self.spool.write([log])
+        else:
+            self.spool.observe(timer() - start)
+
+    def _log_suppressed(self, force=False):
+        self._save_suppressed(self.rate_limiter.pop_suppressed(force), force)
+
+    def _save_suppressed(self, suppressed, force=False):
+        """
+        Save summaries of suppressed logs, called by request, summary thread of rate limiter and at exit (force)
+        """
+        for view_func_path, logs in suppressed.items():
+            log = models_mongo.SuppressedViewTimeLog(
+                view_func_path=view_func_path,
+                count=logs.count,
+                duration_min=_round_duration(logs.duration_min),
+                duration_max=_round_duration(logs.duration_max),
+                duration_sum=_round_duration(logs.duration_sum),
+                start_dc=logs.start_dc,
+                end_dc=logs.end_dc,
+                dc=datetime.datetime.now(),
+            )
+            if force:
+                # process exit, writer could be already closed
+                log.save()
             else:
-                result[key] = qd[key]
-        return result
+                self._save(log)
+
+    def _get_view_func_path(self, view_func):
+        try:
+            return self._view_func_paths[view_func]
+        except (KeyError, TypeError):
+            # TypeError of view without weak references
+            pass
+
+        view_func_module = inspect.getmodule(view_func)
+        if view_func_module:
+            view_func_path = '%s.%s' % (view_func_module.__name__, view_func.__name__)
+        else:
+            view_func_path = ''
+        try:
+            self._view_func_paths[view_func] = view_func_path
+        except TypeError:
+            pass
+        return view_func_path
+
+    def _set_phases(self, log, record, end):
+        view_start = record.view_start
+        if view_start is None:
+            # request middleware returned response, view was not called
+            log.request_duration = _round_duration(end - record.start)
+            return
 
+        view_end = record.view_end or end
+        log.request_duration = _round_duration(view_start - record.start)
+        log.view_duration = _round_duration(view_end - view_start)
+        log.response_duration = _round_duration(end - view_end)
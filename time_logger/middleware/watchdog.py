@@ -0,0 +1,96 @@
+# coding: utf-8
+import logging
+import sys
+import threading
+import time
+import traceback
+
+from django.conf import settings
+
+from time_logger.utils import timer
+
+logger = logging.getLogger('time_logger')
+
+
+class InFlightWatchdog(object):
+    """
+    Registry of in-flight requests by thread ident. Daemon thread checks it every interval seconds and calls
+    callback(request, stack) once for request running longer than LOG_VIEW_TIME, stack is formatted stack of
+    the request thread. Callback is called without registry lock, remove waits for running callback of its request.
+    """
+
+    def __init__(self, callback, interval=10, max_depth=100):
+        self.callback = callback
+        self.interval = interval
+        self.max_depth = max_depth
+
+        # thread ident: request
+        self._requests = {}
+        self._reported = set()
+        # thread idents of running callbacks
+        self._reporting = set()
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def add(self, ident, request):
+        with self._condition:
+            self._requests[ident] = request
+            self._reported.discard(ident)
+        self._ensure_started()
+
+    def remove(self, ident):
+        """
+        Unregister thread request, returns True if it was reported
+        """
+        with self._condition:
+            while ident in self._reporting:
+                self._condition.wait()
+            self._requests.pop(ident, None)
+            if ident in self._reported:
+                self._reported.discard(ident)
+                return True
+            return False
+
+    def check(self, threshold, now=None):
+        if not threshold:
+            return
+
+        if now is None:
+            now = timer()
+        frames = sys._current_frames()
+        stale = []
+        with self._condition:
+            for ident, request in self._requests.items():
+                if ident in self._reported or now - request.time_logger.start <= threshold:
+                    continue
+                self._reported.add(ident)
+                self._reporting.add(ident)
+                stale.append((ident, request))
+
+        for ident, request in stale:
+            frame = frames.get(ident)
+            stack = ''.join(traceback.format_stack(frame, self.max_depth)) if frame is not None else None
+            try:
+                self.callback(request, stack)
+            except Exception:
+                logger.exception('Failed to log in-flight request')
+            finally:
+                with self._condition:
+                    self._reporting.discard(ident)
+                    self._condition.notify_all()
+
+    def _ensure_started(self):
+        if self._thread is not None:
+            return
+
+        with self._condition:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name='time_logger_watchdog')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            self.check(getattr(settings, 'LOG_VIEW_TIME', None))
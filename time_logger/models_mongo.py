@@ -1,12 +1,38 @@
 # coding: utf-8
 from copy import deepcopy
 import datetime
+import math
 import mongoengine
 from django.conf import settings
 
+from time_logger.histogram import LogHistogram
+
+
+def get_ttl_seconds(document_name):
+    """
+    Retention of document logs from LOG_VIEW_TIME_TTL_DAYS in seconds or None.
+    Mongo compares TTL fields with UTC time, logs store naive local time (time of mysql server for imported
+    queries), so logs expire later by UTC offset east of UTC and earlier west of it.
+    """
+    days = getattr(settings, 'LOG_VIEW_TIME_TTL_DAYS', {}).get(document_name)
+    return int(days * 86400) if days else None
+
+
+def get_retention_index(document_name, field_name):
+    """
+    Index of field which logs expire by, TTL index when document has retention days
+    """
+    seconds = get_ttl_seconds(document_name)
+    if seconds is None:
+        return field_name
+    return {'fields': [field_name], 'expireAfterSeconds': seconds}
+
 
 class ViewTimeLog(mongoengine.Document):
-    duration = mongoengine.IntField(help_text='View process duration in seconds')
+    duration = mongoengine.FloatField(help_text='Request process duration in seconds')
+    request_duration = mongoengine.FloatField(help_text='Request middleware duration in seconds')
+    view_duration = mongoengine.FloatField(help_text='View process duration in seconds')
+    response_duration = mongoengine.FloatField(help_text='Template rendering and exception handling in seconds')
     view_func_path = mongoengine.StringField()
     view_args = mongoengine.ListField()
     view_kwargs = mongoengine.DictField()
@@ -14,10 +40,17 @@ class ViewTimeLog(mongoengine.Document):
     request_get = mongoengine.DictField()
     request_post = mongoengine.DictField()
     request_body = mongoengine.StringField()
+    request_sizes = mongoengine.DictField(help_text='Original sizes in bytes of truncated request fields')
+    queries_count = mongoengine.IntField(help_text='Number of database queries during request')
+    queries_duration = mongoengine.FloatField(help_text='Database queries duration in seconds')
+    queries = mongoengine.ListField(mongoengine.DictField(), help_text='Last request queries with durations')
+    profile = mongoengine.StringField(help_text='Sampled stacks in folded format ("outer;inner count" lines)')
+    in_progress = mongoengine.BooleanField(default=False, help_text='Provisional log of not finished request')
+    stack = mongoengine.StringField(help_text='Stack of request thread when it exceeded LOG_VIEW_TIME')
     dc = mongoengine.DateTimeField()
 
     meta = {
-        'indexes': ['-duration', 'dc'],
+        'indexes': ['-duration', get_retention_index('ViewTimeLog', 'dc')],
         'db_alias': getattr(settings, 'LOG_VIEW_TIME_DB_ALIAS', 'default')
     }
 
@@ -48,12 +81,62 @@ class ViewTimeLog(mongoengine.Document):
         return modify_queries
 
 
+class SuppressedViewTimeLog(mongoengine.Document):
+    view_func_path = mongoengine.StringField()
+    count = mongoengine.IntField(help_text='Number of slow requests not logged because of logs rate limit')
+    duration_min = mongoengine.FloatField()
+    duration_max = mongoengine.FloatField()
+    duration_sum = mongoengine.FloatField()
+    start_dc = mongoengine.DateTimeField(help_text='First suppressed request')
+    end_dc = mongoengine.DateTimeField(help_text='Last suppressed request')
+    dc = mongoengine.DateTimeField()
+
+    meta = {
+        'indexes': [get_retention_index('SuppressedViewTimeLog', 'dc'), 'view_func_path'],
+        'db_alias': getattr(settings, 'LOG_VIEW_TIME_DB_ALIAS', 'default')
+    }
+
+    def save(self, *args, **kwargs):
+        if not self.dc:
+            self.dc = datetime.datetime.now()
+        return super(SuppressedViewTimeLog, self).save(*args, **kwargs)
+
+
+class ViewLatencyHistogram(mongoengine.Document):
+    view_func_path = mongoengine.StringField()
+    period = mongoengine.DateTimeField(help_text='Hour start')
+    count = mongoengine.IntField(default=0)
+    duration_sum = mongoengine.FloatField(default=0, help_text='Sum of durations in seconds')
+    duration_max = mongoengine.FloatField()
+    buckets = mongoengine.DictField(help_text='Requests count by time_logger.histogram.LogHistogram bucket')
+
+    meta = {
+        'indexes': [('view_func_path', 'period'), get_retention_index('ViewLatencyHistogram', 'period')],
+        'db_alias': getattr(settings, 'LOG_VIEW_TIME_DB_ALIAS', 'default')
+    }
+
+    @classmethod
+    def add(cls, view_func_path, period, histogram):
+        update = {
+            'inc__count': histogram.count,
+            'inc__duration_sum': histogram.total,
+        }
+        if histogram.max_value is not None:
+            update['max__duration_max'] = histogram.max_value
+        for index, count in histogram.to_dict().items():
+            update['inc__buckets__%s' % index] = count
+        cls.objects(view_func_path=view_func_path, period=period).update_one(upsert=True, **update)
+
+    def get_histogram(self):
+        return LogHistogram.from_dict(self.buckets, self.duration_sum, self.duration_max)
+
+
 class MysqlSlowQueriesTimeLog(mongoengine.Document):
     start_time = mongoengine.DateTimeField()
     end_time = mongoengine.DateTimeField()
     user_host = mongoengine.StringField()
-    query_time = mongoengine.IntField()
-    lock_time = mongoengine.IntField()
+    query_time = mongoengine.FloatField(help_text='Seconds with microsecond precision')
+    lock_time = mongoengine.FloatField(help_text='Seconds with microsecond precision')
     rows_sent = mongoengine.IntField()
     rows_examined = mongoengine.IntField()
     sql_text = mongoengine.StringField()
@@ -61,12 +144,44 @@ class MysqlSlowQueriesTimeLog(mongoengine.Document):
     last_insert_id = mongoengine.IntField()
     insert_id = mongoengine.IntField()
     server_id = mongoengine.IntField()
+    fingerprint_hash = mongoengine.StringField(help_text='Hash of query fingerprint, see QueryDigest')
+    content_hash = mongoengine.StringField(help_text='sha1 of imported fields, see log_writer.BatchWriter')
+    server = mongoengine.StringField(help_text='Alias of mysql database in DATABASES, which slow_log is imported')
 
     meta = {
-        'indexes': ['query_time', 'start_time'],
+        'indexes': [
+            'query_time',
+            get_retention_index('MysqlSlowQueriesTimeLog', 'start_time'),
+            ('server', '-start_time'),
+            {'fields': ['content_hash'], 'unique': True, 'sparse': True},
+        ],
         'db_alias': getattr(settings, 'LOG_VIEW_TIME_DB_ALIAS', 'default')
     }
 
+    @staticmethod
+    def get_query_time_percentiles(queryset, percents=(50, 95, 99), max_count=None):
+        """
+        Nearest-rank percentiles of query_time of queryset, list of (percent, query_time).
+        Logs before rank are skipped from the nearer end of query_time order, skip reads them, so percentiles
+        of queryset with more than max_count logs are not computed (None is returned).
+        """
+        count = queryset.count()
+        if max_count is not None and count > max_count:
+            return None
+
+        percentiles = []
+        if not count:
+            return percentiles
+
+        for percent in percents:
+            position = max(int(math.ceil(percent / 100.0 * count)) - 1, 0)
+            if position < count // 2:
+                query_time = queryset.order_by('query_time').skip(position)
+            else:
+                query_time = queryset.order_by('-query_time').skip(count - 1 - position)
+            percentiles.append((percent, list(query_time.limit(1).scalar('query_time'))[0]))
+        return percentiles
+
 
 class MysqlBinLogTimeLog(mongoengine.Document):
     UPDATE_QUERY_TYPE = 'UPDATE'
@@ -96,9 +211,17 @@ class MysqlBinLogTimeLog(mongoengine.Document):
     error_code = mongoengine.IntField()
     query = mongoengine.StringField()
     query_type = mongoengine.StringField(choices=QUERY_TYPE_CHOICES)
+    fingerprint_hash = mongoengine.StringField(help_text='Hash of query fingerprint, see QueryDigest')
+    log_position = mongoengine.StringField(help_text='"<binlog file name>:<end_log_pos>" of event')
+    content_hash = mongoengine.StringField(help_text='sha1 of imported fields, see log_writer.BatchWriter')
 
     meta = {
-        'indexes': ['exec_time', 'query_type'],
+        'indexes': [
+            'exec_time',
+            'query_type',
+            get_retention_index('MysqlBinLogTimeLog', 'start_time'),
+            {'fields': ['content_hash'], 'unique': True, 'sparse': True},
+        ],
         'db_alias': getattr(settings, 'LOG_VIEW_TIME_DB_ALIAS', 'default')
     }
 
@@ -113,3 +236,121 @@ class ParsedLogsFiles(mongoengine.Document):
 
     def get_all_not_parsed_files(self):
         pass
+
+
+class BinLogCheckpoint(mongoengine.Document):
+    file_name = mongoengine.StringField(unique=True)
+    end_log_pos = mongoengine.LongField(default=0, help_text='Position of last imported event of binlog')
+    dc = mongoengine.DateTimeField()
+
+    meta = {
+        'db_alias': getattr(settings, 'LOG_VIEW_TIME_DB_ALIAS', 'default')
+    }
+
+    def save(self, *args, **kwargs):
+        self.dc = datetime.datetime.now()
+        return super(BinLogCheckpoint, self).save(*args, **kwargs)
+
+
+class SlowLogCheckpoint(mongoengine.Document):
+    log_path = mongoengine.StringField(unique=True)
+    inode = mongoengine.LongField()
+    offset = mongoengine.LongField(default=0, help_text='Bytes of log file which are imported')
+    tail_hash = mongoengine.StringField(help_text='sha1 of last imported bytes, detects rewritten log')
+    last_time = mongoengine.DateTimeField(help_text='Time of last imported entry, time of next entry without '
+                                                    '# Time: line')
+    dc = mongoengine.DateTimeField()
+
+    meta = {
+        'db_alias': getattr(settings, 'LOG_VIEW_TIME_DB_ALIAS', 'default')
+    }
+
+    def save(self, *args, **kwargs):
+        self.dc = datetime.datetime.now()
+        return super(SlowLogCheckpoint, self).save(*args, **kwargs)
+
+
+class QueryDigest(mongoengine.Document):
+    SLOW_LOG_SOURCE = 'slow_log'
+    BIN_LOG_SOURCE = 'bin_log'
+    SOURCE_CHOICES = (
+        (SLOW_LOG_SOURCE, SLOW_LOG_SOURCE),
+        (BIN_LOG_SOURCE, BIN_LOG_SOURCE),
+    )
+
+    source = mongoengine.StringField(choices=SOURCE_CHOICES)
+    fingerprint_hash = mongoengine.StringField()
+    fingerprint = mongoengine.StringField(help_text='Query with literals replaced by "?"')
+    example = mongoengine.StringField(help_text='Last imported query of fingerprint')
+    count = mongoengine.IntField()
+    query_time_sum = mongoengine.FloatField()
+    query_time_max = mongoengine.FloatField()
+    lock_time_sum = mongoengine.FloatField()
+    rows_examined_sum = mongoengine.LongField()
+    first_seen = mongoengine.DateTimeField()
+    last_seen = mongoengine.DateTimeField()
+
+    meta = {
+        'indexes': [
+            {'fields': ['source', 'fingerprint_hash'], 'unique': True},
+            '-query_time_sum',
+        ],
+        'db_alias': getattr(settings, 'LOG_VIEW_TIME_DB_ALIAS', 'default')
+    }
+
+    @classmethod
+    def add(cls, source, fingerprint_hash, stats):
+        """
+        Add time_logger.query_digest.QueryDigestStats to digest of fingerprint
+        """
+        update = {
+            '$set': {'fingerprint': stats.fingerprint, 'example': stats.example},
+            '$inc': {
+                'count': stats.count,
+                'query_time_sum': stats.query_time_sum,
+                'lock_time_sum': stats.lock_time_sum,
+                'rows_examined_sum': stats.rows_examined_sum,
+            },
+            '$max': {'query_time_max': stats.query_time_max},
+        }
+        if stats.first_seen is not None:
+            update['$min'] = {'first_seen': stats.first_seen}
+            update['$max']['last_seen'] = stats.last_seen
+        cls.objects(source=source, fingerprint_hash=fingerprint_hash).update_one(upsert=True, __raw__=update)
+
+    def get_query_time_avg(self):
+        return self.query_time_sum / self.count if self.count else None
+
+
+class QueryLatencyHistogram(mongoengine.Document):
+    """
+    Hourly rollup of imported queries: slow queries by fingerprint hash, binlog queries by "<query type> <table>"
+    """
+    source = mongoengine.StringField(choices=QueryDigest.SOURCE_CHOICES)
+    key = mongoengine.StringField()
+    period = mongoengine.DateTimeField(help_text='Hour start')
+    count = mongoengine.IntField(default=0)
+    duration_sum = mongoengine.FloatField(default=0, help_text='Sum of query times in seconds')
+    duration_max = mongoengine.FloatField()
+    buckets = mongoengine.DictField(help_text='Queries count by time_logger.histogram.LogHistogram bucket')
+
+    meta = {
+        'indexes': [('source', 'key', 'period'), ('source', 'period'),
+                    get_retention_index('QueryLatencyHistogram', 'period')],
+        'db_alias': getattr(settings, 'LOG_VIEW_TIME_DB_ALIAS', 'default')
+    }
+
+    @classmethod
+    def add(cls, source, key, period, histogram):
+        update = {
+            'inc__count': histogram.count,
+            'inc__duration_sum': histogram.total,
+        }
+        if histogram.max_value is not None:
+            update['max__duration_max'] = histogram.max_value
+        for index, count in histogram.to_dict().items():
+            update['inc__buckets__%s' % index] = count
+        cls.objects(source=source, key=key, period=period).update_one(upsert=True, **update)
+
+    def get_histogram(self):
+        return LogHistogram.from_dict(self.buckets, self.duration_sum, self.duration_max)
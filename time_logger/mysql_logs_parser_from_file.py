@@ -1,4 +1,6 @@
 # coding: utf-8
+import mmap
+import multiprocessing
 import re
 import datetime
 import decimal
@@ -18,6 +20,7 @@ _SLOW_USERHOST = re.compile(r"#\s+User@Host:\s+"
                             r"@\s*"
                             r"([\w\d]*)\s*"
                             r"\[\s*([\d.]*)\s*\]")
+_SLOW_SET_TIMESTAMP = re.compile(r"SET timestamp=(\d+);", re.IGNORECASE)
 _SLOW_STATS = re.compile(r"#\sQuery_time:\s(\d*\.\d{1,6})\s*"
                          r"Lock_time:\s(\d*\.\d{1,6})\s*"
                          r"Rows_sent:\s(\d*)\s*"
@@ -35,11 +38,29 @@ _BIN_LOG_QUERY_STATS = re.compile(r"#(" + _DATE_PAT + ")\s+"
 _BIN_LOG_DB = re.compile(r"use `(.+)`")
 _BING_LOG_TIMESTAMP = re.compile(r"SET TIMESTAMP=(\d+)")
 
+# bytes of slow log parsed by one task of parse_slow_log_parallel
+SLOW_LOG_RANGE_SIZE = 8 * 1024 * 1024
+
 
 class LogParserError(Exception):
     pass
 
 
+class LineIteratorStream(object):
+    """
+    Stream interface for iterator of lines
+    """
+
+    def __init__(self, lines):
+        self._lines = iter(lines)
+
+    def readline(self):
+        return next(self._lines, '')
+
+    def close(self):
+        pass
+
+
 class BaseLogParser(object):
     def __iter__(self):
         return self
@@ -50,6 +71,17 @@ class BaseLogParser(object):
             raise StopIteration
         return entry
 
+    @staticmethod
+    def _open_stream(log):
+        """
+        log is path of file, stream with readline (e.g. stdout of subprocess) or iterator of lines
+        """
+        if hasattr(log, 'readline'):
+            return log
+        if isinstance(log, (bytes, type(u''))):
+            return open(log, 'r')
+        return LineIteratorStream(log)
+
     def _get_next_line(self):
         line = self._stream.readline()
         if not line:
@@ -75,8 +107,8 @@ class BaseLogParser(object):
 
 
 class MysqlBinLogParser(BaseLogParser):
-    def __init__(self, log_path):
-        self._stream = open(log_path, 'r')
+    def __init__(self, log):
+        self._stream = self._open_stream(log)
 
         # line which contains query info about new expression
         self._cached_line = None
@@ -118,7 +150,7 @@ class MysqlBinLogParser(BaseLogParser):
             self._parse_line(_BIN_LOG_QUERY_STATS, line)
         # mysql bug http://bugs.mysql.com/bug.php?id=52704
         exec_time = 0 if float(exec_time) > 1000 else exec_time
-        start_time = datetime.datetime.strptime(start_time, "%y%m%d %H:%M:%S")
+        start_time = self._parse_start_time(start_time)
 
         # str: db
         line = self._get_next_line()
@@ -135,14 +167,8 @@ class MysqlBinLogParser(BaseLogParser):
         query_type = line.split(' ')[0]
         query = line
 
-        # skip line to another Query command
-        while not 'Query' in line:
-            line = self._get_next_line()
-            # catch end of log
-            if line == BIN_LOG_END:
-                break
         # cached new query info line
-        self._cached_line = line
+        self._cached_line = self._skip_to_query(line)
 
         return {
             'start_time': start_time,
@@ -162,11 +188,31 @@ class MysqlBinLogParser(BaseLogParser):
         info = self._parse_line(_BING_LOG_TIMESTAMP, line)
         return datetime.datetime.fromtimestamp(float(info[0]))
 
+    @staticmethod
+    def _parse_start_time(start_time):
+        return datetime.datetime.strptime(start_time, "%y%m%d %H:%M:%S")
+
+    def _skip_to_query(self, line):
+        # skip line to another Query command
+        while not 'Query' in line:
+            line = self._get_next_line()
+            # catch end of log
+            if line == BIN_LOG_END:
+                break
+        return line
+
 
 class MysqlSlowQueriesParser(BaseLogParser):
-    def __init__(self, log_path):
-        self._stream = open(log_path, 'r')
+    """
+    Entries are split by '# Time:' lines. Mysql writes the line only when second of entry changes,
+    so entry without it gets time of previous entry (last_time of previous read of log)
+    or time of 'SET timestamp=' query.
+    """
+
+    def __init__(self, log, last_time=None):
+        self._stream = self._open_stream(log)
         self._cached_line = None
+        self.last_time = last_time
 
         line = self._get_next_line()
         if line is not None and line.endswith('started with:'):
@@ -195,6 +241,7 @@ class MysqlSlowQueriesParser(BaseLogParser):
         if line.startswith('# Time:'):
                 timestamp = self._parse_time(line)
                 entry['start_time'] = timestamp
+                self.last_time = timestamp
                 line = self._get_next_line()
 
         if line.startswith('# User@Host:'):
@@ -214,6 +261,9 @@ class MysqlSlowQueriesParser(BaseLogParser):
         queries = self._parse_queries(line)
         entry['queries_list'] = queries
 
+        if 'start_time' not in entry:
+            entry['start_time'] = self.last_time or self._parse_set_timestamp(queries)
+
         return entry
 
     def _parse_time(self, line):
@@ -230,6 +280,14 @@ class MysqlSlowQueriesParser(BaseLogParser):
     def _parse_statistics(self, line):
         return self._parse_line(_SLOW_STATS, line)
 
+    @staticmethod
+    def _parse_set_timestamp(queries):
+        for query in queries:
+            match = _SLOW_SET_TIMESTAMP.match(query)
+            if match:
+                return datetime.datetime.fromtimestamp(int(match.group(1)))
+        return None
+
     def _parse_queries(self, line):
         query_string = []
         while line:
@@ -240,6 +298,295 @@ class MysqlSlowQueriesParser(BaseLogParser):
             self._cached_line = line
         return query_string
 
+
+class MmapLogParserMixin(object):
+    """
+    Reads log file as memory mapped bytes. Lines are decoded only when they are returned by _get_next_line,
+    so parsers can skip not needed parts of log with bytes search.
+    """
+
+    def _open(self, log_path, start=0, end=None):
+        # path or opened binary file
+        self._stream = open(log_path, 'rb') if not hasattr(log_path, 'fileno') else log_path
+        try:
+            self._data = mmap.mmap(self._stream.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # empty file can not be mapped
+            self._data = b''
+        # parsed byte range of file
+        self._pos = start
+        self._end = len(self._data) if end is None else min(end, len(self._data))
+
+    def _read_line(self):
+        """
+        Next raw line without line end or None at the end of file
+        """
+        data = self._data
+        pos = self._pos
+        if pos >= self._end:
+            return None
+
+        end = data.find(b'\n', pos, self._end)
+        if end == -1:
+            end = self._end
+        self._pos = end + 1
+        return data[pos:end]
+
+    def _get_next_line(self):
+        line = self._read_line()
+        if line is None:
+            return None
+
+        delimiter = getattr(self, 'delimiter', '')
+
+        return _decode(line).rstrip('%s\r\n' % delimiter)
+
+
+class MmapMysqlBinLogParser(MmapLogParserMixin, MysqlBinLogParser):
+    """
+    MysqlBinLogParser, which finds next Query line with bytes search, lines of other events are not decoded
+    """
+
+    def __init__(self, log_path):
+        self._open(log_path)
+        self._cached_line = None
+        # last parsed time strings and datetimes, many events share the same second
+        self._start_time = (None, None)
+        self._timestamp = (None, None)
+
+        line = self._get_next_line()
+        if line is not None:
+            self._parse_headers(line)
+
+    def _parse_start_time(self, start_time):
+        if start_time != self._start_time[0]:
+            self._start_time = (start_time, MysqlBinLogParser._parse_start_time(start_time))
+        return self._start_time[1]
+
+    def _parse_timestamp(self, line):
+        if line != self._timestamp[0]:
+            self._timestamp = (line, super(MmapMysqlBinLogParser, self)._parse_timestamp(line))
+        return self._timestamp[1]
+
+    def _skip_to_query(self, line):
+        if 'Query' in line:
+            return line
+
+        data = self._data
+        query_pos = data.find(b'Query', self._pos, self._end)
+        if query_pos == -1:
+            query_pos = self._end
+
+        # end of log line before next Query line
+        end_pos = data.find(_BIN_LOG_END_BYTES, self._pos, query_pos)
+        while end_pos != -1:
+            if end_pos == self._pos or data[end_pos - 1:end_pos] == b'\n':
+                self._pos = end_pos
+                line = self._get_next_line()
+                if line == BIN_LOG_END or 'Query' in line:
+                    return line
+                end_pos = self._pos
+            else:
+                end_pos += 1
+            end_pos = data.find(_BIN_LOG_END_BYTES, end_pos, query_pos)
+
+        if query_pos == self._end:
+            self._pos = query_pos
+            return None
+
+        line_start = data.rfind(b'\n', self._pos, query_pos)
+        self._pos = self._pos if line_start == -1 else line_start + 1
+        return self._get_next_line()
+
+
+class MmapMysqlSlowQueriesParser(MmapLogParserMixin, MysqlSlowQueriesParser):
+    """
+    MysqlSlowQueriesParser, which splits log into entries by '# Time:' lines with bytes search.
+    Every entry is decoded and split into lines at once, query lines are taken by slice.
+    Parser of byte range (start > 0) expects range to begin with entry, see split_slow_log.
+    """
+    # entries are cut into chunks of this size on line boundaries
+    max_chunk_size = 16 * 1024 * 1024
+
+    def __init__(self, log_path, start=0, end=None, last_time=None):
+        self._open(log_path, start, end)
+        self._cached_line = None
+        self.last_time = last_time
+        # end of range is reached, parsing is not stopped by blank line
+        self.is_finished = False
+        # decoded lines of current chunk
+        self._lines = []
+        self._line_index = 0
+        # last parsed '# Time:' line and its datetime, many entries share the same second
+        self._time = (None, None)
+
+        if start == 0:
+            line = self._get_next_line()
+            if line is not None and line.endswith('started with:'):
+                self._parse_headers(line)
+
+    def _get_next_line(self):
+        if self._line_index >= len(self._lines) and not self._read_chunk():
+            self.is_finished = True
+            return None
+        line = self._lines[self._line_index]
+        self._line_index += 1
+        return line
+
+    def _read_chunk(self):
+        data = self._data
+        pos = self._pos
+        if pos >= self._end:
+            return False
+
+        chunk_end = min(pos + self.max_chunk_size, self._end)
+        end = data.find(_SLOW_TIME_BYTES, pos, chunk_end)
+        if end == -1:
+            end = self._end
+            if end > chunk_end:
+                end = data.rfind(b'\n', pos, chunk_end)
+                if end == -1:
+                    # line is longer than chunk
+                    end = data.find(b'\n', pos, self._end)
+                    if end == -1:
+                        end = self._end
+        chunk = data[pos:end]
+        self._pos = end + 1
+
+        lines = _decode(chunk).split('\n')
+        if end >= self._end and chunk.endswith(b'\n'):
+            lines.pop()
+        if b'\r' in chunk:
+            lines = [line.rstrip('\r') for line in lines]
+        self._lines = lines
+        self._line_index = 0
+        return True
+
+    def _parse_time(self, line):
+        if line != self._time[0]:
+            self._time = (line, super(MmapMysqlSlowQueriesParser, self)._parse_time(line))
+        return self._time[1]
+
+    def _parse_queries(self, line):
+        query_string = []
+        while line and not line.startswith('# Time:'):
+            query_string.append(line)
+            # chunks end before '# Time:' lines, so queries are lines of chunk up to blank line
+            lines = self._lines
+            start = self._line_index
+            try:
+                end = lines.index('', start)
+            except ValueError:
+                end = len(lines)
+            query_string.extend(lines[start:end])
+            self._line_index = end
+
+            line = self._get_next_line()
+            self._cached_line = line
+        return query_string
+
+
+def split_slow_log(log_path, range_size, start=0, end=None):
+    """
+    Returns byte ranges of slow log (from start to end) about range_size bytes, which are parsed independently
+    with the same entries as whole log, and whether log has blank lines.
+    Range begins with '# Time:' line after query line, so entry of previous range ends before it.
+    """
+    with open(log_path, 'rb') as log_file:
+        try:
+            data = mmap.mmap(log_file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # empty file
+            return [(0, 0)], False
+
+        try:
+            if end is None:
+                end = len(data)
+
+            # blank line stops parser
+            has_blank_lines = data[start:start + 1] in (b'\n', b'\r') or \
+                data.find(b'\n\n', start, end) != -1 or data.find(b'\n\r', start, end) != -1
+
+            pos = start
+            if start == 0:
+                # header lines are parsed by first range
+                pos = -1
+                for _ in range(3):
+                    pos = data.find(b'\n', pos + 1, end)
+                    if pos == -1:
+                        return [(0, end)], has_blank_lines
+
+            ranges = []
+            while True:
+                boundary = _find_slow_entry_start(data, max(pos, start + range_size), end)
+                if boundary == -1:
+                    break
+                ranges.append((start, boundary))
+                start = pos = boundary
+            ranges.append((start, end))
+            return ranges, has_blank_lines
+        finally:
+            data.close()
+
+
+def _find_slow_entry_start(data, pos, end):
+    while True:
+        # position of line end before '# Time:'
+        pos = data.find(_SLOW_TIME_BYTES, pos, end)
+        if pos == -1:
+            return -1
+
+        previous_line = data[data.rfind(b'\n', 0, pos) + 1:pos].rstrip(b'\r')
+        if previous_line and not previous_line.startswith(_SLOW_HEADER_PREFIXES):
+            return pos + 1
+        pos += 1
+
+
+def parse_slow_log_parallel(log_path, workers, ordered=True, range_size=SLOW_LOG_RANGE_SIZE, start=0, end=None,
+                            last_time=None):
+    """
+    Iterate entries of slow log (from start to end) parsed by pool of processes in byte ranges, entries are
+    the same as of MmapMysqlSlowQueriesParser. Blank line stops parser, so ranges after range stopped by blank line
+    are ignored, and log with blank lines is parsed ordered.
+    """
+    ranges, has_blank_lines = split_slow_log(log_path, range_size, start, end)
+    pool = multiprocessing.Pool(workers)
+    try:
+        # only first range can begin without '# Time:' line
+        tasks = [(log_path, range_start, range_end, last_time if i == 0 else None)
+                 for i, (range_start, range_end) in enumerate(ranges)]
+        if ordered or has_blank_lines:
+            results = pool.imap(_parse_slow_log_range, tasks)
+        else:
+            results = pool.imap_unordered(_parse_slow_log_range, tasks)
+
+        for entries, is_finished in results:
+            for entry in entries:
+                yield entry
+            if not is_finished:
+                break
+    finally:
+        pool.terminate()
+
+
+def _parse_slow_log_range(task):
+    log_path, start, end, last_time = task
+    parser = MmapMysqlSlowQueriesParser(log_path, start, end, last_time)
+    entries = list(parser)
+    return entries, parser.is_finished
+
+
+def _decode(line):
+    if str is bytes:
+        # python 2 parsers return str
+        return line
+    return line.decode('utf-8', 'replace')
+
+
+_BIN_LOG_END_BYTES = BIN_LOG_END.encode('ascii')
+_SLOW_TIME_BYTES = b'\n# Time:'
+_SLOW_HEADER_PREFIXES = (b'# Time:', b'# User@Host:', b'# Query_time:')
+
 # usage example
 # if __name__ == '__main__':
 #     cnt = 0
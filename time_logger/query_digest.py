@@ -0,0 +1,150 @@
+# coding: utf-8
+import hashlib
+import re
+
+from time_logger import models_mongo
+from time_logger.histogram import LogHistogram, get_period
+
+# strings and comments in one pass, so quotes in comments and comment marks in strings are skipped
+_STRINGS_AND_COMMENTS = re.compile(
+    r"""('(?:[^'\\]|\\.|'')*'|"(?:[^"\\]|\\.|"")*")|(/\*.*?\*/|--\s[^\n]*|#[^\n]*)""",
+    re.DOTALL,
+)
+_NUMBERS = re.compile(r"\b(?:0x[0-9a-f]+|\d+(?:\.\d+)?(?:e[+-]?\d+)?)\b")
+_WHITESPACE = re.compile(r"\s+")
+# statements of slow log entry before query
+_SESSION_STATEMENTS = re.compile(r"^(?:\s*(?:use\s+\S+?|set\s+timestamp\s*=\s*\S+?)\s*;)+\s*")
+_IN_LIST = re.compile(r"\bin\s*\(\s*\?(?:\s*,\s*\?)*\s*\)")
+_VALUES_LIST = re.compile(r"\bvalues\s*\([^()]*\)(?:\s*,\s*\([^()]*\))*")
+_MODIFIED_TABLE = re.compile(
+    r"^\s*(?:insert(?:\s+ignore)?\s+into|replace\s+into|update(?:\s+ignore)?|delete\s+from)\s+([`\w.$]+)",
+    re.IGNORECASE,
+)
+
+
+def _replace_string_or_comment(match):
+    return '?' if match.group(1) is not None else ' '
+
+
+def fingerprint(sql):
+    """
+    Query shape: literals are replaced by '?', IN and VALUES lists are collapsed, comments, whitespace and case
+    are normalized. Leading 'use db;' and 'SET timestamp=N;' statements of slow log are removed.
+    """
+    sql = _STRINGS_AND_COMMENTS.sub(_replace_string_or_comment, sql).lower()
+    sql = _WHITESPACE.sub(' ', sql)
+    sql = _SESSION_STATEMENTS.sub('', sql)
+    sql = _NUMBERS.sub('?', sql)
+    sql = _IN_LIST.sub('in(?+)', sql)
+    sql = _VALUES_LIST.sub('values(?+)', sql)
+    return sql.strip().rstrip(';').rstrip()
+
+
+def get_statement_fingerprint(sql_text):
+    """
+    Fingerprint of sql_text of MysqlSlowQueriesTimeLog, lines of slow log entry are joined by ' ;' in it
+    """
+    return fingerprint(sql_text.replace(' ;', ' '))
+
+
+def get_fingerprint_hash(fingerprint):
+    if not isinstance(fingerprint, bytes):
+        fingerprint = fingerprint.encode('utf-8')
+    return hashlib.md5(fingerprint).hexdigest()[:16]
+
+
+def get_table(sql):
+    """
+    Table modified by INSERT, REPLACE, UPDATE or DELETE query without quotes, None for other queries
+    """
+    match = _MODIFIED_TABLE.match(sql)
+    return match.group(1).replace('`', '') if match else None
+
+
+class QueryDigestStats(object):
+    __slots__ = ('fingerprint', 'example', 'count', 'query_time_sum', 'query_time_max', 'lock_time_sum',
+                 'rows_examined_sum', 'first_seen', 'last_seen')
+
+    def __init__(self, fingerprint):
+        self.fingerprint = fingerprint
+        self.example = None
+        self.count = 0
+        self.query_time_sum = 0.0
+        self.query_time_max = 0.0
+        self.lock_time_sum = 0.0
+        self.rows_examined_sum = 0
+        self.first_seen = None
+        self.last_seen = None
+
+    def add(self, sql, query_time, lock_time, rows_examined, seen):
+        self.example = sql
+        self.count += 1
+        self.query_time_sum += query_time
+        self.query_time_max = max(self.query_time_max, query_time)
+        self.lock_time_sum += lock_time
+        self.rows_examined_sum += rows_examined
+        if seen is not None:
+            if self.first_seen is None or seen < self.first_seen:
+                self.first_seen = seen
+            if self.last_seen is None or seen > self.last_seen:
+                self.last_seen = seen
+
+
+class QueryDigestCollector(object):
+    """
+    Aggregates imported queries by fingerprint, flush adds aggregates to QueryDigest collection
+    with one upsert per fingerprint. Query times are added to hourly histograms of histograms collector.
+    """
+
+    def __init__(self, source):
+        self.source = source
+        self.histograms = QueryHistogramCollector(source)
+        # fingerprint hash: QueryDigestStats
+        self._stats = {}
+
+    def add(self, sql, query_time, lock_time=0, rows_examined=0, seen=None, histogram_key=None,
+            query_fingerprint=None):
+        """
+        Returns fingerprint hash of query (of query_fingerprint, fingerprint of sql by default). Query time
+        is added to histogram of histogram_key (fingerprint hash by default) in hour of seen.
+        """
+        if query_fingerprint is None:
+            query_fingerprint = fingerprint(sql)
+        fingerprint_hash = get_fingerprint_hash(query_fingerprint)
+        stats = self._stats.get(fingerprint_hash)
+        if stats is None:
+            stats = self._stats[fingerprint_hash] = QueryDigestStats(query_fingerprint)
+        stats.add(sql, query_time or 0, lock_time or 0, rows_examined or 0, seen)
+        if seen is not None:
+            self.histograms.add(histogram_key or fingerprint_hash, seen, query_time or 0)
+        return fingerprint_hash
+
+    def flush(self):
+        stats_by_hash, self._stats = self._stats, {}
+        for fingerprint_hash, stats in stats_by_hash.items():
+            models_mongo.QueryDigest.add(self.source, fingerprint_hash, stats)
+        self.histograms.flush()
+
+
+class QueryHistogramCollector(object):
+    """
+    Aggregates query times by key and hour, flush adds them to QueryLatencyHistogram collection
+    with one upsert per key and hour.
+    """
+
+    def __init__(self, source):
+        self.source = source
+        # (key, period): LogHistogram
+        self._histograms = {}
+
+    def add(self, key, seen, query_time):
+        period = get_period(seen)
+        histogram = self._histograms.get((key, period))
+        if histogram is None:
+            histogram = self._histograms[(key, period)] = LogHistogram()
+        histogram.add(query_time)
+
+    def flush(self):
+        histograms, self._histograms = self._histograms, {}
+        for (key, period), histogram in histograms.items():
+            models_mongo.QueryLatencyHistogram.add(self.source, key, period, histogram)
@@ -0,0 +1,98 @@
+# coding: utf-8
+import time
+
+from time_logger import models_mongo
+from time_logger.models_mongo import get_ttl_seconds
+
+# document: field which logs expire by
+RETENTION_FIELDS = (
+    (models_mongo.ViewTimeLog, 'dc'),
+    (models_mongo.SuppressedViewTimeLog, 'dc'),
+    (models_mongo.ViewLatencyHistogram, 'period'),
+    (models_mongo.MysqlSlowQueriesTimeLog, 'start_time'),
+    (models_mongo.MysqlBinLogTimeLog, 'start_time'),
+    (models_mongo.QueryLatencyHistogram, 'period'),
+)
+
+# document: field which logs are removed by remove_old_logs --expire_day
+EXPIRE_FIELDS = (
+    (models_mongo.MysqlBinLogTimeLog, 'start_time'),
+    (models_mongo.MysqlSlowQueriesTimeLog, 'start_time'),
+    (models_mongo.ViewTimeLog, 'dc'),
+    (models_mongo.SuppressedViewTimeLog, 'dc'),
+    (models_mongo.ViewLatencyHistogram, 'period'),
+    (models_mongo.QueryLatencyHistogram, 'period'),
+)
+
+UNCHANGED = 'unchanged'
+CREATED = 'created'
+UPDATED = 'updated'
+REMOVED = 'removed'
+
+
+def apply_ttl_indexes():
+    """
+    Make indexes of RETENTION_FIELDS the same as in documents meta: TTL indexes with LOG_VIEW_TIME_TTL_DAYS
+    or ordinary indexes for documents without retention days. Mongo removes expired logs of TTL index
+    by background task. Returns list of (document name, field name, action).
+    """
+    results = []
+    for document_cls, field_name in RETENTION_FIELDS:
+        action = apply_ttl_index(_get_raw_collection(document_cls), field_name,
+                                 get_ttl_seconds(document_cls.__name__))
+        results.append((document_cls.__name__, field_name, action))
+    return results
+
+
+def apply_ttl_index(collection, field_name, seconds):
+    index_name = '%s_1' % field_name
+    index = collection.index_information().get(index_name)
+    current_seconds = index.get('expireAfterSeconds') if index else None
+
+    if index and current_seconds == seconds:
+        return UNCHANGED
+
+    if current_seconds is not None and seconds is not None:
+        # TTL is changed without rebuilding index
+        collection.database.command('collMod', collection.name,
+                                    index={'keyPattern': {field_name: 1}, 'expireAfterSeconds': seconds})
+        return UPDATED
+
+    if index:
+        collection.drop_index(index_name)
+    if seconds is None:
+        collection.create_index([(field_name, 1)], background=True)
+        return REMOVED if index else CREATED
+    collection.create_index([(field_name, 1)], expireAfterSeconds=seconds, background=True)
+    return UPDATED if index else CREATED
+
+
+def get_expired(document_cls, field_name, expire_date):
+    return document_cls.objects(**{'%s__lt' % field_name: expire_date})
+
+
+def iter_delete_expired(document_cls, field_name, expire_date, chunk_size=1000, sleep=0):
+    """
+    Delete logs with field older than expire_date by chunks of _id range, number of deleted logs is yielded
+    after each chunk. Chunk deletes are short and paused for sleep seconds, so they do not hold resources
+    for concurrent inserts and replication.
+    """
+    expired = get_expired(document_cls, field_name, expire_date)
+    last_id = None
+    while True:
+        chunk = expired.order_by('id')
+        if last_id is not None:
+            chunk = chunk.filter(id__gt=last_id)
+        ids = list(chunk.limit(chunk_size).scalar('id'))
+        if not ids:
+            break
+
+        last_id = ids[-1]
+        yield expired.filter(id__gte=ids[0], id__lte=last_id).delete() or 0
+        if sleep:
+            time.sleep(sleep)
+
+
+def _get_raw_collection(document_cls):
+    # _get_collection creates indexes of meta, they conflict with indexes which are not applied yet
+    return document_cls._get_db()[document_cls._get_collection_name()]
@@ -0,0 +1,157 @@
+# coding: utf-8
+import glob
+import logging
+import os
+import struct
+import threading
+import time
+
+import bson
+from bson.objectid import ObjectId
+
+from time_logger.utils import timer
+
+logger = logging.getLogger('time_logger')
+
+SPOOL_EXTENSION = '.spool'
+# file is being written by process
+ACTIVE_EXTENSION = '.active'
+
+_LENGTH = struct.Struct('<i')
+
+
+def _encode(record):
+    encode = getattr(bson, 'encode', None) or bson.BSON.encode
+    return encode(record)
+
+
+def _decode(data):
+    decode = getattr(bson, 'decode', None)
+    if decode is not None:
+        return decode(data)
+    return bson.BSON(data).decode()
+
+
+def read_spool_file(path):
+    """
+    Iterate (model name, raw document) of spool file. Truncated record at the end of file is skipped.
+    """
+    with open(path, 'rb') as spool_file:
+        while True:
+            header = spool_file.read(_LENGTH.size)
+            if len(header) < _LENGTH.size:
+                return
+            length = _LENGTH.unpack(header)[0]
+            body = spool_file.read(length - _LENGTH.size)
+            if len(body) < length - _LENGTH.size:
+                logger.warning('Truncated record at the end of %s', path)
+                return
+            record = _decode(header + body)
+            yield record['model'], record['document']
+
+
+def get_spool_files(spool_dir, include_active=False):
+    paths = glob.glob(os.path.join(spool_dir, '*' + SPOOL_EXTENSION))
+    if include_active:
+        paths += glob.glob(os.path.join(spool_dir, '*' + SPOOL_EXTENSION + ACTIVE_EXTENSION))
+    return sorted(paths)
+
+
+class SpoolWriter(object):
+    """
+    Local fallback storage of log documents when mongo is slow or unreachable.
+    Records are BSON documents ({'model': name, 'document': raw document}), which are length-prefixed,
+    appended to <spool_dir>/<pid>-<time>.spool.active. File is renamed to .spool when it exceeds max_file_size
+    or writer is closed; replay_spooled_logs command imports .spool files.
+
+    Writer also works as circuit breaker: after failed or slower than latency_budget write to mongo,
+    documents go directly to spool during cooldown seconds.
+    """
+
+    def __init__(self, spool_dir, max_file_size=64 * 1024 * 1024, fsync_interval=1.0, latency_budget=1.0,
+                 cooldown=60):
+        self.spool_dir = spool_dir
+        self.max_file_size = max_file_size
+        self.fsync_interval = fsync_interval
+        self.latency_budget = latency_budget
+        self.cooldown = cooldown
+
+        self.spooled = 0
+
+        self._file = None
+        self._path = None
+        self._size = 0
+        self._fsync_time = 0
+        self._file_number = 0
+        self._active_until = 0
+        self._lock = threading.Lock()
+
+    def is_active(self):
+        return timer() < self._active_until
+
+    def activate(self):
+        self._active_until = timer() + self.cooldown
+
+    def observe(self, duration):
+        """
+        Check duration of mongo write against latency budget
+        """
+        if duration > self.latency_budget:
+            logger.warning('Mongo write took %.3f s, logs are spooled for %s s', duration, self.cooldown)
+            self.activate()
+
+    def write(self, documents):
+        """
+        Append mongoengine documents to spool
+        """
+        records = []
+        for document in documents:
+            raw = document.to_mongo()
+            if '_id' not in raw:
+                # replay is idempotent by _id
+                raw['_id'] = ObjectId()
+            records.append(_encode({'model': document.__class__.__name__, 'document': raw}))
+
+        with self._lock:
+            if self._file is None:
+                self._open()
+            for record in records:
+                self._file.write(record)
+                self._size += len(record)
+            self.spooled += len(records)
+
+            now = timer()
+            if now - self._fsync_time >= self.fsync_interval:
+                self._sync()
+                self._fsync_time = now
+
+            if self._size >= self.max_file_size:
+                self._rotate()
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._rotate()
+
+    def _open(self):
+        if not os.path.exists(self.spool_dir):
+            os.makedirs(self.spool_dir)
+        # number keeps names unique when files are rotated within a millisecond
+        self._file_number += 1
+        name = '%d-%d-%d-%06d%s' % (
+            int(time.time() * 1000), os.getpid(), id(self), self._file_number, SPOOL_EXTENSION
+        )
+        self._path = os.path.join(self.spool_dir, name)
+        self._file = open(self._path + ACTIVE_EXTENSION, 'ab')
+        self._size = 0
+
+    def _sync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def _rotate(self):
+        self._sync()
+        self._file.close()
+        os.rename(self._path + ACTIVE_EXTENSION, self._path)
+        self._file = None
+        self._path = None
@@ -1,16 +1,48 @@
 import mock
 from mock import sentinel
+import collections
 import datetime
+import gc
+import logging
+import os
+import shutil
+import signal
+import sys
+import tempfile
+import threading
 from django.conf import settings
 from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.db import connections, DEFAULT_DB_ALIAS
 from djutils.testrunner import TearDownTestCaseMixin
 from django.test import TestCase
 from django.test.client import RequestFactory
+from django.utils.six import StringIO
 from mysql_logs_parser_from_file import BaseLogParser, LogParserError, MysqlBinLogParser, BIN_LOG_END, _BIN_LOG_DB, \
-    _BIN_LOG_QUERY_STATS, _BING_LOG_TIMESTAMP, MysqlSlowQueriesParser, _SLOW_TIMESTAMP, _SLOW_USERHOST, _SLOW_STATS
+    _BIN_LOG_QUERY_STATS, _BING_LOG_TIMESTAMP, MysqlSlowQueriesParser, _SLOW_TIMESTAMP, _SLOW_USERHOST, _SLOW_STATS, \
+    MmapMysqlBinLogParser, MmapMysqlSlowQueriesParser, split_slow_log, parse_slow_log_parallel
 import models_mongo
-from middleware.view_logger import ViewTimeLogger as ViewTimeLoggerMiddleware
+import log_writer
+from log_writer import insert_many
+import spool
+from middleware.view_logger import ViewTimeLogger as ViewTimeLoggerMiddleware, RequestTimeRecord, timer
+from middleware.query_capture import QueryCapture, CaptureCursorWrapper
+from middleware.profiler import SamplingProfiler, to_folded, OTHER_STACK
+from middleware.rate_limit import LogRateLimiter
+from middleware.payload import PayloadCapture, REDACTED_VALUE, TRUNCATED_MARKER, SKIPPED_KEYS_KEY
+from middleware.histograms import ViewLatencyHistograms, OTHER_VIEWS_PATH
+from middleware.watchdog import InFlightWatchdog
+from histogram import LogHistogram, get_period
+from log_tail import SlowLogTail
+from query_digest import fingerprint, get_fingerprint_hash, get_statement_fingerprint, get_table, \
+    QueryDigestCollector
+from collector import Collector, SlowLogSource, BinLogSource, SlowLogTableSource
+import retention
 import views
+# commands are loaded by call_command as time_logger package modules
+from time_logger.management.commands import bin_log_to_mongo
+
+logger = logging.getLogger(__name__)
 
 
 class ViewsLogTestCase(TestCase):
@@ -92,11 +124,25 @@ class ViewsLogDetail(TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response.context['object'], log)
 
+    def test_page_profile(self):
+        log = models_mongo.ViewTimeLog.objects.create(
+            duration=2,
+            view_func_path='time_logger.views.test_view',
+            profile='main;view 3',
+        )
+
+        response = self.client.get('/views_log/%s/' % log.pk)
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'main;view 3')
+
 
-class SlowQueriesLogTestCase(TestCase):
+class SlowQueriesLogTestCase(TestCase, TearDownTestCaseMixin):
     def setUp(self):
         self.url = '/slow_queries_log/'
 
+    def tearDown(self):
+        self.tearDownMongo()
+
     def generate_data(self):
         now = datetime.datetime.now()
         start_time = now - datetime.timedelta(seconds=30)
@@ -171,11 +217,62 @@ class SlowQueriesLogTestCase(TestCase):
         self.assertIn(log1, response.context['page_obj'].object_list)
         self.assertIn(log2, response.context['page_obj'].object_list)
 
+    def test_float_query_time(self):
+        log1, log2 = self.generate_data()
+        log2.query_time = 0.000125
+        log2.save()
+        log3 = models_mongo.MysqlSlowQueriesTimeLog.objects.create(start_time=log2.start_time, query_time=0.5)
 
-class BinLogTestCase(TestCase):
+        response = self.client.get(self.url, {'min_query_time': 0.0002, 'order': '-query_time'})
+        self.assertFalse(response.context['form'].errors)
+        self.assertEqual(list(response.context['page_obj'].object_list), [log1, log3])
+        self.assertEqual(response.context['query_time_percentiles'], [(50, 0.5), (95, 40), (99, 40)])
+
+        response = self.client.get(self.url, {'order': '-query_time'})
+        self.assertEqual(list(response.context['page_obj'].object_list), [log1, log3, log2])
+        self.assertEqual(response.context['query_time_percentiles'], [(50, 0.5), (95, 40), (99, 40)])
+        self.assertEqual(models_mongo.MysqlSlowQueriesTimeLog.objects.get(pk=log2.pk).query_time, 0.000125)
+
+    def test_percentiles(self):
+        for i in range(1, 101):
+            models_mongo.MysqlSlowQueriesTimeLog.objects.create(query_time=i / 1000.0)
+        percentiles = models_mongo.MysqlSlowQueriesTimeLog.get_query_time_percentiles(
+            models_mongo.MysqlSlowQueriesTimeLog.objects.all(), (1, 50, 99, 100))
+        self.assertEqual(percentiles, [(1, 0.001), (50, 0.05), (99, 0.099), (100, 0.1)])
+
+        percentiles = models_mongo.MysqlSlowQueriesTimeLog.get_query_time_percentiles(
+            models_mongo.MysqlSlowQueriesTimeLog.objects.all(), (1, 50, 99, 100), max_count=100)
+        self.assertEqual(percentiles, [(1, 0.001), (50, 0.05), (99, 0.099), (100, 0.1)])
+        self.assertIsNone(models_mongo.MysqlSlowQueriesTimeLog.get_query_time_percentiles(
+            models_mongo.MysqlSlowQueriesTimeLog.objects.all(), max_count=99))
+
+    def test_percentiles_max_count(self):
+        self.generate_data()
+        with mock.patch.object(views.SlowQueriesLog, 'percentiles_max_count', 1):
+            response = self.client.get(self.url, {'order': '-query_time'})
+        self.assertIsNone(response.context['query_time_percentiles'])
+        self.assertContains(response, 'Percentiles are not computed for more than 1 queries')
+
+    def test_migrate_durations(self):
+        collection = models_mongo.MysqlSlowQueriesTimeLog._get_collection()
+        collection.insert([{'query_time': 75, 'lock_time': 0}, {'query_time': 75, 'lock_time': 1},
+                           {'query_time': 1.5, 'lock_time': 0.25}])
+        out = StringIO()
+        call_command('migrate_slow_log_durations', stdout=out)
+        self.assertEqual(out.getvalue(), 'query_time: 2 logs\nlock_time: 2 logs\n')
+        for log in collection.find():
+            self.assertIsInstance(log['query_time'], float)
+            self.assertIsInstance(log['lock_time'], float)
+        self.assertEqual(sorted(log['query_time'] for log in collection.find()), [1.5, 75, 75])
+
+
+class BinLogTestCase(TestCase, TearDownTestCaseMixin):
     def setUp(self):
         self.url = '/bin_log/'
 
+    def tearDown(self):
+        self.tearDownMongo()
+
     def generate_data(self):
         now = datetime.datetime.now()
         start_time = now - datetime.timedelta(seconds=30)
@@ -244,6 +341,121 @@ class BinLogTestCase(TestCase):
         self.assertIn(log2, response.context['page_obj'].object_list)
 
 
+class QueryDigestsTestCase(TestCase, TearDownTestCaseMixin):
+    def setUp(self):
+        self.url = '/query_digests/'
+
+    def tearDown(self):
+        self.tearDownMongo()
+
+    def generate_data(self):
+        now = datetime.datetime.now()
+        digests = QueryDigestCollector(models_mongo.QueryDigest.SLOW_LOG_SOURCE)
+        digests.add('select * from test where id = 1', 1, seen=now - datetime.timedelta(days=2))
+        digests.add('select * from test where id = 2', 2, seen=now - datetime.timedelta(days=2))
+        digests.add('update test set a = 1', 10, seen=now)
+        digests.flush()
+        return (models_mongo.QueryDigest.objects.get(fingerprint='update test set a = ?'),
+                models_mongo.QueryDigest.objects.get(fingerprint='select * from test where id = ?'))
+
+    def test_without_params(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+
+    def test_order_by_total_time(self):
+        digest1, digest2 = self.generate_data()
+        response = self.client.get(self.url, {'source': models_mongo.QueryDigest.SLOW_LOG_SOURCE})
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(response.context['form'].errors)
+        self.assertEqual(list(response.context['page_obj'].object_list), [digest1, digest2])
+
+        response = self.client.get(self.url, {'source': models_mongo.QueryDigest.BIN_LOG_SOURCE})
+        self.assertFalse(response.context['page_obj'].object_list)
+
+    def test_filter(self):
+        digest1, digest2 = self.generate_data()
+        response = self.client.get(self.url, {'fingerprint': 'SELECT'})
+        self.assertEqual(list(response.context['page_obj'].object_list), [digest2])
+
+        response = self.client.get(self.url, {'min_dc': datetime.date.today()})
+        self.assertEqual(list(response.context['page_obj'].object_list), [digest1])
+
+
+class LatencyHistogramsTestCase(TestCase, TearDownTestCaseMixin):
+    def setUp(self):
+        self.url = '/latency/'
+        self.period = datetime.datetime(2015, 8, 25, 3)
+
+    def tearDown(self):
+        self.tearDownMongo()
+
+    def _add_view_histogram(self, view_func_path, period, durations):
+        histogram = LogHistogram()
+        for duration in durations:
+            histogram.add(duration)
+        models_mongo.ViewLatencyHistogram.add(view_func_path, period, histogram)
+
+    def test_without_params(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+
+    def test_default_window(self):
+        period = get_period(datetime.datetime.now()) - datetime.timedelta(hours=3)
+        self._add_view_histogram('app.views.list', period, [0.1])
+        self._add_view_histogram('app.views.list', period - datetime.timedelta(days=2), [3])
+        self._add_view_histogram('app.views.old', period - datetime.timedelta(days=2), [3])
+
+        # histograms of last 24 hours without dates
+        response = self.client.get(self.url, {'source': 'view'})
+        rows = response.context['page_obj'].object_list
+        self.assertEqual([(row['key'], row['count']) for row in rows], [('app.views.list', 1)])
+
+        response = self.client.get(self.url, {'source': 'view', 'max_dc': datetime.date.today()})
+        rows = response.context['page_obj'].object_list
+        self.assertEqual([(row['key'], row['count']) for row in rows], [('app.views.list', 2), ('app.views.old', 1)])
+
+    def test_views(self):
+        self._add_view_histogram('app.views.list', self.period, [0.1, 0.2])
+        self._add_view_histogram('app.views.list', self.period + datetime.timedelta(hours=1), [3])
+        self._add_view_histogram('app.views.detail', self.period, [0.5])
+
+        response = self.client.get(self.url, {'source': 'view', 'min_dc': self.period.date()})
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(response.context['form'].errors)
+        rows = response.context['page_obj'].object_list
+        self.assertEqual([(row['key'], row['count'], row['duration_max']) for row in rows],
+                         [('app.views.list', 3, 3), ('app.views.detail', 1, 0.5)])
+        self.assertAlmostEqual(rows[0]['duration_sum'], 3.3)
+        self.assertEqual([percent for percent, duration in rows[0]['percentiles']], [50, 95, 99])
+        self.assertAlmostEqual(rows[0]['percentiles'][0][1], 0.2, delta=0.2 * 0.2)
+
+        response = self.client.get(self.url, {'source': 'view', 'key': 'app.views.l', 'by_hour': 'on',
+                                              'max_dc': self.period.date()})
+        rows = response.context['page_obj'].object_list
+        self.assertEqual([(row['key'], row['period'], row['count']) for row in rows],
+                         [('app.views.list', self.period, 2),
+                          ('app.views.list', self.period + datetime.timedelta(hours=1), 1)])
+
+        # hours which overlap dates
+        response = self.client.get(self.url, {'source': 'view', 'min_dc': self.period + datetime.timedelta(minutes=90)})
+        rows = response.context['page_obj'].object_list
+        self.assertEqual([(row['key'], row['count']) for row in rows], [('app.views.list', 1)])
+
+    def test_queries(self):
+        digests = QueryDigestCollector(models_mongo.QueryDigest.SLOW_LOG_SOURCE)
+        fingerprint_hash = digests.add('select * from t where id = 1', 1.5, seen=self.period)
+        digests.flush()
+
+        response = self.client.get(self.url, {'source': models_mongo.QueryDigest.SLOW_LOG_SOURCE,
+                                              'min_dc': self.period.date()})
+        rows = response.context['page_obj'].object_list
+        self.assertEqual([(row['key'], row['fingerprint'], row['count']) for row in rows],
+                         [(fingerprint_hash, 'select * from t where id = ?', 1)])
+
+        response = self.client.get(self.url, {'source': models_mongo.QueryDigest.BIN_LOG_SOURCE})
+        self.assertFalse(response.context['page_obj'].object_list)
+
+
 class ViewMiddlewareTestCase(TestCase, TearDownTestCaseMixin):
     def setUp(self):
         url = '/views_log/'
@@ -261,11 +473,9 @@ class ViewMiddlewareTestCase(TestCase, TearDownTestCaseMixin):
             hasattr(self.request, 'time_logger')
         )
 
-        self.assertAlmostEqual(
-            self.request.time_logger['start_dt'],
-            datetime.datetime.now(),
-            delta=datetime.timedelta(seconds=1),
-        )
+        self.assertAlmostEqual(self.request.time_logger.start, timer(), delta=1)
+        self.assertIsNone(self.request.time_logger.view_start)
+        self.assertIsNone(self.request.time_logger.view_end)
 
     def test_process_view(self):
         view = views.ViewsLog.as_view()
@@ -275,9 +485,16 @@ class ViewMiddlewareTestCase(TestCase, TearDownTestCaseMixin):
         self.middleware.process_request(self.request)
         self.middleware.process_view(self.request, view, args, kwargs)
 
-        self.assertEqual(self.request.time_logger['view_func'], view)
-        self.assertEqual(self.request.time_logger['view_args'], args)
-        self.assertEqual(self.request.time_logger['view_kwargs'], kwargs)
+        self.assertEqual(self.request.time_logger.view_func, view)
+        self.assertEqual(self.request.time_logger.view_args, args)
+        self.assertEqual(self.request.time_logger.view_kwargs, kwargs)
+        self.assertAlmostEqual(self.request.time_logger.view_start, timer(), delta=1)
+
+    def test_process_template_response(self):
+        self.middleware.process_request(self.request)
+        response = self.middleware.process_template_response(self.request, sentinel.response)
+        self.assertEqual(response, sentinel.response)
+        self.assertAlmostEqual(self.request.time_logger.view_end, timer(), delta=1)
 
     @mock.patch('time_logger.middleware.view_logger.ViewTimeLogger._log_view')
     def test_process_response(self, log_view_mock):
@@ -286,8 +503,11 @@ class ViewMiddlewareTestCase(TestCase, TearDownTestCaseMixin):
 
     @mock.patch('time_logger.middleware.view_logger.ViewTimeLogger._log_view')
     def test_process_exception(self, log_view_mock):
+        self.middleware.process_request(self.request)
         self.middleware.process_exception(self.request, None)
-        self.assertTrue(log_view_mock.called)
+        # exception response is logged by process_response
+        self.assertFalse(log_view_mock.called)
+        self.assertAlmostEqual(self.request.time_logger.view_end, timer(), delta=1)
 
 
 class LogViewFuncViewMiddlewareTestCase(TestCase, TearDownTestCaseMixin):
@@ -296,12 +516,10 @@ class LogViewFuncViewMiddlewareTestCase(TestCase, TearDownTestCaseMixin):
         factory = RequestFactory()
         self.request = factory.get(url)
         self.middleware = ViewTimeLoggerMiddleware()
-        self.request.time_logger = {
-            'start_dt': datetime.datetime.now(),
-            'view_func': views.ViewsLog.as_view(),
-            'view_args': [1, 2, 3],
-            'view_kwargs': {'a': 1, 'b': 2, 'c': 3},
-        }
+        self.request.time_logger = RequestTimeRecord(timer())
+        self.request.time_logger.view_func = views.ViewsLog.as_view()
+        self.request.time_logger.view_args = [1, 2, 3]
+        self.request.time_logger.view_kwargs = {'a': 1, 'b': 2, 'c': 3}
         user = User.objects.create(username='tester')
         self.request.user = user
 
@@ -316,8 +534,7 @@ class LogViewFuncViewMiddlewareTestCase(TestCase, TearDownTestCaseMixin):
             )
 
     def test_no_logging_with_small_duration(self):
-        small_delta = datetime.timedelta(seconds=settings.LOG_VIEW_TIME - 2)
-        self.request.time_logger['start_dt'] = self.request.time_logger['start_dt'] - small_delta
+        self.request.time_logger.start -= settings.LOG_VIEW_TIME - 2
 
         self.middleware._log_view(self.request)
         self.assertFalse(
@@ -325,23 +542,943 @@ class LogViewFuncViewMiddlewareTestCase(TestCase, TearDownTestCaseMixin):
         )
 
     def test_no_logging_with_big_duration(self):
-        big_duration = settings.LOG_VIEW_TIME + 2
-        big_delta = datetime.timedelta(seconds=big_duration)
-        self.request.time_logger['start_dt'] = self.request.time_logger['start_dt'] - big_delta
+        big_duration = settings.LOG_VIEW_TIME + 2.3456
+        start = self.request.time_logger.start
 
-        self.middleware._log_view(self.request)
+        with mock.patch('time_logger.middleware.view_logger.timer', return_value=start + big_duration):
+            self.middleware._log_view(self.request)
         self.assertTrue(
             models_mongo.ViewTimeLog.objects.all().count()
         )
 
         log = models_mongo.ViewTimeLog.objects.get()
-        self.assertEqual(log.duration, big_duration)
+        self.assertEqual(log.duration, round(big_duration, 3))
         self.assertEqual(log.view_func_path, 'time_logger.views.ViewsLog')
-        self.assertEqual(log.view_args, self.request.time_logger['view_args'])
-        self.assertEqual(log.view_kwargs, self.request.time_logger['view_kwargs'])
+        self.assertEqual(log.view_args, self.request.time_logger.view_args)
+        self.assertEqual(log.view_kwargs, self.request.time_logger.view_kwargs)
         self.assertEqual(log.request_get, {})
         self.assertEqual(log.request_post, {})
         self.assertAlmostEqual(log.dc, datetime.datetime.now(), delta=datetime.timedelta(seconds=1))
+        # view was not called
+        self.assertEqual(log.request_duration, round(big_duration, 3))
+        self.assertIsNone(log.view_duration)
+        self.assertIsNone(log.response_duration)
+
+    def test_phases(self):
+        start = self.request.time_logger.start
+        self.request.time_logger.view_start = start + 0.5
+        self.request.time_logger.view_end = start + 11.25
+
+        with mock.patch('time_logger.middleware.view_logger.timer', return_value=start + 12.5):
+            self.middleware._log_view(self.request)
+
+        log = models_mongo.ViewTimeLog.objects.get()
+        self.assertEqual(log.duration, 12.5)
+        self.assertEqual(log.request_duration, 0.5)
+        self.assertEqual(log.view_duration, 10.75)
+        self.assertEqual(log.response_duration, 1.25)
+
+    def test_phases_clock_adjusted(self):
+        start = self.request.time_logger.start
+        self.request.time_logger.view_start = start + 0.5
+        self.request.time_logger.view_end = start + 12
+
+        # clock is set back after view
+        with mock.patch('time_logger.middleware.view_logger.timer', return_value=start + 11.5):
+            self.middleware._log_view(self.request)
+
+        log = models_mongo.ViewTimeLog.objects.get()
+        self.assertEqual(log.view_duration, 11.5)
+        self.assertEqual(log.response_duration, 0)
+
+    def test_queries(self):
+        self.request.time_logger.start -= settings.LOG_VIEW_TIME + 2
+        queries = QueryCapture(max_queries=2)
+        queries.queries.extend([('default', 'select 1', 0.1), ('default', 'select 2', 0.2)])
+        queries.count = 5
+        queries.duration = 1.5
+        self.request.time_logger.queries = queries
+
+        self.middleware._log_view(self.request)
+
+        log = models_mongo.ViewTimeLog.objects.get()
+        self.assertEqual(log.queries_count, 5)
+        self.assertEqual(log.queries_duration, 1.5)
+        self.assertEqual(log.queries, [
+            {'alias': 'default', 'sql': 'select 1', 'duration': 0.1},
+            {'alias': 'default', 'sql': 'select 2', 'duration': 0.2},
+        ])
+
+    def test_profile(self):
+        self.request.time_logger.start -= settings.LOG_VIEW_TIME + 2
+        self.request.time_logger.thread_ident = threading.current_thread().ident
+        with self.settings(LOG_VIEW_TIME_PROFILE=True):
+            middleware = ViewTimeLoggerMiddleware()
+
+        samples = collections.Counter({'main;view': 3, 'main;view;query': 7})
+        with mock.patch.object(middleware.profiler, 'stop', return_value=samples) as stop_mock:
+            middleware._log_view(self.request)
+        stop_mock.assert_called_with(self.request.time_logger.thread_ident)
+
+        log = models_mongo.ViewTimeLog.objects.get()
+        self.assertEqual(log.profile, 'main;view;query 7\nmain;view 3')
+
+    def test_histograms(self):
+        with self.settings(LOG_VIEW_TIME_HISTOGRAMS=True):
+            middleware = ViewTimeLoggerMiddleware()
+
+        with mock.patch.object(middleware.histograms, 'add') as add_mock:
+            middleware._log_view(self.request)
+        self.assertEqual(add_mock.call_args[0][0], 'time_logger.views.ViewsLog')
+        # fast request is not logged
+        self.assertFalse(models_mongo.ViewTimeLog.objects.count())
+
+    def test_view_func_path_cache(self):
+        view_func = self.request.time_logger.view_func
+        self.assertEqual(self.middleware._get_view_func_path(view_func), 'time_logger.views.ViewsLog')
+
+        with mock.patch('inspect.getmodule') as getmodule_mock:
+            self.assertEqual(self.middleware._get_view_func_path(view_func), 'time_logger.views.ViewsLog')
+        self.assertFalse(getmodule_mock.called)
+
+        self.assertEqual(self.middleware._get_view_func_path(None), '')
+
+        # views are not kept by cache
+        def view(request):
+            pass
+        self.middleware._get_view_func_path(view)
+        self.assertIn(view, self.middleware._view_func_paths)
+        del view
+        gc.collect()
+        self.assertEqual(len(self.middleware._view_func_paths), 1)
+
+    @mock.patch.object(LogRateLimiter, '_ensure_started')
+    def test_rate_limit(self, _ensure_started_mock):
+        with self.settings(LOG_VIEW_TIME_RATE=0.001, LOG_VIEW_TIME_SUPPRESSED_INTERVAL=0):
+            middleware = ViewTimeLoggerMiddleware()
+        self.assertEqual(middleware.rate_limiter.on_summary, middleware._save_suppressed)
+
+        start = self.request.time_logger.start
+        with mock.patch('time_logger.middleware.view_logger.timer', return_value=start + 12.5):
+            for _ in range(3):
+                middleware._log_view(self.request)
+
+        log = models_mongo.ViewTimeLog.objects.get()
+        suppressed = models_mongo.SuppressedViewTimeLog.objects.all()
+        self.assertEqual(sum(s.count for s in suppressed), 2)
+        self.assertEqual(suppressed[0].view_func_path, log.view_func_path)
+        self.assertEqual(suppressed[0].duration_max, log.duration)
+
+    def test_request_payload(self):
+        factory = RequestFactory()
+        request = factory.post('/views_log/?q=%s' % ('a' * 20), 'password=123&name=test',
+                               content_type='application/x-www-form-urlencoded')
+        request.time_logger = self.request.time_logger
+        request.time_logger.start -= settings.LOG_VIEW_TIME + 2
+        request.user = self.request.user
+
+        with self.settings(LOG_VIEW_TIME_MAX_VALUE_SIZE=10, LOG_VIEW_TIME_MAX_BODY_SIZE=1000):
+            middleware = ViewTimeLoggerMiddleware()
+        middleware._log_view(request)
+
+        log = models_mongo.ViewTimeLog.objects.get()
+        self.assertEqual(log.request_get, {'q': 'a' * 10 + TRUNCATED_MARKER})
+        self.assertEqual(log.request_post, {'password': REDACTED_VALUE, 'name': 'test'})
+        self.assertEqual(log.request_body, 'password=%s&name=test' % REDACTED_VALUE)
+        self.assertEqual(log.request_sizes, {'request_get': 20})
+
+    def test_request_payload_large_post(self):
+        factory = RequestFactory()
+        request = factory.post('/views_log/', 'name=test&q=' + 'a' * 100,
+                               content_type='application/x-www-form-urlencoded')
+        request.time_logger = self.request.time_logger
+        request.time_logger.start -= settings.LOG_VIEW_TIME + 2
+        request.user = self.request.user
+
+        # body is longer than saved head, view did not read POST
+        with self.settings(LOG_VIEW_TIME_MAX_VALUE_SIZE=1000, LOG_VIEW_TIME_MAX_BODY_SIZE=10):
+            middleware = ViewTimeLoggerMiddleware()
+        middleware._log_view(request)
+
+        log = models_mongo.ViewTimeLog.objects.get()
+        self.assertEqual(log.request_post, {'name': 'test', 'q': 'a' * 100})
+        self.assertEqual(log.request_body, 'name=test&' + TRUNCATED_MARKER)
+        self.assertEqual(log.request_sizes, {'request_body': 112})
+
+    @mock.patch.object(InFlightWatchdog, '_ensure_started')
+    def test_watchdog(self, _ensure_started_mock):
+        with self.settings(LOG_VIEW_TIME_WATCHDOG=True):
+            middleware = ViewTimeLoggerMiddleware()
+        request = RequestFactory().get('/views_log/?q=1')
+        request.user = self.request.user
+        middleware.process_request(request)
+        middleware.process_view(request, views.ViewsLog.as_view(), [], {})
+        start = request.time_logger.start
+
+        # hung request is logged before it is finished
+        middleware.watchdog.check(settings.LOG_VIEW_TIME, now=start + settings.LOG_VIEW_TIME + 1)
+        log = models_mongo.ViewTimeLog.objects.get()
+        self.assertTrue(log.in_progress)
+        self.assertIn('test_watchdog', log.stack)
+        self.assertEqual(log.view_func_path, 'time_logger.views.ViewsLog')
+        self.assertEqual(log.request_get, {'q': '1'})
+        self.assertIsNone(log.username)
+
+        # provisional log is reported once
+        middleware.watchdog.check(settings.LOG_VIEW_TIME, now=start + settings.LOG_VIEW_TIME + 2)
+        self.assertEqual(models_mongo.ViewTimeLog.objects.count(), 1)
+
+        # and replaced by final log
+        with mock.patch('time_logger.middleware.view_logger.timer', return_value=start + settings.LOG_VIEW_TIME + 5):
+            middleware.process_response(request, sentinel.response)
+        log = models_mongo.ViewTimeLog.objects.get()
+        self.assertFalse(log.in_progress)
+        self.assertIn('test_watchdog', log.stack)
+        self.assertEqual(log.duration, settings.LOG_VIEW_TIME + 5)
+        self.assertEqual(log.username, 'tester')
+        self.assertFalse(middleware.watchdog._requests)
+
+    @mock.patch.object(log_writer.BackgroundLogWriter, '_ensure_started')
+    @mock.patch.object(InFlightWatchdog, '_ensure_started')
+    def test_watchdog_background_writer(self, _ensure_started_mock, _writer_ensure_started_mock):
+        with self.settings(LOG_VIEW_TIME_WATCHDOG=True, LOG_VIEW_TIME_ASYNC=True):
+            middleware = ViewTimeLoggerMiddleware()
+        request = RequestFactory().get('/views_log/')
+        request.user = self.request.user
+        middleware.process_request(request)
+        middleware.process_view(request, views.ViewsLog.as_view(), [], {})
+        start = request.time_logger.start
+
+        # provisional log is queued with id of final log
+        middleware.watchdog.check(settings.LOG_VIEW_TIME, now=start + settings.LOG_VIEW_TIME + 1)
+        provisional_log = middleware.writer._queue[0]
+        self.assertTrue(provisional_log.in_progress)
+        self.assertIsNotNone(provisional_log.id)
+        self.assertFalse(models_mongo.ViewTimeLog.objects.count())
+
+        # final log is written before queued provisional log
+        with mock.patch('time_logger.middleware.view_logger.timer', return_value=start + settings.LOG_VIEW_TIME + 5):
+            middleware.process_response(request, sentinel.response)
+        middleware.writer.flush()
+        log = models_mongo.ViewTimeLog.objects.get()
+        self.assertEqual(log.id, provisional_log.id)
+        self.assertFalse(log.in_progress)
+
+
+class SamplingProfilerTestCase(TestCase):
+    def test_sample(self):
+        profiler = SamplingProfiler()
+        ident = threading.current_thread().ident
+        with mock.patch.object(profiler, '_ensure_started') as _ensure_started_mock:
+            profiler.start(ident)
+        self.assertTrue(_ensure_started_mock.called)
+
+        profiler.sample()
+        profiler.sample()
+        samples = profiler.stop(ident)
+        self.assertEqual(sum(samples.values()), 2)
+        stack = list(samples)[0]
+        self.assertIn('test_sample', stack)
+
+        self.assertIsNone(profiler.stop(ident))
+
+    def test_max_depth(self):
+        profiler = SamplingProfiler(max_depth=2)
+        ident = threading.current_thread().ident
+        with mock.patch.object(profiler, '_ensure_started'):
+            profiler.start(ident)
+        profiler.sample()
+        stack = list(profiler.stop(ident))[0]
+        self.assertEqual(len(stack.split(';')), 2)
+
+    def test_max_stacks(self):
+        profiler = SamplingProfiler(max_stacks=1)
+        ident = threading.current_thread().ident
+        with mock.patch.object(profiler, '_ensure_started'):
+            profiler.start(ident)
+        with mock.patch.object(profiler, '_get_folded_stack', side_effect=['a;b', 'a;c', 'a;b', 'a;d']):
+            for i in range(4):
+                profiler.sample()
+        self.assertEqual(profiler.stop(ident), {'a;b': 2, OTHER_STACK: 2})
+
+    def test_thread(self):
+        profiler = SamplingProfiler(interval=0.001)
+        ident = threading.current_thread().ident
+        profiler.start(ident)
+        deadline = timer() + 5
+        while timer() < deadline and not profiler._samples[ident]:
+            sum(range(1000))
+        self.assertTrue(profiler.stop(ident))
+
+    def test_to_folded(self):
+        samples = collections.Counter({'a;b': 1, 'a;b;c': 2})
+        self.assertEqual(to_folded(samples), 'a;b;c 2\na;b 1')
+        self.assertEqual(to_folded(samples, max_size=len('a;b;c 2\na;b 1')), 'a;b;c 2\na;b 1')
+        self.assertEqual(to_folded(samples, max_size=10), 'a;b;c 2')
+
+
+class QueryCaptureTestCase(TestCase):
+    def test_call(self):
+        queries = QueryCapture(max_queries=2)
+        execute = mock.Mock(return_value=sentinel.result)
+        context = {'connection': mock.Mock(alias='default')}
+
+        for i in range(3):
+            result = queries(execute, 'select %s', [i], False, context)
+            self.assertEqual(result, sentinel.result)
+            execute.assert_called_with('select %s', [i], False, context)
+
+        self.assertEqual(queries.count, 3)
+        self.assertEqual(len(queries.queries), 2)
+        self.assertEqual([q['sql'] for q in queries.to_list()], ['select %s', 'select %s'])
+        self.assertGreaterEqual(queries.duration, 0)
+
+    def test_call_exception(self):
+        queries = QueryCapture()
+        execute = mock.Mock(side_effect=ValueError)
+        context = {'connection': mock.Mock(alias='default')}
+        self.assertRaises(ValueError, queries, execute, 'select 1', None, False, context)
+        self.assertEqual(queries.count, 1)
+
+    @mock.patch('time_logger.middleware.query_capture.connections')
+    def test_install(self, connections_mock):
+        stale_queries = QueryCapture()
+        connection = mock.Mock(execute_wrappers=[sentinel.wrapper, stale_queries])
+        old_connection = mock.Mock(spec=[])
+        connections_mock.all.return_value = [connection, old_connection]
+
+        queries = QueryCapture()
+        queries.install()
+        self.assertEqual(connection.execute_wrappers, [sentinel.wrapper, queries])
+
+        queries.uninstall()
+        self.assertEqual(connection.execute_wrappers, [sentinel.wrapper])
+
+    def test_cursor_wrapper(self):
+        # connection of installed django
+        connection = connections[DEFAULT_DB_ALIAS]
+        stale_queries = QueryCapture()
+        stale_queries.install()
+        queries = QueryCapture()
+        queries.install()
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT %s', [1])
+                self.assertEqual(cursor.fetchone(), (1,))
+                cursor.executemany('UPDATE auth_user SET last_name = %s WHERE id = 0', [['a'], ['b']])
+        finally:
+            queries.uninstall()
+        connection.cursor().execute('SELECT 2')
+
+        self.assertEqual(queries.count, 2)
+        self.assertEqual([(query['alias'], query['sql']) for query in queries.to_list()],
+                         [(DEFAULT_DB_ALIAS, 'SELECT %s'),
+                          (DEFAULT_DB_ALIAS, 'UPDATE auth_user SET last_name = %s WHERE id = 0')])
+        self.assertEqual(stale_queries.count, 0)
+        self.assertNotIsInstance(connection.cursor(), CaptureCursorWrapper)
+
+
+class LogRateLimiterTestCase(TestCase):
+    @mock.patch('time_logger.middleware.rate_limit.timer')
+    def test_process_rate(self, timer_mock):
+        timer_mock.return_value = 100
+        limiter = LogRateLimiter(rate=1, burst=2)
+        self.assertEqual([limiter.allow('view1', 1) for _ in range(3)], [True, True, False])
+
+        timer_mock.return_value = 101
+        self.assertEqual([limiter.allow('view2', 2) for _ in range(2)], [True, False])
+
+    @mock.patch('time_logger.middleware.rate_limit.timer')
+    def test_view_rate(self, timer_mock):
+        timer_mock.return_value = 100
+        limiter = LogRateLimiter(view_rate=1, max_views=1)
+        self.assertTrue(limiter.allow('view1', 1))
+        self.assertFalse(limiter.allow('view1', 1))
+        # views over max_views share bucket
+        self.assertTrue(limiter.allow('view2', 1))
+        self.assertFalse(limiter.allow('view3', 1))
+
+    @mock.patch('time_logger.middleware.rate_limit.timer')
+    def test_pop_suppressed(self, timer_mock):
+        timer_mock.return_value = 100
+        limiter = LogRateLimiter(rate=1, summary_interval=60)
+        limiter.allow('view1', 1)
+        limiter.allow('view1', 3)
+        limiter.allow('view1', 2)
+        limiter.allow('view2', 5)
+
+        self.assertEqual(limiter.pop_suppressed(), {})
+
+        timer_mock.return_value = 160
+        suppressed = limiter.pop_suppressed()
+        self.assertEqual(sorted(suppressed), ['view1', 'view2'])
+        self.assertEqual(suppressed['view1'].count, 2)
+        self.assertEqual(suppressed['view1'].duration_min, 2)
+        self.assertEqual(suppressed['view1'].duration_max, 3)
+        self.assertEqual(suppressed['view1'].duration_sum, 5)
+        self.assertEqual(limiter.pop_suppressed(force=True), {})
+
+        self.assertTrue(limiter.allow('view1', 1))
+        self.assertFalse(limiter.allow('view1', 1))
+        self.assertEqual(limiter.pop_suppressed(), {})
+        self.assertEqual(limiter.pop_suppressed(force=True)['view1'].count, 1)
+
+    @mock.patch('time_logger.middleware.rate_limit.timer')
+    def test_max_suppressed_views(self, timer_mock):
+        timer_mock.return_value = 100
+        limiter = LogRateLimiter(rate=1, max_views=1)
+        for path in ('view1', 'view1', 'view2', 'view3'):
+            limiter.allow(path, 1)
+        suppressed = limiter.pop_suppressed(force=True)
+        self.assertEqual(sorted(suppressed), [OTHER_VIEWS_PATH, 'view1'])
+        self.assertEqual(suppressed[OTHER_VIEWS_PATH].count, 2)
+
+    @mock.patch('time_logger.middleware.rate_limit.timer')
+    @mock.patch.object(LogRateLimiter, '_ensure_started')
+    def test_summary_thread(self, _ensure_started_mock, timer_mock):
+        timer_mock.return_value = 100
+        on_summary = mock.Mock()
+        limiter = LogRateLimiter(rate=1, summary_interval=60, on_summary=on_summary)
+        limiter.allow('view1', 1)
+        self.assertFalse(_ensure_started_mock.called)
+        limiter.allow('view1', 2)
+        self.assertTrue(_ensure_started_mock.called)
+
+        limiter._write_summary()
+        self.assertFalse(on_summary.called)
+
+        # summary is written without new requests
+        timer_mock.return_value = 160
+        limiter._write_summary()
+        suppressed = on_summary.call_args[0][0]
+        self.assertEqual(suppressed['view1'].count, 1)
+
+        on_summary.side_effect = ValueError
+        limiter.allow('view1', 2)
+        limiter.allow('view1', 2)
+        timer_mock.return_value = 220
+        with mock.patch('time_logger.middleware.rate_limit.logger') as logger_mock:
+            limiter._write_summary()
+        self.assertTrue(logger_mock.exception.called)
+
+
+class PayloadCaptureTestCase(TestCase):
+    def setUp(self):
+        self.factory = RequestFactory()
+
+    def test_query_to_dict(self):
+        payload = PayloadCapture()
+        request = self.factory.get('/', {'q': 'test', 'ids': [1, 2], 'a.b': 1, '$c': 2, 'Api_Key': 'abc'})
+        result, size = payload.query_to_dict(request.GET)
+        self.assertEqual(result, {'q': 'test', 'ids': ['1', '2'], 'Api_Key': REDACTED_VALUE})
+        self.assertIsNone(size)
+
+    def test_redact_whole_keys(self):
+        payload = PayloadCapture(max_body_size=100)
+        request = self.factory.get('/', {'password_hint': 'pet', 'password': 'secret'})
+        result, size = payload.query_to_dict(request.GET)
+        self.assertEqual(result, {'password_hint': 'pet', 'password': REDACTED_VALUE})
+
+        request = self.factory.post('/', 'password_hint=pet&my_token=1&password=secret',
+                                    content_type='application/x-www-form-urlencoded')
+        body, size = payload.get_body(request)
+        self.assertEqual(body, 'password_hint=pet&my_token=1&password=%s' % REDACTED_VALUE)
+
+    def test_query_to_dict_truncate(self):
+        payload = PayloadCapture(max_value_size=3, max_field_size=8)
+        request = self.factory.get('/', {'a': u'\u0444' * 3})
+        result, size = payload.query_to_dict(request.GET)
+        self.assertEqual(result, {'a': u'\u0444' + TRUNCATED_MARKER})
+        self.assertEqual(size, 6)
+
+        request = self.factory.get('/', {'a': '123', 'b': '456', 'c': '789'})
+        result, size = payload.query_to_dict(request.GET)
+        self.assertEqual(len(result), 3)
+        self.assertEqual(result[SKIPPED_KEYS_KEY], 1)
+        self.assertEqual(size, 9)
+
+    def test_get_body_not_read(self):
+        payload = PayloadCapture(max_body_size=5)
+        request = self.factory.post('/', 'token=secret&q=123456', content_type='application/x-www-form-urlencoded')
+        with mock.patch.object(request, 'read', wraps=request.read) as read_mock:
+            body, size = payload.get_body(request)
+        read_mock.assert_called_once_with(6)
+        self.assertEqual(body, 'token' + TRUNCATED_MARKER)
+        self.assertEqual(size, 21)
+
+        # chunked request without content length
+        request = self.factory.post('/', '{"q": "123456"}', content_type='application/json')
+        del request.META['CONTENT_LENGTH']
+        body, size = payload.get_body(request)
+        self.assertEqual(body, '{"q":' + TRUNCATED_MARKER)
+        self.assertIsNone(size)
+
+    def test_get_body_read(self):
+        payload = PayloadCapture(max_body_size=100)
+        request = self.factory.post('/', '{"user": "test", "password": "secret"}', content_type='application/json')
+        request.body
+        body, size = payload.get_body(request)
+        self.assertEqual(body, '{"user": "test", "password": "%s"}' % REDACTED_VALUE)
+        self.assertIsNone(size)
+
+        request = self.factory.post('/', 'q=1&passwd=secret&a=2', content_type='application/x-www-form-urlencoded')
+        request.body
+        body, size = payload.get_body(request)
+        self.assertEqual(body, 'q=1&passwd=%s&a=2' % REDACTED_VALUE)
+
+    def test_get_body_multipart(self):
+        payload = PayloadCapture(max_body_size=10)
+        request = self.factory.post('/', {'q': 1})
+        body, size = payload.get_body(request)
+        self.assertTrue(body.endswith(TRUNCATED_MARKER))
+        self.assertEqual(size, int(request.META['CONTENT_LENGTH']))
+
+        payload = PayloadCapture(max_body_size=1000)
+        request = self.factory.post('/', {'q': 1})
+        body, size = payload.get_body(request)
+        self.assertIn('name="q"', body)
+        self.assertIsNone(size)
+        self.assertEqual(request.POST['q'], '1')
+
+    def test_get_body_consumed(self):
+        payload = PayloadCapture(max_body_size=100)
+        request = self.factory.post('/', {'q': 1})
+        request.read()
+        self.assertEqual(payload.get_body(request), (None, None))
+
+    def test_get_body_disabled(self):
+        payload = PayloadCapture()
+        request = self.factory.post('/', {'q': 1})
+        self.assertEqual(payload.get_body(request), (None, None))
+
+
+class NoopMiddleware(object):
+    def process_request(self, request):
+        pass
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        pass
+
+    def process_response(self, request, response):
+        return response
+
+
+class ViewMiddlewareBenchmarkTestCase(TestCase, TearDownTestCaseMixin):
+    """
+    Time per request of middleware over baseline of middleware which does nothing. Typical overhead is about
+    6 us on the fast path and 250 us on the slow path (log document is built, its mongo write is mocked).
+    """
+    iterations = 2000
+
+    def setUp(self):
+        factory = RequestFactory()
+        self.request = factory.get('/views_log/', {'q': 'test'})
+        self.request.user = User.objects.create(username='tester')
+        self.view = views.ViewsLog.as_view()
+
+    def tearDown(self):
+        self.tearDownMongo()
+
+    def _benchmark(self, middleware):
+        """
+        Middleware time in nanoseconds per request
+        """
+        start = timer()
+        for _ in range(self.iterations):
+            middleware.process_request(self.request)
+            middleware.process_view(self.request, self.view, (), {})
+            middleware.process_response(self.request, None)
+        return (timer() - start) / self.iterations * 10 ** 9
+
+    def _assert_overhead(self, name, middleware, max_overhead):
+        baseline = self._benchmark(NoopMiddleware())
+        overhead = self._benchmark(middleware) - baseline
+        message = '%s overhead %.0f ns per request (baseline %.0f ns)' % (name, overhead, baseline)
+        logger.info(message)
+        self.assertLess(overhead, max_overhead, message)
+
+    def test_fast_path(self):
+        self._assert_overhead('fast path', ViewTimeLoggerMiddleware(), 5 * 10 ** 4)
+        self.assertFalse(models_mongo.ViewTimeLog.objects.count())
+
+    @mock.patch.object(models_mongo.ViewTimeLog, 'save')
+    def test_slow_path(self, save_mock):
+        # mongo write is not middleware overhead
+        with self.settings(LOG_VIEW_TIME=0.000000001):
+            self._assert_overhead('slow path', ViewTimeLoggerMiddleware(), 2 * 10 ** 6)
+        self.assertEqual(save_mock.call_count, self.iterations)
+
+
+class AsyncLogViewFuncViewMiddlewareTestCase(TestCase, TearDownTestCaseMixin):
+    def setUp(self):
+        url = '/views_log/'
+        factory = RequestFactory()
+        self.request = factory.get(url)
+        self.request.time_logger = RequestTimeRecord(timer() - settings.LOG_VIEW_TIME - 2)
+        self.request.time_logger.view_func = views.ViewsLog.as_view()
+        self.request.time_logger.view_args = [1, 2, 3]
+        self.request.time_logger.view_kwargs = {'a': 1, 'b': 2, 'c': 3}
+        self.request.user = User.objects.create(username='tester')
+
+    def tearDown(self):
+        self.tearDownMongo()
+
+    def test_response_not_blocked_by_insert(self):
+        insert_started = threading.Event()
+        insert_release = threading.Event()
+        insert_many = log_writer.insert_many
+
+        def slow_insert_many(document_cls, docs, **kwargs):
+            insert_started.set()
+            insert_release.wait(5)
+            return insert_many(document_cls, docs, **kwargs)
+
+        with self.settings(LOG_VIEW_TIME_ASYNC=True, LOG_VIEW_TIME_FLUSH_INTERVAL=0.01), \
+                mock.patch('time_logger.log_writer.insert_many', side_effect=slow_insert_many):
+            middleware = ViewTimeLoggerMiddleware()
+            response = middleware.process_response(self.request, sentinel.response)
+            self.assertEqual(response, sentinel.response)
+
+            self.assertTrue(insert_started.wait(5))
+            self.assertFalse(models_mongo.ViewTimeLog.objects.count())
+
+            insert_release.set()
+            middleware.writer.flush(timeout=5)
+
+        log = models_mongo.ViewTimeLog.objects.get()
+        self.assertEqual(log.view_func_path, 'time_logger.views.ViewsLog')
+        self.assertAlmostEqual(log.dc, datetime.datetime.now(), delta=datetime.timedelta(seconds=1))
+        self.assertEqual(middleware.writer.written, 1)
+
+
+@mock.patch.object(log_writer.BackgroundLogWriter, '_ensure_started')
+class BackgroundLogWriterTestCase(TestCase, TearDownTestCaseMixin):
+    def tearDown(self):
+        self.tearDownMongo()
+
+    def _create_logs(self, count):
+        return [models_mongo.ViewTimeLog(duration=i, view_func_path='test', dc=datetime.datetime.now())
+                for i in range(count)]
+
+    def test_drop_oldest(self, _ensure_started_mock):
+        writer = log_writer.BackgroundLogWriter(max_size=2, overflow_policy=log_writer.DROP_OLDEST)
+        for log in self._create_logs(3):
+            self.assertTrue(writer.put(log))
+        self.assertTrue(_ensure_started_mock.called)
+        self.assertEqual(writer.dropped_oldest, 1)
+        self.assertEqual(writer.dropped_newest, 0)
+
+        writer.flush()
+        durations = sorted(models_mongo.ViewTimeLog.objects.values_list('duration'))
+        self.assertEqual(durations, [1, 2])
+
+    def test_drop_newest(self, _ensure_started_mock):
+        writer = log_writer.BackgroundLogWriter(max_size=2, overflow_policy=log_writer.DROP_NEWEST)
+        results = [writer.put(log) for log in self._create_logs(3)]
+        self.assertEqual(results, [True, True, False])
+        self.assertEqual(writer.dropped_oldest, 0)
+        self.assertEqual(writer.dropped_newest, 1)
+
+        writer.flush()
+        durations = sorted(models_mongo.ViewTimeLog.objects.values_list('duration'))
+        self.assertEqual(durations, [0, 1])
+
+    def test_flush_in_batches(self, _ensure_started_mock):
+        writer = log_writer.BackgroundLogWriter(batch_size=2)
+        for log in self._create_logs(5):
+            writer.put(log)
+
+        with mock.patch('time_logger.log_writer.insert_many', wraps=log_writer.insert_many) as insert_many_mock:
+            writer.close()
+        self.assertEqual(insert_many_mock.call_count, 3)
+        self.assertEqual(models_mongo.ViewTimeLog.objects.count(), 5)
+        self.assertEqual(writer.get_stats()['written'], 5)
+
+        # closed writer does not accept documents
+        self.assertFalse(writer.put(self._create_logs(1)[0]))
+
+    def test_unknown_overflow_policy(self, _ensure_started_mock):
+        self.assertRaises(ValueError, log_writer.BackgroundLogWriter, overflow_policy='blablabla')
+
+
+class SpoolTestCase(TestCase, TearDownTestCaseMixin):
+    def setUp(self):
+        self.spool_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.spool_dir)
+        self.tearDownMongo()
+
+    def _create_logs(self, count):
+        return [models_mongo.ViewTimeLog(duration=i, view_func_path='test', dc=datetime.datetime.now())
+                for i in range(count)]
+
+    def test_write_read(self):
+        writer = spool.SpoolWriter(self.spool_dir, max_file_size=10 ** 6)
+        writer.write(self._create_logs(3))
+        # active file is not replayed
+        self.assertEqual(spool.get_spool_files(self.spool_dir), [])
+        self.assertEqual(len(spool.get_spool_files(self.spool_dir, include_active=True)), 1)
+
+        writer.close()
+        paths = spool.get_spool_files(self.spool_dir)
+        self.assertEqual(len(paths), 1)
+
+        records = list(spool.read_spool_file(paths[0]))
+        self.assertEqual([model_name for model_name, _ in records], ['ViewTimeLog'] * 3)
+        self.assertEqual([document['duration'] for _, document in records], [0, 1, 2])
+        self.assertTrue(all('_id' in document for _, document in records))
+        self.assertEqual(writer.spooled, 3)
+
+    def test_rotate(self):
+        writer = spool.SpoolWriter(self.spool_dir, max_file_size=1)
+        writer.write(self._create_logs(1))
+        writer.write(self._create_logs(1))
+        self.assertEqual(len(spool.get_spool_files(self.spool_dir, include_active=True)), 2)
+        self.assertEqual(len(spool.get_spool_files(self.spool_dir)), 2)
+
+    def test_truncated_record(self):
+        writer = spool.SpoolWriter(self.spool_dir)
+        writer.write(self._create_logs(2))
+        writer.close()
+        path = spool.get_spool_files(self.spool_dir)[0]
+        with open(path, 'rb+') as spool_file:
+            spool_file.truncate(os.path.getsize(path) - 1)
+        self.assertEqual(len(list(spool.read_spool_file(path))), 1)
+
+    @mock.patch('time_logger.spool.timer')
+    def test_circuit_breaker(self, timer_mock):
+        timer_mock.return_value = 100
+        writer = spool.SpoolWriter(self.spool_dir, latency_budget=1, cooldown=60)
+        self.assertFalse(writer.is_active())
+
+        writer.observe(0.5)
+        self.assertFalse(writer.is_active())
+
+        writer.observe(2)
+        self.assertTrue(writer.is_active())
+
+        timer_mock.return_value = 161
+        self.assertFalse(writer.is_active())
+
+    def test_middleware_save_error(self):
+        with self.settings(LOG_VIEW_TIME_SPOOL_DIR=self.spool_dir):
+            middleware = ViewTimeLoggerMiddleware()
+        log = self._create_logs(1)[0]
+        with mock.patch.object(models_mongo.ViewTimeLog, 'save', side_effect=Exception) as save_mock:
+            middleware._save(log)
+            self.assertTrue(middleware.spool.is_active())
+            middleware._save(log)
+        self.assertEqual(save_mock.call_count, 1)
+        self.assertEqual(middleware.spool.spooled, 2)
+        middleware.spool.close()
+
+    def test_background_writer_error(self):
+        writer = log_writer.BackgroundLogWriter(spool=spool.SpoolWriter(self.spool_dir))
+        for log in self._create_logs(2):
+            writer._queue.append(log)
+        with mock.patch('time_logger.log_writer.insert_many', side_effect=Exception):
+            writer.flush()
+        self.assertEqual(writer.spooled, 2)
+        self.assertEqual(writer.failed, 0)
+        self.assertTrue(writer.spool.is_active())
+        writer.spool.close()
+
+    def test_replay(self):
+        writer = spool.SpoolWriter(self.spool_dir)
+        writer.write(self._create_logs(3))
+        writer.close()
+
+        call_command('replay_spooled_logs', spool_dir=self.spool_dir, batch_size=2, keep=True)
+        self.assertEqual(models_mongo.ViewTimeLog.objects.count(), 3)
+
+        # replay is idempotent
+        call_command('replay_spooled_logs', spool_dir=self.spool_dir)
+        self.assertEqual(models_mongo.ViewTimeLog.objects.count(), 3)
+        self.assertEqual(spool.get_spool_files(self.spool_dir), [])
+
+    def test_replay_final_log(self):
+        provisional_log, log = self._create_logs(2)
+        provisional_log.in_progress = True
+        provisional_log.save()
+        log.id = provisional_log.id
+
+        writer = spool.SpoolWriter(self.spool_dir)
+        writer.write([log])
+        writer.close()
+
+        # final log replaces provisional log written before it
+        call_command('replay_spooled_logs', spool_dir=self.spool_dir)
+        log = models_mongo.ViewTimeLog.objects.get()
+        self.assertFalse(log.in_progress)
+        self.assertEqual(log.duration, 1)
+
+
+class InFlightWatchdogTestCase(TestCase):
+    def setUp(self):
+        self.callback = mock.Mock()
+        self.watchdog = InFlightWatchdog(self.callback)
+        self.ident = threading.current_thread().ident
+        self.request = RequestFactory().get('/')
+        self.request.time_logger = RequestTimeRecord(100)
+        with mock.patch.object(self.watchdog, '_ensure_started') as _ensure_started_mock:
+            self.watchdog.add(self.ident, self.request)
+        self.assertTrue(_ensure_started_mock.called)
+
+    def test_check(self):
+        self.watchdog.check(10, now=105)
+        self.assertFalse(self.callback.called)
+
+        self.watchdog.check(10, now=111)
+        self.watchdog.check(10, now=112)
+        self.assertEqual(self.callback.call_count, 1)
+        request, stack = self.callback.call_args[0]
+        self.assertIs(request, self.request)
+        self.assertIn('test_check', stack)
+
+        self.assertTrue(self.watchdog.remove(self.ident))
+        self.assertFalse(self.watchdog.remove(self.ident))
+
+    def test_check_without_threshold(self):
+        self.watchdog.check(None, now=1000)
+        self.assertFalse(self.callback.called)
+        self.assertFalse(self.watchdog.remove(self.ident))
+
+    def test_callback_error(self):
+        self.callback.side_effect = ValueError
+        self.watchdog.check(10, now=111)
+        self.assertTrue(self.watchdog.remove(self.ident))
+
+    def test_callback_without_lock(self):
+        def callback(request, stack):
+            self.assertTrue(self.watchdog._condition.acquire(False))
+            self.watchdog._condition.release()
+        self.callback.side_effect = callback
+        self.watchdog.check(10, now=111)
+        self.assertEqual(self.callback.call_count, 1)
+
+    def test_remove_waits_for_callback(self):
+        callback_started = threading.Event()
+        callback_release = threading.Event()
+
+        def callback(request, stack):
+            callback_started.set()
+            callback_release.wait(5)
+        self.callback.side_effect = callback
+
+        check_thread = threading.Thread(target=self.watchdog.check, args=(10, 111))
+        check_thread.start()
+        self.assertTrue(callback_started.wait(5))
+
+        results = []
+        remove_thread = threading.Thread(target=lambda: results.append(self.watchdog.remove(self.ident)))
+        remove_thread.start()
+        remove_thread.join(0.05)
+        self.assertEqual(results, [])
+
+        callback_release.set()
+        remove_thread.join(5)
+        check_thread.join(5)
+        self.assertEqual(results, [True])
+
+
+class LogHistogramTestCase(TestCase):
+    def test_quantile(self):
+        histogram = LogHistogram()
+        self.assertIsNone(histogram.quantile(0.5))
+
+        for i in range(1, 1001):
+            histogram.add(i / 1000.0)
+        self.assertEqual(histogram.count, 1000)
+        self.assertAlmostEqual(histogram.total, 500.5)
+        for q in (0.5, 0.9, 0.99):
+            self.assertAlmostEqual(histogram.quantile(q), q, delta=q * 0.2)
+        self.assertAlmostEqual(histogram.get_max(), 1, delta=0.2)
+
+    def test_small_values(self):
+        histogram = LogHistogram()
+        histogram.add(0)
+        histogram.add(-1)
+        self.assertEqual(histogram.buckets, {0: 2})
+
+    def test_merge(self):
+        histogram1 = LogHistogram()
+        histogram1.add(0.1)
+        histogram2 = LogHistogram()
+        histogram2.add(0.1)
+        histogram2.add(10)
+
+        histogram1.merge(histogram2)
+        self.assertEqual(histogram1.count, 3)
+        self.assertAlmostEqual(histogram1.total, 10.2)
+        self.assertEqual(histogram1.max_value, 10)
+        self.assertEqual(sorted(histogram1.buckets.values()), [1, 2])
+
+    def test_dict(self):
+        histogram = LogHistogram()
+        histogram.add(0.1)
+        histogram.add(0.1)
+        histogram.add(10)
+
+        buckets = histogram.to_dict()
+        self.assertTrue(all(isinstance(key, str) for key in buckets))
+
+        restored = LogHistogram.from_dict(buckets, histogram.total, histogram.max_value)
+        self.assertEqual(restored.buckets, histogram.buckets)
+        self.assertEqual(restored.count, histogram.count)
+        self.assertEqual(restored.total, histogram.total)
+        self.assertEqual(restored.max_value, 10)
+
+
+@mock.patch.object(ViewLatencyHistograms, '_ensure_started')
+class ViewLatencyHistogramsTestCase(TestCase, TearDownTestCaseMixin):
+    def tearDown(self):
+        self.tearDownMongo()
+
+    def test_max_views(self, _ensure_started_mock):
+        dc = datetime.datetime(2015, 8, 25, 3, 59)
+        period = datetime.datetime(2015, 8, 25, 3)
+        histograms = ViewLatencyHistograms(max_views=2)
+        for path in ('view1', 'view2', 'view3', 'view4', 'view1'):
+            histograms.add(path, 0.1, dc)
+        # views of other hours are not counted twice
+        histograms.add('view2', 0.1, dc + datetime.timedelta(minutes=1))
+        self.assertTrue(_ensure_started_mock.called)
+        self.assertEqual(sorted(histograms._histograms), [
+            (OTHER_VIEWS_PATH, period), ('view1', period), ('view2', period),
+            ('view2', period + datetime.timedelta(hours=1)),
+        ])
+        self.assertEqual(histograms._histograms[('view1', period)].count, 2)
+        self.assertEqual(histograms._histograms[(OTHER_VIEWS_PATH, period)].count, 2)
+
+    def test_flush(self, _ensure_started_mock):
+        histograms = ViewLatencyHistograms()
+        histograms.add('view1', 0.1)
+        histograms.add('view1', 1)
+        histograms.flush()
+        self.assertFalse(histograms._histograms)
+
+        histograms.add('view1', 1)
+        histograms.flush()
+
+        rollup = models_mongo.ViewLatencyHistogram.objects.get()
+        self.assertEqual(rollup.view_func_path, 'view1')
+        self.assertEqual(rollup.period, datetime.datetime.now().replace(minute=0, second=0, microsecond=0))
+        self.assertEqual(rollup.count, 3)
+        self.assertAlmostEqual(rollup.duration_sum, 2.1)
+        self.assertEqual(rollup.duration_max, 1)
+        histogram = rollup.get_histogram()
+        self.assertEqual(histogram.count, 3)
+        self.assertEqual(histogram.buckets[LogHistogram.get_index(1)], 2)
+
+    def test_period_of_request(self, _ensure_started_mock):
+        histograms = ViewLatencyHistograms()
+        # request finished before hour boundary is flushed after it
+        histograms.add('view1', 0.1, datetime.datetime(2015, 8, 25, 3, 59, 59))
+        with mock.patch('time_logger.middleware.histograms.datetime') as datetime_mock:
+            datetime_mock.datetime.now.return_value = datetime.datetime(2015, 8, 25, 4, 0, 1)
+            histograms.flush()
+        self.assertEqual(models_mongo.ViewLatencyHistogram.objects.get().period, datetime.datetime(2015, 8, 25, 3))
 
 
 class BaseLogParserTestCase(TestCase):
@@ -674,3 +1811,1007 @@ class MysqlSlowQueriesParserTestCase(TestCase):
         self.assertEqual(parser._cached_line, _get_next_line_mock.return_value)
         self.assertTrue(_get_next_line_mock.called)
         self.assertEqual(result, [line, ])
+
+
+SLOW_LOG = '''\
+/usr/sbin/mysqld, Version: 5.5.40-0ubuntu0.14.04.1-log ((Ubuntu)). started with:
+Tcp port: 3306  Unix socket: /var/run/mysqld/mysqld.sock
+Time                 Id Command    Argument
+# Time: 150825  3:31:06
+# User@Host: test[test] @ localhost [127.0.0.1]
+# Query_time: 3.000123  Lock_time: 0.000045 Rows_sent: 1  Rows_examined: 131758
+use test;
+SET timestamp=1440462666;
+SELECT *
+FROM users
+WHERE name = '\xd1\x82\xd0\xb5\xd1\x81\xd1\x82';
+# User@Host: [app] @ web1 []
+# Query_time: 4.5  Lock_time: 0.1 Rows_sent: 10  Rows_examined: 20
+SET timestamp=1440462666;
+SELECT SLEEP(4.5);
+# Time: 150825  3:31:07
+# User@Host: app[app] @  [10.0.0.2]
+# Query_time: 5.000001  Lock_time: 0.000000 Rows_sent: 0  Rows_examined: 0
+SET timestamp=1440462667;
+UPDATE t SET a = 1;
+
+SELECT 1;
+# Time: 150825  3:31:07
+# User@Host: bad host line
+# Query_time: 6.000001  Lock_time: 0.000000 Rows_sent: 0  Rows_examined: 0
+SET timestamp=1440462667;
+DELETE FROM t;
+'''
+
+BIN_LOG = '''\
+/*!50530 SET @@SESSION.PSEUDO_SLAVE_MODE=1*/;
+/*!40019 SET @@session.max_insert_delayed_threads=0*/;
+/*!50003 SET @OLD_COMPLETION_TYPE=@@COMPLETION_TYPE,COMPLETION_TYPE=0*/;
+DELIMITER /*!*/;
+# at 4
+#150822 13:01:45 server id 192168352  end_log_pos 107 \tStart: binlog v 4, server v 5.5.40-0ubuntu0.14.04.1-log created 150822 13:01:45
+BINLOG '
+KWTYVQ8gXnoLZwAAAGsAAAAAAAQANS41LjQwLTB1YnVudHUwLjE0LjA0LjEtbG9nAAAAAAAAAAAA
+'/*!*/;
+# at 107
+#150822 13:01:45 server id 192168352  end_log_pos 180 \tQuery\tthread_id=3552\texec_time=0\terror_code=0
+SET TIMESTAMP=1440237705/*!*/;
+SET @@session.pseudo_thread_id=3552/*!*/;
+BEGIN
+/*!*/;
+# at 180
+#150822 13:01:45 server id 192168352  end_log_pos 519 \tQuery\tthread_id=3552\texec_time=0\terror_code=0
+use `test`/*!*/;
+SET TIMESTAMP=1440237705/*!*/;
+INSERT INTO t (a, b) VALUES (1, '\xd1\x82\xd0\xb5\xd1\x81\xd1\x82')
+/*!*/;
+# at 519
+#150822 13:01:45 server id 192168352  end_log_pos 546 \tXid = 31
+COMMIT/*!*/;
+# at 546
+#150822 13:01:46 server id 192168352  end_log_pos 620 \tQuery\tthread_id=3553\texec_time=2\terror_code=0
+SET TIMESTAMP=1440237706/*!*/;
+BEGIN
+/*!*/;
+# at 620
+#150822 13:01:46 server id 192168352  end_log_pos 700 \tQuery\tthread_id=3553\texec_time=4294967295\terror_code=0
+SET TIMESTAMP=1440237706/*!*/;
+UPDATE t SET b = 'x' WHERE a = 1
+/*!*/;
+# at 700
+#150822 13:01:46 server id 192168352  end_log_pos 727 \tXid = 32
+COMMIT/*!*/;
+# End of log file
+ROLLBACK /* added by mysqlbinlog */;
+/*!50003 SET COMPLETION_TYPE=@OLD_COMPLETION_TYPE*/;
+/*!50530 SET @@SESSION.PSEUDO_SLAVE_MODE=0*/;
+'''
+
+
+class MmapLogParsersTestCase(TestCase):
+    """
+    Mmap parsers return the same entries as readline parsers
+    """
+
+    def setUp(self):
+        self.log_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.log_dir)
+
+    def _write_log(self, text, name='test.log'):
+        path = os.path.join(self.log_dir, name)
+        with open(path, 'wb') as log_file:
+            log_file.write(text)
+        return path
+
+    def test_slow_log(self):
+        path = self._write_log(SLOW_LOG)
+        entries = list(MysqlSlowQueriesParser(path))
+        self.assertEqual(len(entries), 4)
+        self.assertEqual(list(MmapMysqlSlowQueriesParser(path)), entries)
+
+        # entries are cut into chunks
+        parser = MmapMysqlSlowQueriesParser(path)
+        parser.max_chunk_size = 50
+        self.assertEqual(list(parser), entries)
+
+    def test_slow_log_crlf(self):
+        path = self._write_log(SLOW_LOG.replace('\n', '\r\n'))
+        self.assertEqual(list(MmapMysqlSlowQueriesParser(path)), list(MysqlSlowQueriesParser(path)))
+
+    def test_slow_log_without_headers(self):
+        path = self._write_log(SLOW_LOG.split('\n', 3)[3].rstrip('\n'))
+        self.assertEqual(list(MmapMysqlSlowQueriesParser(path)), list(MysqlSlowQueriesParser(path)))
+
+    def test_bin_log(self):
+        path = self._write_log(BIN_LOG)
+        entries = list(MysqlBinLogParser(path))
+        self.assertEqual([entry['query_type'] for entry in entries], ['INSERT', 'BEGIN', 'UPDATE'])
+        self.assertEqual(list(MmapMysqlBinLogParser(path)), entries)
+
+    def test_lines_iterator(self):
+        path = self._write_log(BIN_LOG)
+        self.assertEqual(list(MysqlBinLogParser(BIN_LOG.splitlines(True))), list(MysqlBinLogParser(path)))
+        path = self._write_log(SLOW_LOG)
+        with open(path) as log_file:
+            self.assertEqual(list(MysqlSlowQueriesParser(log_file)), list(MysqlSlowQueriesParser(path)))
+
+    def test_empty_log(self):
+        path = self._write_log('')
+        self.assertEqual(list(MmapMysqlSlowQueriesParser(path)), [])
+        self.assertEqual(list(MmapMysqlBinLogParser(path)), [])
+        self.assertEqual(list(parse_slow_log_parallel(path, 2)), [])
+
+
+class BinLogCommandTestCase(TestCase, TearDownTestCaseMixin):
+    """
+    Binlogs are decoded by fake mysqlbinlog script, which prints decoded log fixture
+    """
+
+    def setUp(self):
+        self.log_dir = tempfile.mkdtemp()
+        self.binlogs_dir = os.path.join(self.log_dir, 'binlogs') + '/'
+        os.mkdir(self.binlogs_dir)
+        for name in ('mysql-bin.000001', 'mysql-bin.000002', 'mysql-bin.000003', 'mysql-bin.index'):
+            with open(os.path.join(self.binlogs_dir, name), 'w') as log_file:
+                log_file.write(BIN_LOG)
+
+        self.mysqlbinlog = os.path.join(self.log_dir, 'mysqlbinlog')
+        self._write_mysqlbinlog('print(open(sys.argv[-1]).read())')
+
+        patches = [
+            mock.patch('time_logger.management.commands.bin_log_to_mongo.PATH_TO_BINLOGS', self.binlogs_dir),
+            mock.patch('time_logger.management.commands.bin_log_to_mongo.PATH_TO_READABLE_BINLOGS',
+                       os.path.join(self.log_dir, 'readable') + '/'),
+            mock.patch('time_logger.management.commands.bin_log_to_mongo.MYSQLBINLOG', self.mysqlbinlog),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        # indexes are dropped with database of previous tests
+        models_mongo.MysqlBinLogTimeLog.ensure_indexes()
+
+    def tearDown(self):
+        shutil.rmtree(self.log_dir)
+        self.tearDownMongo()
+
+    def _write_mysqlbinlog(self, code):
+        with open(self.mysqlbinlog, 'w') as script:
+            script.write('#!%s\nimport sys\n%s\n' % (sys.executable, code))
+        os.chmod(self.mysqlbinlog, 0o755)
+
+    def _get_log_positions(self):
+        return sorted(models_mongo.MysqlBinLogTimeLog.objects.values_list('log_position'))
+
+    def test_pipe(self):
+        call_command('bin_log_to_mongo')
+        # last binlog is written by mysql
+        self.assertEqual(sorted(models_mongo.ParsedLogsFiles.objects.values_list('file_name')),
+                         ['mysql-bin.000001', 'mysql-bin.000002'])
+        logs = models_mongo.MysqlBinLogTimeLog.objects.filter(log_position__startswith='mysql-bin.000001')
+        self.assertEqual([log.query_type for log in logs.order_by('start_time')], ['INSERT', 'UPDATE'])
+        self.assertEqual(self._get_log_positions(), ['mysql-bin.000001:519', 'mysql-bin.000001:700',
+                                                     'mysql-bin.000002:519', 'mysql-bin.000002:700'])
+        self.assertEqual(models_mongo.QueryDigest.objects.count(), 2)
+        self.assertEqual(sorted(models_mongo.QueryLatencyHistogram.objects.values_list('key', 'count')),
+                         [('INSERT t', 2), ('UPDATE t', 2)])
+        self.assertFalse(models_mongo.BinLogCheckpoint.objects.count())
+
+        # parsed binlogs are skipped
+        call_command('bin_log_to_mongo')
+        self.assertEqual(models_mongo.MysqlBinLogTimeLog.objects.count(), 4)
+
+    def test_mmap(self):
+        call_command('bin_log_to_mongo', engine='mmap')
+        self.assertEqual(models_mongo.MysqlBinLogTimeLog.objects.count(), 4)
+        self.assertEqual(os.listdir(os.path.join(self.log_dir, 'readable')), [])
+
+    def test_workers(self):
+        call_command('bin_log_to_mongo', workers=2, batch_size=1)
+        self.assertEqual(sorted(models_mongo.ParsedLogsFiles.objects.values_list('file_name')),
+                         ['mysql-bin.000001', 'mysql-bin.000002'])
+        self.assertEqual(len(self._get_log_positions()), 4)
+
+    @mock.patch('time_logger.management.commands.bin_log_to_mongo.WORKERS_CHECK_INTERVAL', 0.1)
+    def test_worker_killed(self):
+        parse_binlog = bin_log_to_mongo._parse_binlog
+
+        def _parse_binlog(file_name, *args):
+            if file_name == 'mysql-bin.000002':
+                os.kill(os.getpid(), signal.SIGKILL)
+            return parse_binlog(file_name, *args)
+
+        # workers are forked with patched parser
+        with mock.patch.object(bin_log_to_mongo, '_parse_binlog', side_effect=_parse_binlog):
+            with self.assertRaisesRegexp(Exception, 'exited with code'):
+                call_command('bin_log_to_mongo', workers=2)
+        self.assertNotIn('mysql-bin.000002', models_mongo.ParsedLogsFiles.objects.values_list('file_name'))
+
+    def test_resume(self):
+        inserted = []
+
+        def insert_many_once(document_cls, docs, ignore_duplicates):
+            if inserted:
+                raise Exception('interrupted')
+            inserted.extend(docs)
+            return insert_many(document_cls, docs, ignore_duplicates=ignore_duplicates)
+
+        with mock.patch('time_logger.log_writer.insert_many', insert_many_once):
+            self.assertRaises(Exception, call_command, 'bin_log_to_mongo', log_path='mysql-bin.000001', batch_size=1)
+        self.assertEqual(models_mongo.BinLogCheckpoint.objects.get().end_log_pos, 519)
+
+        # import continues from checkpoint
+        with mock.patch('time_logger.log_writer.insert_many', wraps=insert_many) as insert_many_mock:
+            call_command('bin_log_to_mongo', log_path='mysql-bin.000001', batch_size=1)
+        self.assertEqual(insert_many_mock.call_count, 1)
+        self.assertEqual(insert_many_mock.call_args[0][1][0]['log_position'], 'mysql-bin.000001:700')
+
+        # logs inserted before checkpoint is saved are not duplicated
+        models_mongo.ParsedLogsFiles.objects.delete()
+        out = StringIO()
+        call_command('bin_log_to_mongo', log_path='mysql-bin.000001', stdout=out)
+        self.assertEqual(self._get_log_positions(), ['mysql-bin.000001:519', 'mysql-bin.000001:700'])
+        self.assertIn('MysqlBinLogTimeLog: 2 documents, 0 inserted, 2 duplicates', out.getvalue())
+        self.assertFalse(models_mongo.BinLogCheckpoint.objects.count())
+
+    def test_mysqlbinlog_failed(self):
+        self._write_mysqlbinlog('sys.stdout.write(open(sys.argv[-1]).read()[:100])\nsys.exit(1)')
+        self.assertRaises(Exception, call_command, 'bin_log_to_mongo', log_path='mysql-bin.000001')
+        self.assertFalse(models_mongo.ParsedLogsFiles.objects.count())
+
+
+class ParallelSlowLogParserTestCase(TestCase):
+    def setUp(self):
+        self.log_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.log_dir, 'slow.log')
+        entries_text = SLOW_LOG.split('\n', 3)[3]
+        with open(self.path, 'wb') as log_file:
+            log_file.write(SLOW_LOG + entries_text * 10)
+        self.entries = list(MysqlSlowQueriesParser(self.path))
+
+    def tearDown(self):
+        shutil.rmtree(self.log_dir)
+
+    def test_split(self):
+        ranges, has_blank_lines = split_slow_log(self.path, 100)
+        self.assertTrue(has_blank_lines)
+        self.assertEqual(ranges[0][0], 0)
+        self.assertEqual(ranges[-1][1], os.path.getsize(self.path))
+        with open(self.path, 'rb') as log_file:
+            data = log_file.read()
+        for (start, end), (next_start, _) in zip(ranges, ranges[1:]):
+            self.assertEqual(end, next_start)
+            self.assertTrue(data[next_start:].startswith('# Time:'))
+            # entry without queries loses next '# Time:' line, log is not split there
+            self.assertFalse(data[:next_start - 1].rsplit('\n', 1)[1].startswith('# '))
+
+        entries = []
+        for start, end in ranges:
+            entries.extend(MmapMysqlSlowQueriesParser(self.path, start, end))
+        self.assertEqual(entries, self.entries)
+
+    def test_parallel(self):
+        entries = list(parse_slow_log_parallel(self.path, 2, range_size=100))
+        self.assertEqual(entries, self.entries)
+
+    def test_unordered(self):
+        with open(self.path, 'wb') as log_file:
+            log_file.write(SLOW_LOG.replace('\n\n', '\n') * 10)
+        entries = list(MysqlSlowQueriesParser(self.path))
+
+        result = list(parse_slow_log_parallel(self.path, 2, ordered=False, range_size=100))
+        self.assertItemsEqual(result, entries)
+
+    def test_stopped_by_blank_line(self):
+        with open(self.path, 'ab') as log_file:
+            log_file.write('SELECT 1;\n\n\n' + SLOW_LOG.split('\n', 3)[3])
+        # entries after blank lines are not parsed
+        entries = list(MysqlSlowQueriesParser(self.path))
+        self.assertEqual(len(entries), len(self.entries))
+
+        result = list(parse_slow_log_parallel(self.path, 2, ordered=False, range_size=100))
+        self.assertEqual(result, entries)
+
+
+class SlowLogTailTestCase(TestCase, TearDownTestCaseMixin):
+    def setUp(self):
+        self.log_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.log_dir, 'slow.log')
+        self.entries_text = SLOW_LOG.split('\n', 3)[3].replace('\n\n', '\n')
+        self._write(SLOW_LOG.replace('\n\n', '\n'))
+        # indexes are dropped with database of previous tests
+        models_mongo.MysqlSlowQueriesTimeLog.ensure_indexes()
+
+    def tearDown(self):
+        shutil.rmtree(self.log_dir)
+        self.tearDownMongo()
+
+    def _write(self, text, mode='wb'):
+        with open(self.path, mode) as log_file:
+            log_file.write(text)
+
+    def _read(self):
+        tail = SlowLogTail(self.path)
+        entries = list(tail.read())
+        tail.close()
+        return entries
+
+    def test_read(self):
+        entries = self._read()
+        self.assertEqual(entries, list(MysqlSlowQueriesParser(self.path)))
+        checkpoint = models_mongo.SlowLogCheckpoint.objects.get()
+        self.assertEqual(checkpoint.offset, os.path.getsize(self.path))
+        self.assertEqual(checkpoint.inode, os.stat(self.path).st_ino)
+
+        self.assertEqual(self._read(), [])
+
+    def test_read_new_entries(self):
+        self._read()
+        offset = os.path.getsize(self.path)
+
+        # last line is not written completely
+        self._write(self.entries_text + '# Time: 150825  3:32:00', 'ab')
+        entries = self._read()
+        self.assertEqual(entries, list(MmapMysqlSlowQueriesParser(self.path, offset, offset + len(self.entries_text))))
+        self.assertEqual(len(entries), 3)
+        self.assertEqual(models_mongo.SlowLogCheckpoint.objects.get().offset, offset + len(self.entries_text))
+
+    def test_read_workers(self):
+        tail = SlowLogTail(self.path, workers=4)
+        with mock.patch('multiprocessing.Pool') as pool_mock:
+            # small append is parsed without pool
+            entries = list(tail.read())
+        self.assertFalse(pool_mock.called)
+        self.assertEqual(entries, list(MysqlSlowQueriesParser(self.path)))
+
+        self._write(self.entries_text, 'ab')
+        with mock.patch('time_logger.log_tail.PARALLEL_MIN_SIZE', len(self.entries_text)), \
+                mock.patch('time_logger.log_tail.parse_slow_log_parallel', return_value=iter([])) as parallel_mock:
+            list(tail.read())
+        self.assertTrue(parallel_mock.called)
+        tail.close()
+
+    def test_read_entries_without_time(self):
+        self._read()
+        self.assertEqual(models_mongo.SlowLogCheckpoint.objects.get().last_time,
+                         datetime.datetime(2015, 8, 25, 3, 31, 7))
+
+        # entry of the same second is written without '# Time:' line
+        self._write(self.entries_text.split('# Time: 150825  3:31:07\n')[-1].replace('DELETE', 'INSERT'), 'ab')
+        call_command('slow_logs_from_file', log_path=self.path)
+        log = models_mongo.MysqlSlowQueriesTimeLog.objects.get()
+        self.assertEqual(log.sql_text, 'SET timestamp=1440462667; ;INSERT FROM t;')
+        self.assertEqual(log.start_time, datetime.datetime(2015, 8, 25, 3, 31, 7))
+
+    def test_entries_without_time(self):
+        # log without '# Time:' lines is imported with time of 'SET timestamp=' query
+        self._write(self.entries_text.split('# Time: 150825  3:31:07\n')[-1])
+        entries = self._read()
+        self.assertEqual(entries[0]['start_time'], datetime.datetime.fromtimestamp(1440462667))
+
+        self._write('# User@Host: app[app] @  [10.0.0.2]\n'
+                    '# Query_time: 5.000001  Lock_time: 0.000000 Rows_sent: 0  Rows_examined: 0\n'
+                    'SELECT 1;\n')
+        models_mongo.SlowLogCheckpoint.objects.delete()
+        call_command('slow_logs_from_file', log_path=self.path)
+        self.assertEqual(models_mongo.MysqlSlowQueriesTimeLog.objects.count(), 0)
+        self.assertEqual(models_mongo.SlowLogCheckpoint.objects.get().offset, os.path.getsize(self.path))
+
+    def test_truncated(self):
+        self._read()
+        self._write(self.entries_text)
+        self.assertEqual(len(self._read()), 3)
+
+        # log is truncated and written over checkpoint offset
+        self._write(self.entries_text.replace('DELETE', 'INSERT') + self.entries_text)
+        self.assertEqual(len(self._read()), 6)
+
+    def test_rotated(self):
+        tail = SlowLogTail(self.path)
+        self.assertEqual(len(list(tail.read())), 3)
+
+        # rest of rotated log is read before new log
+        os.rename(self.path, self.path + '.1')
+        with open(self.path + '.1', 'ab') as log_file:
+            log_file.write(self.entries_text)
+        self._write(SLOW_LOG.replace('\n\n', '\n'))
+        self.assertEqual(len(list(tail.read())), 3)
+        self.assertEqual(len(list(tail.read())), 3)
+        self.assertEqual(list(tail.read()), [])
+        tail.close()
+
+        checkpoint = models_mongo.SlowLogCheckpoint.objects.get()
+        self.assertEqual(checkpoint.inode, os.stat(self.path).st_ino)
+        self.assertEqual(checkpoint.offset, os.path.getsize(self.path))
+
+    def test_command(self):
+        call_command('slow_logs_from_file', log_path=self.path)
+        self.assertEqual(models_mongo.MysqlSlowQueriesTimeLog.objects.count(), 3)
+        digest = models_mongo.QueryDigest.objects.get(fingerprint='select * from users where name = ?')
+        self.assertEqual(digest.count, 1)
+        self.assertEqual(models_mongo.MysqlSlowQueriesTimeLog.objects.filter(
+            fingerprint_hash=digest.fingerprint_hash).count(), 1)
+
+        self._write(self.entries_text.replace('150825', '150826'), 'ab')
+        call_command('slow_logs_from_file', log_path=self.path)
+        self.assertEqual(models_mongo.MysqlSlowQueriesTimeLog.objects.count(), 6)
+
+        # imported entries are not read again
+        entries = []
+        with mock.patch('time_logger.management.commands.slow_logs_from_file._import_entries',
+                        side_effect=lambda new_entries, writer: entries.extend(new_entries)):
+            call_command('slow_logs_from_file', log_path=self.path)
+        self.assertEqual(entries, [])
+
+
+    def test_backfilled_fingerprint(self):
+        self._write(self.entries_text.replace('150825', '150826'), 'ab')
+        call_command('slow_logs_from_file', log_path=self.path)
+        period = datetime.datetime(2015, 8, 25, 3)
+        imported = models_mongo.QueryLatencyHistogram.objects.filter(period=period)
+        imported_keys = sorted(imported.values_list('key', 'count'))
+        self.assertEqual(len(imported_keys), 3)
+
+        # histograms of logs imported before digests
+        models_mongo.MysqlSlowQueriesTimeLog.objects.update(unset__fingerprint_hash=True)
+        call_command('backfill_latency_histograms', source=['slow_log'], since='2015-08-25', until='2015-08-26',
+                     stdout=StringIO())
+        self.assertEqual(sorted(imported.values_list('key', 'count')), imported_keys)
+
+
+class QueryDigestTestCase(TestCase, TearDownTestCaseMixin):
+    def tearDown(self):
+        self.tearDownMongo()
+
+    def test_fingerprint(self):
+        self.assertEqual(
+            fingerprint("SELECT  *\nFROM users WHERE name = 'O\\'Brien' AND id IN (1, 2,3) -- comment\n LIMIT 10;"),
+            'select * from users where name = ? and id in(?+) limit ?',
+        )
+        self.assertEqual(
+            fingerprint('INSERT INTO t1 (a, b) VALUES (1, "x"), (2.5, \'y\') /* it\'s a comment */'),
+            'insert into t1 (a, b) values(?+)',
+        )
+        self.assertEqual(
+            fingerprint('use test; SET timestamp=1440462666; SELECT SLEEP(4.5), 0x1F;'),
+            'select sleep(?), ?',
+        )
+        self.assertEqual(fingerprint('select a from t where b in (?)'), 'select a from t where b in(?+)')
+        self.assertEqual(get_statement_fingerprint('use test; ;SET timestamp=1440462666; ;SELECT * ;FROM users;'),
+                         fingerprint('use test; SET timestamp=1440462666; SELECT * FROM users;'))
+
+    def test_fingerprint_hash(self):
+        query_fingerprint = fingerprint('select * from t where id = 1')
+        self.assertEqual(get_fingerprint_hash(query_fingerprint),
+                         get_fingerprint_hash(fingerprint('SELECT *  FROM t WHERE id = 5')))
+        self.assertEqual(len(get_fingerprint_hash(query_fingerprint)), 16)
+        self.assertNotEqual(get_fingerprint_hash(query_fingerprint), get_fingerprint_hash('select 1'))
+
+    def test_collector(self):
+        dc = datetime.datetime(2015, 8, 25, 3, 31, 6)
+        digests = QueryDigestCollector(models_mongo.QueryDigest.SLOW_LOG_SOURCE)
+        fingerprint_hash = digests.add('select * from t where id = 1', 1.5, 0.1, 10, dc)
+        self.assertEqual(digests.add('select * from t where id = 2', 0.5, 0.2, 20, dc - datetime.timedelta(hours=1)),
+                         fingerprint_hash)
+        digests.flush()
+        digests.add('select * from t where id = 3', 2, 0, 30, dc + datetime.timedelta(hours=1))
+        digests.flush()
+
+        digest = models_mongo.QueryDigest.objects.get()
+        self.assertEqual(digest.fingerprint_hash, fingerprint_hash)
+        self.assertEqual(digest.fingerprint, 'select * from t where id = ?')
+        self.assertEqual(digest.example, 'select * from t where id = 3')
+        self.assertEqual(digest.count, 3)
+        self.assertEqual(digest.query_time_sum, 4)
+        self.assertEqual(digest.query_time_max, 2)
+        self.assertAlmostEqual(digest.lock_time_sum, 0.3)
+        self.assertEqual(digest.rows_examined_sum, 60)
+        self.assertEqual(digest.first_seen, dc - datetime.timedelta(hours=1))
+        self.assertEqual(digest.last_seen, dc + datetime.timedelta(hours=1))
+        self.assertEqual(digest.get_query_time_avg(), 4 / 3.0)
+
+        # hourly histograms of fingerprint
+        histograms = models_mongo.QueryLatencyHistogram.objects.order_by('period')
+        self.assertEqual([(histogram.source, histogram.key, histogram.period, histogram.count, histogram.duration_max)
+                          for histogram in histograms], [
+            ('slow_log', fingerprint_hash, datetime.datetime(2015, 8, 25, 2), 1, 0.5),
+            ('slow_log', fingerprint_hash, datetime.datetime(2015, 8, 25, 3), 1, 1.5),
+            ('slow_log', fingerprint_hash, datetime.datetime(2015, 8, 25, 4), 1, 2),
+        ])
+
+    def test_get_table(self):
+        self.assertEqual(get_table('INSERT INTO `db`.`t1` (a) VALUES (1)'), 'db.t1')
+        self.assertEqual(get_table('update ignore t2 set a = 1'), 't2')
+        self.assertEqual(get_table('  DELETE FROM t3 WHERE id = 1'), 't3')
+        self.assertIsNone(get_table('select * from t4'))
+
+
+class SlowLogsFromDbTestCase(TestCase, TearDownTestCaseMixin):
+    """
+    mysql.slow_log rows are returned by mock cursor
+    """
+
+    def setUp(self):
+        models_mongo.MysqlSlowQueriesTimeLog.ensure_indexes()
+        self.fields = ('start_time', 'user_host', 'query_time', 'lock_time', 'rows_sent', 'rows_examined', 'db',
+                       'sql_text')
+        self.rows = [
+            (datetime.datetime(2015, 8, 25, 3, 31, i), u'root[root] @ localhost []', datetime.time(0, 0, 3 + i),
+             datetime.time(0, 0, 0), 1, 10, u'test', u'select sleep(%s)' % i)
+            for i in range(5)
+        ]
+
+        self.connections = {}
+        self.cursor = self._add_connection('mysql')
+        patch = mock.patch('time_logger.management.commands.slow_logs_from_db.connections', self.connections)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def tearDown(self):
+        self.tearDownMongo()
+
+    def _add_connection(self, alias):
+        cursor = mock.Mock(description=[(field, ) for field in self.fields])
+        cursor.fetchone.return_value = (0, )
+        connection = self.connections[alias] = mock.Mock(vendor='sqlite')
+        connection.cursor.return_value = cursor
+        return cursor
+
+    def _fetch_by(self, rows, chunk_size, cursor=None):
+        chunks = [rows[i:i + chunk_size] for i in range(0, len(rows), chunk_size)]
+        (cursor or self.cursor).fetchmany.side_effect = chunks + [[]]
+
+    def test_import(self):
+        self._fetch_by(self.rows, 2)
+        out = StringIO()
+        call_command('slow_logs_from_db', database=['mysql'], batch_size=2, stdout=out)
+        self.cursor.execute.assert_called_with('SELECT * FROM mysql.slow_log ORDER BY start_time', [])
+        self.cursor.fetchmany.assert_called_with(2)
+        self.assertTrue(self.cursor.close.called)
+
+        logs = models_mongo.MysqlSlowQueriesTimeLog.objects.order_by('start_time')
+        self.assertEqual([log.query_time for log in logs], [3, 4, 5, 6, 7])
+        self.assertEqual(logs[0].end_time, datetime.datetime(2015, 8, 25, 3, 31, 3))
+        self.assertEqual(models_mongo.QueryDigest.objects.get().count, 5)
+        self.assertIn('5 inserted', out.getvalue())
+
+        # import continues from latest imported query, it is not duplicated
+        self._fetch_by(self.rows[4:], 2)
+        call_command('slow_logs_from_db', database=['mysql'], stdout=StringIO())
+        self.cursor.execute.assert_called_with(
+            'SELECT * FROM mysql.slow_log WHERE start_time >= %s ORDER BY start_time', [self.rows[4][0]])
+        self.assertEqual(models_mongo.MysqlSlowQueriesTimeLog.objects.count(), 5)
+
+    def test_window(self):
+        self._fetch_by(self.rows[:2], 1000)
+        call_command('slow_logs_from_db', database=['mysql'], since='2015-08-25', limit=2, stdout=StringIO())
+        self.cursor.execute.assert_called_with(
+            'SELECT * FROM mysql.slow_log WHERE start_time >= %s ORDER BY start_time LIMIT %s',
+            [datetime.datetime(2015, 8, 25), 2],
+        )
+        self.assertEqual(models_mongo.MysqlSlowQueriesTimeLog.objects.count(), 2)
+
+    def test_window_of_one_second(self):
+        rows = [self.rows[0][:1] + row[1:] for row in self.rows]
+        self._fetch_by(rows[:2], 1000)
+        call_command('slow_logs_from_db', database=['mysql'], limit=2, stdout=StringIO())
+        self.assertEqual(models_mongo.MysqlSlowQueriesTimeLog.objects.count(), 2)
+
+        # imported rows of the latest second are not counted by limit
+        self.cursor.fetchone.return_value = (2, )
+        self._fetch_by(rows[:4], 1000)
+        call_command('slow_logs_from_db', database=['mysql'], limit=2, stdout=StringIO())
+        self.assertEqual(self.cursor.execute.call_args_list[-2], mock.call(
+            'SELECT COUNT(*) FROM mysql.slow_log WHERE start_time = %s', [rows[0][0]]))
+        self.cursor.execute.assert_called_with(
+            'SELECT * FROM mysql.slow_log WHERE start_time >= %s ORDER BY start_time LIMIT %s', [rows[0][0], 4])
+        self.assertEqual(models_mongo.MysqlSlowQueriesTimeLog.objects.count(), 4)
+
+    def test_durations(self):
+        # drivers return TIME(6) as timedelta or time
+        self.rows[0] = self.rows[0][:2] + (datetime.timedelta(seconds=75, microseconds=250000),
+                                           datetime.time(0, 0, 0, 125)) + self.rows[0][4:]
+        self.rows[1] = self.rows[1][:2] + (datetime.time(1, 1, 15, 500000), 0.5) + self.rows[1][4:]
+        self._fetch_by(self.rows[:2], 1000)
+        call_command('slow_logs_from_db', database=['mysql'], stdout=StringIO())
+
+        log1, log2 = models_mongo.MysqlSlowQueriesTimeLog.objects.order_by('start_time')
+        self.assertEqual((log1.query_time, log1.lock_time), (75.25, 0.000125))
+        self.assertEqual(log1.end_time, self.rows[0][0] + datetime.timedelta(seconds=75, microseconds=250000))
+        self.assertEqual((log2.query_time, log2.lock_time), (3675.5, 0.5))
+
+    def test_servers(self):
+        replica_cursor = self._add_connection('replica')
+        failed_cursor = self._add_connection('failed')
+        failed_cursor.execute.side_effect = Exception('Connection refused')
+
+        self._fetch_by(self.rows[:2], 1000)
+        self._fetch_by(self.rows, 1000, replica_cursor)
+        out = StringIO()
+        with mock.patch('time_logger.management.commands.slow_logs_from_db.logger'):
+            self.assertRaises(Exception, call_command, 'slow_logs_from_db', database=['mysql', 'replica', 'failed'],
+                              stdout=out)
+        self.assertIn('mysql: MysqlSlowQueriesTimeLog: 2 documents', out.getvalue())
+        self.assertIn('replica: MysqlSlowQueriesTimeLog: 5 documents', out.getvalue())
+        self.assertEqual(models_mongo.MysqlSlowQueriesTimeLog.objects.filter(server='mysql').count(), 2)
+        self.assertEqual(models_mongo.MysqlSlowQueriesTimeLog.objects.filter(server='replica').count(), 5)
+        self.assertTrue(self.connections['mysql'].close.called)
+
+        # every server is imported from its latest query
+        self._fetch_by([], 1000)
+        self._fetch_by([], 1000, replica_cursor)
+        call_command('slow_logs_from_db', database=['mysql', 'replica'], threads=1, stdout=StringIO())
+        query = 'SELECT * FROM mysql.slow_log WHERE start_time >= %s ORDER BY start_time'
+        self.cursor.execute.assert_called_with(query, [self.rows[1][0]])
+        replica_cursor.execute.assert_called_with(query, [self.rows[4][0]])
+
+
+class BatchWriterTestCase(TestCase, TearDownTestCaseMixin):
+    def setUp(self):
+        models_mongo.MysqlSlowQueriesTimeLog.ensure_indexes()
+
+    def tearDown(self):
+        self.tearDownMongo()
+
+    def _get_fields(self, i):
+        return {'start_time': datetime.datetime(2015, 8, 25, 3, 31, i), 'query_time': 1, 'sql_text': u'select %s' % i}
+
+    def test_content_hash(self):
+        fields = self._get_fields(1)
+        self.assertEqual(log_writer.get_content_hash(fields), log_writer.get_content_hash(dict(fields)))
+        self.assertNotEqual(log_writer.get_content_hash(fields), log_writer.get_content_hash(self._get_fields(2)))
+        self.assertEqual(log_writer.get_content_hash({'sql_text': '\xd1\x84'}),
+                         log_writer.get_content_hash({'sql_text': u'\u0444'}))
+
+    def test_batches(self):
+        inserted = []
+        writer = log_writer.BatchWriter(models_mongo.MysqlSlowQueriesTimeLog, batch_size=2,
+                                        on_insert=lambda document, context: inserted.append(context))
+        with mock.patch('time_logger.log_writer.insert_many', wraps=insert_many) as insert_many_mock:
+            for i in range(3):
+                writer.add(self._get_fields(i), i)
+            self.assertEqual(insert_many_mock.call_count, 1)
+            writer.flush()
+            self.assertEqual(insert_many_mock.call_count, 2)
+        self.assertEqual(inserted, [0, 1, 2])
+        self.assertEqual(models_mongo.MysqlSlowQueriesTimeLog.objects.count(), 3)
+        self.assertEqual(models_mongo.MysqlSlowQueriesTimeLog.objects.order_by('start_time')[0].content_hash,
+                         log_writer.get_content_hash(self._get_fields(0)))
+
+    def test_duplicates(self):
+        writer = log_writer.BatchWriter(models_mongo.MysqlSlowQueriesTimeLog)
+        writer.add(self._get_fields(0))
+        writer.flush()
+
+        inserted = []
+        writer = log_writer.BatchWriter(models_mongo.MysqlSlowQueriesTimeLog,
+                                        on_insert=lambda document, context: inserted.append(document.sql_text))
+        for i in (0, 1, 1):
+            writer.add(self._get_fields(i))
+        writer.flush()
+        self.assertEqual(inserted, [u'select 1'])
+        self.assertEqual(models_mongo.MysqlSlowQueriesTimeLog.objects.count(), 2)
+        self.assertTrue(writer.get_report().startswith(
+            'MysqlSlowQueriesTimeLog: 3 documents, 1 inserted, 2 duplicates in '))
+
+    def test_concurrent_duplicates(self):
+        def import_concurrently(document, context):
+            # document is imported by other process after imported documents are checked
+            if context == 0:
+                models_mongo.MysqlSlowQueriesTimeLog(**document.to_mongo().to_dict()).save()
+
+        writer = log_writer.BatchWriter(models_mongo.MysqlSlowQueriesTimeLog, on_insert=import_concurrently)
+        for i in range(3):
+            writer.add(self._get_fields(i), i)
+        writer.flush()
+        self.assertEqual(models_mongo.MysqlSlowQueriesTimeLog.objects.count(), 3)
+        self.assertEqual(writer.inserted, 2)
+
+    def test_insert_many_count(self):
+        docs = [models_mongo.MysqlSlowQueriesTimeLog(content_hash=str(i), **self._get_fields(i)).to_mongo()
+                for i in (0, 1, 1)]
+        self.assertEqual(insert_many(models_mongo.MysqlSlowQueriesTimeLog, docs[:1]), 1)
+        self.assertEqual(insert_many(models_mongo.MysqlSlowQueriesTimeLog, docs[1:], ignore_duplicates=True), 1)
+
+
+class RetentionTestCase(TestCase, TearDownTestCaseMixin):
+    def tearDown(self):
+        self.tearDownMongo()
+
+    def _get_collection(self, indexes):
+        collection = mock.Mock()
+        collection.name = 'view_time_log'
+        collection.index_information.return_value = indexes
+        return collection
+
+    def test_retention_index(self):
+        with self.settings(LOG_VIEW_TIME_TTL_DAYS={'ViewTimeLog': 30, 'MysqlBinLogTimeLog': 0.5}):
+            self.assertEqual(models_mongo.get_retention_index('ViewTimeLog', 'dc'),
+                             {'fields': ['dc'], 'expireAfterSeconds': 30 * 86400})
+            self.assertEqual(models_mongo.get_ttl_seconds('MysqlBinLogTimeLog'), 43200)
+            self.assertEqual(models_mongo.get_retention_index('MysqlSlowQueriesTimeLog', 'start_time'), 'start_time')
+
+    def test_apply_ttl_index(self):
+        collection = self._get_collection({})
+        self.assertEqual(retention.apply_ttl_index(collection, 'dc', 60), retention.CREATED)
+        collection.create_index.assert_called_with([('dc', 1)], expireAfterSeconds=60, background=True)
+
+        collection = self._get_collection({'dc_1': {'key': [('dc', 1)], 'expireAfterSeconds': 60}})
+        self.assertEqual(retention.apply_ttl_index(collection, 'dc', 60), retention.UNCHANGED)
+        self.assertEqual(retention.apply_ttl_index(collection, 'dc', 120), retention.UPDATED)
+        collection.database.command.assert_called_with(
+            'collMod', 'view_time_log', index={'keyPattern': {'dc': 1}, 'expireAfterSeconds': 120})
+        self.assertFalse(collection.drop_index.called)
+
+        self.assertEqual(retention.apply_ttl_index(collection, 'dc', None), retention.REMOVED)
+        collection.drop_index.assert_called_with('dc_1')
+        collection.create_index.assert_called_with([('dc', 1)], background=True)
+
+        # ordinary index is rebuilt as TTL index
+        collection = self._get_collection({'dc_1': {'key': [('dc', 1)]}})
+        self.assertEqual(retention.apply_ttl_index(collection, 'dc', None), retention.UNCHANGED)
+        self.assertEqual(retention.apply_ttl_index(collection, 'dc', 60), retention.UPDATED)
+        collection.drop_index.assert_called_with('dc_1')
+        collection.create_index.assert_called_with([('dc', 1)], expireAfterSeconds=60, background=True)
+
+    def test_command(self):
+        self.assertRaises(Exception, call_command, 'remove_old_logs')
+
+        out = StringIO()
+        with self.settings(LOG_VIEW_TIME_TTL_DAYS={'ViewTimeLog': 30}):
+            with mock.patch('time_logger.retention.apply_ttl_index', return_value=retention.UPDATED) as apply_mock:
+                call_command('remove_old_logs', ttl=True, stdout=out)
+        self.assertIn('ViewTimeLog.dc: updated\n', out.getvalue())
+        self.assertIn('MysqlBinLogTimeLog.start_time: updated\n', out.getvalue())
+        self.assertEqual([call[0][1:] for call in apply_mock.call_args_list][:2], [('dc', 30 * 86400), ('dc', None)])
+
+    def _create_view_logs(self):
+        now = datetime.datetime.now()
+        logs = [models_mongo.ViewTimeLog.objects.create(view_func_path='test') for _ in range(5)]
+        # logs are expired out of _id order
+        for i, log in enumerate(logs):
+            days = 40 if i != 2 else 1
+            models_mongo.ViewTimeLog.objects(pk=log.pk).update(set__dc=now - datetime.timedelta(days=days))
+        return logs
+
+    def test_iter_delete_expired(self):
+        logs = self._create_view_logs()
+        expire_date = datetime.datetime.now() - datetime.timedelta(days=30)
+        with mock.patch('time_logger.retention.time.sleep') as sleep_mock:
+            removed = list(retention.iter_delete_expired(models_mongo.ViewTimeLog, 'dc', expire_date, chunk_size=2,
+                                                         sleep=0.5))
+        self.assertEqual(removed, [2, 2])
+        sleep_mock.assert_called_with(0.5)
+        self.assertEqual(list(models_mongo.ViewTimeLog.objects.all()), [logs[2]])
+
+    def test_remove_old_logs(self):
+        self._create_view_logs()
+        now = datetime.datetime.now()
+        for period in (now - datetime.timedelta(days=40), now):
+            models_mongo.ViewLatencyHistogram.add('app.views.list', get_period(period), LogHistogram())
+        out = StringIO()
+        call_command('remove_old_logs', expire_day=30, dry_run=True, stdout=out)
+        self.assertIn('ViewTimeLog: 4 logs to remove\n', out.getvalue())
+        self.assertIn('MysqlBinLogTimeLog: 0 logs to remove\n', out.getvalue())
+        self.assertIn('ViewLatencyHistogram: 1 logs to remove\n', out.getvalue())
+        self.assertIn('QueryLatencyHistogram: 0 logs to remove\n', out.getvalue())
+        self.assertEqual(models_mongo.ViewTimeLog.objects.count(), 5)
+
+        out = StringIO()
+        call_command('remove_old_logs', expire_day=30, chunk_size=3, sleep=0, stdout=out)
+        self.assertIn('ViewTimeLog: 3/4 logs removed\nViewTimeLog: 4/4 logs removed\n', out.getvalue())
+        self.assertEqual(models_mongo.ViewTimeLog.objects.count(), 1)
+        self.assertEqual(models_mongo.ViewLatencyHistogram.objects.count(), 1)
+
+
+class CollectorTestCase(TestCase, TearDownTestCaseMixin):
+    def setUp(self):
+        self.log_dir = tempfile.mkdtemp()
+        self.slow_log_path = os.path.join(self.log_dir, 'slow.log')
+        with open(self.slow_log_path, 'w') as log_file:
+            log_file.write(SLOW_LOG.replace('\n\n', '\n'))
+
+        self.binlogs_dir = os.path.join(self.log_dir, 'binlogs') + '/'
+        os.mkdir(self.binlogs_dir)
+        for name in ('mysql-bin.000001', 'mysql-bin.000002'):
+            self._write_binlog(name)
+        mysqlbinlog = os.path.join(self.log_dir, 'mysqlbinlog')
+        with open(mysqlbinlog, 'w') as script:
+            script.write('#!%s\nimport sys\nprint(open(sys.argv[-1]).read())\n' % sys.executable)
+        os.chmod(mysqlbinlog, 0o755)
+
+        patches = [
+            mock.patch('time_logger.management.commands.bin_log_to_mongo.PATH_TO_BINLOGS', self.binlogs_dir),
+            mock.patch('time_logger.management.commands.bin_log_to_mongo.MYSQLBINLOG', mysqlbinlog),
+            # collector waits interval between cycles
+            mock.patch('time_logger.collector.pyinotify', None),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        # indexes are dropped with database of previous tests
+        models_mongo.MysqlSlowQueriesTimeLog.ensure_indexes()
+        models_mongo.MysqlBinLogTimeLog.ensure_indexes()
+
+    def tearDown(self):
+        shutil.rmtree(self.log_dir)
+        self.tearDownMongo()
+
+    def _write_binlog(self, name):
+        with open(os.path.join(self.binlogs_dir, name), 'w') as log_file:
+            log_file.write(BIN_LOG)
+
+    def test_collect(self):
+        binlogs = BinLogSource()
+        collector = Collector([SlowLogSource(self.slow_log_path), binlogs])
+        collector.collect()
+        self.assertEqual(models_mongo.MysqlSlowQueriesTimeLog.objects.count(), 3)
+        # last binlog is written by mysql
+        self.assertEqual(models_mongo.MysqlBinLogTimeLog.objects.count(), 2)
+        self.assertEqual(models_mongo.QueryDigest.objects.count(), 5)
+
+        with open(self.slow_log_path, 'a') as log_file:
+            log_file.write(SLOW_LOG.split('\n', 3)[3].replace('\n\n', '\n').replace('150825', '150826'))
+        # binlogs are not listed without changes of directory
+        with mock.patch('time_logger.management.commands.bin_log_to_mongo.get_new_binlog_file_names') as names_mock:
+            collector.collect()
+        self.assertFalse(names_mock.called)
+        self.assertEqual(models_mongo.MysqlSlowQueriesTimeLog.objects.count(), 6)
+
+        binlogs._mtime -= 1
+        self._write_binlog('mysql-bin.000003')
+        collector.collect()
+        self.assertEqual(models_mongo.MysqlBinLogTimeLog.objects.count(), 4)
+        self.assertEqual(binlogs.get_counts(), (4, 4))
+
+    def test_collect_entries_without_time(self):
+        collector = Collector([SlowLogSource(self.slow_log_path)])
+        collector.collect()
+
+        # entry of the same second as the last imported one
+        with open(self.slow_log_path, 'a') as log_file:
+            log_file.write(SLOW_LOG.split('# Time: 150825  3:31:07\n')[-1].replace('DELETE', 'INSERT'))
+        collector.collect()
+        log = models_mongo.MysqlSlowQueriesTimeLog.objects.get(sql_text__contains='INSERT')
+        self.assertEqual(log.start_time, datetime.datetime(2015, 8, 25, 3, 31, 7))
+
+    def test_slow_log_table_thread(self):
+        import_started = threading.Event()
+        import_release = threading.Event()
+
+        def import_servers(aliases, batch_size):
+            import_started.set()
+            import_release.wait(5)
+            return [mock.Mock(added=2, inserted=1), None]
+
+        source = SlowLogTableSource(['default', 'replica'], interval=60)
+        with mock.patch('time_logger.management.commands.slow_logs_from_db.import_servers',
+                        side_effect=import_servers):
+            # collector loop is not blocked by import of tables
+            source.collect()
+            self.assertTrue(import_started.wait(5))
+            source.collect()
+            self.assertEqual(source.get_counts(), (0, 0))
+
+            import_release.set()
+            source.close()
+        self.assertFalse(source._thread.is_alive())
+        self.assertEqual(source.get_counts(), (2, 1))
+
+    def test_collect_error(self):
+        failed_source = mock.Mock(collect=mock.Mock(side_effect=Exception), watch_path=None)
+        failed_source.name = 'failed'
+        collector = Collector([failed_source, SlowLogSource(self.slow_log_path)])
+        with mock.patch('time_logger.collector.logger') as logger_mock:
+            collector.collect()
+        logger_mock.exception.assert_called_once_with('Failed to collect %s', 'failed')
+        self.assertEqual(models_mongo.MysqlSlowQueriesTimeLog.objects.count(), 3)
+
+    def test_command(self):
+        handlers = {}
+
+        def collect(collector):
+            # shutdown by signal after first cycle
+            original_collect(collector)
+            handlers[signal.SIGTERM](signal.SIGTERM, None)
+
+        original_collect = Collector.collect
+        out = StringIO()
+        with mock.patch('signal.signal', side_effect=handlers.__setitem__), \
+                mock.patch.object(Collector, 'collect', autospec=True, side_effect=collect):
+            call_command('time_logger_collector', log_path=self.slow_log_path, binlogs=True, stdout=out)
+        self.assertEqual(models_mongo.MysqlSlowQueriesTimeLog.objects.count(), 3)
+        self.assertEqual(models_mongo.MysqlBinLogTimeLog.objects.count(), 2)
+        self.assertIn(signal.SIGINT, handlers)
+        self.assertRegexpMatches(out.getvalue(), r'^slow_log: 3 documents, 3 inserted \([0-9.]+ inserted/s\); '
+                                                 r'bin_log: 2 documents, 2 inserted ')
+
+        with self.assertRaises(Exception):
+            call_command('time_logger_collector')
+
+
+class BackfillLatencyHistogramsTestCase(TestCase, TearDownTestCaseMixin):
+    def setUp(self):
+        self.period = datetime.datetime(2015, 8, 25, 3)
+
+    def tearDown(self):
+        self.tearDownMongo()
+
+    def test_queries(self):
+        for minute, query_time in ((1, 1.5), (2, 0.5)):
+            models_mongo.MysqlSlowQueriesTimeLog.objects.create(
+                start_time=self.period + datetime.timedelta(minutes=minute), query_time=query_time,
+                sql_text='select * from t where id = %s' % minute)
+        for hours in (0, 1):
+            models_mongo.MysqlBinLogTimeLog.objects.create(start_time=self.period + datetime.timedelta(hours=hours),
+                                                           exec_time=2, query='UPDATE t SET a = 1', query_type='UPDATE')
+        # hour of the latest log is still imported
+        models_mongo.MysqlSlowQueriesTimeLog.objects.create(
+            start_time=self.period + datetime.timedelta(hours=1), query_time=1, sql_text='select 1')
+        # histogram of backfilled hour is replaced
+        models_mongo.QueryLatencyHistogram.objects.create(source='slow_log', key='old', period=self.period, count=1)
+        # histograms of hours without logs are kept
+        models_mongo.QueryLatencyHistogram.objects.create(
+            source='slow_log', key='expired', period=self.period - datetime.timedelta(hours=1), count=1)
+
+        out = StringIO()
+        call_command('backfill_latency_histograms', source=['slow_log', 'bin_log'], since='2015-08-25', stdout=out)
+        self.assertEqual(out.getvalue(), 'slow_log: 2 logs\nbin_log: 1 logs\n')
+
+        histogram = models_mongo.QueryLatencyHistogram.objects.get(source='slow_log', period=self.period)
+        self.assertEqual(histogram.key, get_fingerprint_hash('select * from t where id = ?'))
+        self.assertEqual((histogram.period, histogram.count, histogram.duration_sum, histogram.duration_max),
+                         (self.period, 2, 2, 1.5))
+        histogram = models_mongo.QueryLatencyHistogram.objects.get(source='bin_log')
+        self.assertEqual((histogram.key, histogram.period, histogram.count), ('UPDATE t', self.period, 1))
+        self.assertEqual(models_mongo.QueryLatencyHistogram.objects.filter(source='slow_log').count(), 2)
+        self.assertEqual(models_mongo.QueryLatencyHistogram.objects.get(key='expired').count, 1)
+
+        # logs after until are not added
+        call_command('backfill_latency_histograms', source=['slow_log'], since='2015-08-25',
+                     until='2015-08-25 03:00:00', stdout=out)
+        self.assertEqual(models_mongo.QueryLatencyHistogram.objects.get(source='slow_log', period=self.period).count, 2)
+
+    def test_queries_covered_hours(self):
+        for hours in (0, 1, 2):
+            models_mongo.MysqlSlowQueriesTimeLog.objects.create(
+                start_time=self.period + datetime.timedelta(hours=hours, minutes=1), query_time=1, sql_text='select 1')
+        replica_log = models_mongo.MysqlSlowQueriesTimeLog.objects.create(
+            start_time=self.period + datetime.timedelta(hours=2, minutes=5), query_time=1, sql_text='select 2',
+            server='replica')
+        models_mongo.QueryLatencyHistogram.objects.create(source='slow_log', key='old', period=self.period, count=1)
+
+        # the first hour can be partly removed by retention, it is kept without since
+        out = StringIO()
+        call_command('backfill_latency_histograms', source=['slow_log'], stdout=out)
+        self.assertEqual(out.getvalue(), 'slow_log: 1 logs\n')
+        self.assertEqual(
+            sorted(models_mongo.QueryLatencyHistogram.objects.values_list('period', 'key')),
+            [(self.period, 'old'), (self.period + datetime.timedelta(hours=1), get_fingerprint_hash('select ?'))],
+        )
+
+        # slow_log of replica is still imported in previous hour
+        replica_log.start_time -= datetime.timedelta(hours=1)
+        replica_log.save()
+        out = StringIO()
+        call_command('backfill_latency_histograms', source=['slow_log'], stdout=out)
+        self.assertEqual(out.getvalue(), 'slow_log: 0 logs\n')
+
+    def test_views(self):
+        for view_func_path, hours in (('view1', 0), ('view1', 1), ('view2', 0)):
+            models_mongo.ViewTimeLog.objects.create(view_func_path=view_func_path, duration=2,
+                                                    dc=self.period + datetime.timedelta(hours=hours))
+        # histograms of all requests collected by middleware are kept
+        histogram = LogHistogram()
+        histogram.add(0.1)
+        models_mongo.ViewLatencyHistogram.add('view1', self.period, histogram)
+
+        out = StringIO()
+        call_command('backfill_latency_histograms', source=['view'], since='2015-08-25', stdout=out)
+        self.assertEqual(out.getvalue(), 'view: 2 logs\n')
+        self.assertEqual(
+            sorted(models_mongo.ViewLatencyHistogram.objects.values_list('view_func_path', 'period', 'duration_max')),
+            [('view1', self.period, 0.1), ('view1', self.period + datetime.timedelta(hours=1), 2),
+             ('view2', self.period, 2)],
+        )
@@ -0,0 +1,14 @@
+# coding: utf-8
+import unittest
+
+import django
+
+# MIDDLEWARE with async views is supported since django 3.1 (python 3), run tests by
+# $ python runtests.py time_logger.tests_async
+if django.VERSION >= (3, 1):
+    from time_logger.async_tests import *  # noqa
+else:
+    @unittest.skip('async middleware requires django >= 3.1')
+    class ViewTimeLoggerMiddlewareTestCase(unittest.TestCase):
+        def test_async_view(self):
+            pass
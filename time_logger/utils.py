@@ -0,0 +1,6 @@
+# coding: utf-8
+import time
+
+# monotonic high resolution clock, python 2 has only time.time which is changed by clock adjustments,
+# so differences of its values can be negative
+timer = getattr(time, 'perf_counter', time.time)
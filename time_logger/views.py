@@ -1,10 +1,12 @@
 # coding: utf-8
 import datetime
+import re
 from django.views.generic import TemplateView, DetailView
 from django.views.generic.list import MultipleObjectMixin
 
 from . import forms
 from . import models_mongo
+from .histogram import get_period
 
 
 class ViewsLog(MultipleObjectMixin, TemplateView):
@@ -61,6 +63,8 @@ class SlowQueriesLog(MultipleObjectMixin, TemplateView):
     form_class = forms.SlowQueriesLog
     template_name = 'time_logger/slow_queries_log.html'
     paginate_by = 30
+    # percentiles of more queries are read from hourly histograms of latency page
+    percentiles_max_count = 100000
 
     def get_context_data(self, **kwargs):
         context = {}
@@ -69,6 +73,11 @@ class SlowQueriesLog(MultipleObjectMixin, TemplateView):
         if self.form.is_valid():
             self.object_list = self.get_queryset()
             context = super(SlowQueriesLog, self).get_context_data(**kwargs)
+            percentiles = models_mongo.MysqlSlowQueriesTimeLog.get_query_time_percentiles(
+                self.object_list, max_count=self.percentiles_max_count)
+            context['query_time_percentiles'] = percentiles
+            context['percentiles_skipped'] = percentiles is None
+            context['percentiles_max_count'] = self.percentiles_max_count
 
         context['form'] = self.form
         return context
@@ -76,6 +85,8 @@ class SlowQueriesLog(MultipleObjectMixin, TemplateView):
     def get_queryset(self):
         params = self.get_queryset_params()
         qs = models_mongo.MysqlSlowQueriesTimeLog.objects.filter(**params)
+        if self.form.cleaned_data.get('order'):
+            qs = qs.order_by(self.form.cleaned_data['order'])
         return qs
 
     def get_queryset_params(self):
@@ -83,6 +94,9 @@ class SlowQueriesLog(MultipleObjectMixin, TemplateView):
         if self.form.cleaned_data.get('min_query_time'):
             params['query_time__gte'] = self.form.cleaned_data['min_query_time']
 
+        if self.form.cleaned_data.get('server'):
+            params['server'] = self.form.cleaned_data['server']
+
         if self.form.cleaned_data.get('min_dc'):
             params['start_time__gte'] = _date_to_datetime(self.form.cleaned_data['min_dc'])
 
@@ -127,6 +141,130 @@ class BinLog(MultipleObjectMixin, TemplateView):
         return params
 
 
+class QueryDigests(MultipleObjectMixin, TemplateView):
+    form_class = forms.QueryDigests
+    template_name = 'time_logger/query_digests.html'
+    paginate_by = 30
+
+    def get_context_data(self, **kwargs):
+        context = {}
+
+        self.form = self.form_class(self.request.GET or None)
+        if self.form.is_valid():
+            self.object_list = self.get_queryset()
+            context = super(QueryDigests, self).get_context_data(**kwargs)
+
+        context['form'] = self.form
+        return context
+
+    def get_queryset(self):
+        params = self.get_queryset_params()
+        # the most expensive query shapes first
+        qs = models_mongo.QueryDigest.objects.filter(**params).order_by('-query_time_sum')
+        return qs
+
+    def get_queryset_params(self):
+        params = {}
+        if self.form.cleaned_data.get('source'):
+            params['source'] = self.form.cleaned_data['source']
+
+        if self.form.cleaned_data.get('fingerprint'):
+            params['fingerprint__contains'] = self.form.cleaned_data['fingerprint'].lower()
+
+        if self.form.cleaned_data.get('min_dc'):
+            params['last_seen__gte'] = _date_to_datetime(self.form.cleaned_data['min_dc'])
+
+        if self.form.cleaned_data.get('max_dc'):
+            params['first_seen__lte'] = _date_to_datetime_lte(self.form.cleaned_data['max_dc'])
+
+        return params
+
+
+class LatencyHistograms(MultipleObjectMixin, TemplateView):
+    """
+    Count, total, max and percentiles of durations merged from hourly histograms of views or queries.
+    Without dates only histograms of last default_window are merged.
+    """
+    form_class = forms.LatencyHistograms
+    template_name = 'time_logger/latency_histograms.html'
+    paginate_by = 30
+    percents = (50, 95, 99)
+    default_window = datetime.timedelta(hours=24)
+
+    def get_context_data(self, **kwargs):
+        context = {}
+
+        self.form = self.form_class(self.request.GET or None)
+        if self.form.is_valid():
+            self.object_list = self.get_queryset()
+            context = super(LatencyHistograms, self).get_context_data(**kwargs)
+
+        context['form'] = self.form
+        return context
+
+    def get_queryset(self):
+        source = self.form.cleaned_data['source']
+        params = self.get_queryset_params()
+        if source == 'view':
+            qs = models_mongo.ViewLatencyHistogram.objects.filter(**params)
+        else:
+            qs = models_mongo.QueryLatencyHistogram.objects.filter(source=source, **params)
+
+        by_hour = self.form.cleaned_data.get('by_hour')
+        # (key, period or None): merged LogHistogram
+        histograms = {}
+        for item in qs:
+            key = item.view_func_path if source == 'view' else item.key
+            group = (key, item.period if by_hour else None)
+            if group in histograms:
+                histograms[group].merge(item.get_histogram())
+            else:
+                histograms[group] = item.get_histogram()
+
+        fingerprints = {}
+        if source == models_mongo.QueryDigest.SLOW_LOG_SOURCE and histograms:
+            digests = models_mongo.QueryDigest.objects(
+                source=source, fingerprint_hash__in=list(set(key for key, period in histograms)))
+            fingerprints = dict(digests.scalar('fingerprint_hash', 'fingerprint'))
+
+        rows = [
+            {
+                'key': key,
+                'fingerprint': fingerprints.get(key),
+                'period': period,
+                'count': histogram.count,
+                'duration_sum': histogram.total,
+                'duration_avg': histogram.total / histogram.count if histogram.count else None,
+                'duration_max': histogram.max_value,
+                'percentiles': [(percent, histogram.quantile(percent / 100.0)) for percent in self.percents],
+            }
+            for (key, period), histogram in histograms.items()
+        ]
+        if by_hour:
+            rows.sort(key=lambda row: (row['key'], row['period']))
+        else:
+            # the most expensive entities first
+            rows.sort(key=lambda row: -row['duration_sum'])
+        return rows
+
+    def get_queryset_params(self):
+        params = {}
+        if self.form.cleaned_data.get('key'):
+            key_field = 'view_func_path' if self.form.cleaned_data['source'] == 'view' else 'key'
+            params[key_field] = {'$regex': '^%s' % re.escape(self.form.cleaned_data['key'])}
+
+        if self.form.cleaned_data.get('min_dc'):
+            params['period__gte'] = get_period(_date_to_datetime(self.form.cleaned_data['min_dc']))
+
+        if self.form.cleaned_data.get('max_dc'):
+            params['period__lte'] = _date_to_datetime_lte(self.form.cleaned_data['max_dc'])
+
+        if 'period__gte' not in params and 'period__lte' not in params:
+            params['period__gte'] = get_period(datetime.datetime.now() - self.default_window)
+
+        return params
+
+
 def _date_to_datetime(date):
     return datetime.datetime(*(date.timetuple()[:6]))
 